@@ -8,30 +8,102 @@ Whan started, this program asks for the following information by GUI:
     * serial port baudrate (textbox)
 Upon answer, it connects to a serialshare-server instance and enables
 communication between the given serial port and the server.
+
+With --headless, it asks nothing, and connects with the last used profile,
+changed by any of --host, --device and --baudrate. The device may then be
+a path, e.g. /dev/ttyACM0 or COM3, which is opened without listing ports.
+--device may be given more than once, to share several ports over one
+connection, each as a session of its own.
 """
-import asyncio
+import argparse
+import logging
+import time
 
-from . import device
-from . import ui
-from . import net
 from . import data
-
-import websockets.exceptions
+from . import trace
+
+# startup is timed from here, before the slow imports
+started = time.monotonic()
+
+parser = argparse.ArgumentParser(prog="serialshare")
+parser.add_argument(
+    "--headless", action="store_true",
+    help="connect without asking, using the last used profile and any "
+         "options given here"
+)
+parser.add_argument("--host", dest="hostname", help="server to connect to")
+parser.add_argument(
+    "--device", action="append",
+    help="serial device path or description. may be given more than once"
+)
+parser.add_argument("--baudrate", type=int)
+parser.add_argument(
+    "--debug", action="store_true",
+    help="print every chunk of serial data sent and received"
+)
+parser.add_argument(
+    "--trace", metavar="PREFIX",
+    help="time sampled serial data through the client, and write the "
+         "trace to PREFIX.client.json on exit"
+)
+parser.add_argument(
+    "--trace-every", type=int, default=trace.EVERY, metavar="BYTES",
+    help="bytes of serial data between samples. the server's must match"
+)
+args = parser.parse_args()
+
+logging.basicConfig(
+    level=logging.DEBUG if args.debug else logging.WARNING,
+    format="%(name)s: %(message)s"
+)
+
+if args.device is not None and len(args.device) == 1:
+    args.device = args.device[0]
+elif args.device is not None and not args.headless:
+    parser.error("more than one --device needs --headless")
 
 # fetch last used settings, or the defaults
 profile = data.read_profile()
 print(profile)
 
-all_devices = device.list_devices()
+# settings given as arguments win over saved ones
+profile.update({
+    key: value for key, value in vars(args).items()
+    if key in profile and value is not None
+})
+
+if args.headless:
+    missing = [key for key in ("hostname", "device") if not profile[key]]
+    if missing:
+        parser.error("no {} given, or saved from an earlier run".format(
+            " or ".join(missing)
+        ))
+
+    from . import device
 
-# configure profile from gui
-ui.input_window(profile, all_devices.keys())
+    if isinstance(profile["device"], list):
+        profile["device"] = [device.resolve(d) for d in profile["device"]]
+    else:
+        profile["device"] = device.resolve(profile["device"])
+    on_error = print
+else:
+    # imported here, since tkinter and listing ports are slow, and headless
+    # clients never need them
+    from . import device
+    from . import ui
 
-# save profile
-data.write_profile(profile)
+    all_devices = device.list_devices()
+
+    # configure profile from gui
+    ui.input_window(profile, all_devices.keys())
+
+    # save profile
+    data.write_profile(profile)
+
+    # pull just the name of the device from the dict
+    profile["device"] = all_devices.get(profile["device"], profile["device"])
+    on_error = ui.error
 
-# pull just the name of the device from the dict
-profile["device"] = all_devices[profile["device"]]
 # fix up baudrate from string
 profile["baudrate"] = int(profile["baudrate"])
 
@@ -39,70 +111,15 @@ print("Connecting device {} at {} baud to host {}.".format(
     profile["device"], profile["baudrate"], profile["hostname"]
 ))
 
+# the websocket and serial libraries load last, so their time is counted
+from . import client
+
+if args.trace is not None:
+    trace.enable("client", args.trace_every)
+try:
+    client.run(profile, on_error=on_error, started=started)
+finally:
+    trace.dump(args.trace)
 
-async def main(event_loop):
-    """ connects serial port with websocket """
-    # get our connection
-    for tries in range(0,3):
-        print('try', tries)
-        try:
-            websocket = await net.connect(profile["hostname"])
-        except OSError:
-            ui.error("connection failed.")
-            if tries < 2:
-                print("connection failed. retrying...")
-                await asyncio.sleep(5/3)
-                continue
-            # after three tries (five seconds), give up
-            event_loop.stop()
-            return
-        else:
-            break
-    # create the protocol object for pyserial to write to
-    webserial = net.WebSerial(websocket, event_loop)
-
-    # read from the serial device into the websocket
-    transport, _ = await device.open_dev(
-        loop,
-        lambda: webserial,
-        profile["device"],
-        profile["baudrate"]
-    )
-
-    # read from the websocket into the serial device
-    try:
-        async for message in websocket:
-            # message is bytes if we send it as such, so no need to decode
-            # we do need to parse message type though
-            mtype = message[0]
-            MESSAGE_SERIAL = 0 # data to/from serial device
-            MESSAGE_PING = 1 # websocket keepalive
-            MESSAGE_PONG = 2 # keepalive response
-
-            message = message[1:]
-
-            if mtype == MESSAGE_SERIAL:
-                lastbyte = 0x00
-                print('received from server:', str(message))
-                for byte in message:
-                    ## fix newlines
-                    #if byte == ord('\n') and lastbyte != ord('\r'):
-                    #    transport.write(b'\r\n')
-                    #else:
-                    if True: # TODO: that's silly
-                        transport.write(bytes([byte]))
-            elif mtype == MESSAGE_PING:
-                # respond to ping
-                # TODO: add timestamp
-                websocket.send(bytes([2, 0]))
-
-    except websockets.exceptions.ConnectionClosedError:
-        print("connection lost.")
-        asyncio.get_running_loop().stop()
-
-
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main(loop))
-loop.run_forever()
-loop.close()
-ui.error("serialshare has exited.")
+if not args.headless:
+    ui.error("serialshare has exited.")
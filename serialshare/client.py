@@ -0,0 +1,304 @@
+"""
+linking a serial port to serialshare-server, given a complete profile
+
+kept apart from __main__ and ui, so it runs without a display (e.g. from
+serialshare_server.bench)
+"""
+import asyncio
+import collections
+import logging
+import random
+import time
+import uuid
+
+import websockets.exceptions
+
+from . import compress
+from . import data
+from . import device
+from . import metrics
+from . import net
+from . import proto
+from . import sync
+
+# a serial port, and what applies files synced to its device
+_Port = collections.namedtuple("_Port", ["webserial", "receiver"])
+
+_log = logging.getLogger(__name__)
+
+# serial data received from the server, and how often we had to reconnect
+_BYTES, _FRAMES, _FRAME_SIZES = metrics.traffic("to_device")
+_RECONNECTS = metrics.REGISTRY.counter(
+    "serialshare_reconnects_total", "connections made again after dropping"
+)
+_RECONNECT_FAILURES = metrics.REGISTRY.counter(
+    "serialshare_reconnect_failures_total", "failed attempts to reconnect"
+)
+
+
+def _devices(profile):
+    """ returns the list of serial devices in the profile """
+    devices = profile["device"]
+    return [devices] if isinstance(devices, str) else list(devices)
+
+
+async def _connect(profile, stream):
+    """ returns a websocket connection, with the profile's settings """
+    return await net.connect(
+        profile["hostname"], profile["compression"], stream=stream,
+        channels=len(_devices(profile))
+    )
+
+
+def _framer(websocket, profile):
+    """ returns a proto.Framer for what the server agreed to """
+    # the server says which protocol version to speak, and whether it
+    # agreed to compress frames
+    framer = proto.Framer(proto.negotiate(websocket.response_headers))
+    if compress.negotiated(websocket.response_headers):
+        framer.compressor = compress.Compressor(
+            int(profile["compress_threshold"])
+        )
+        framer.decompressor = compress.Decompressor()
+    return framer
+
+
+async def _serve(websocket, ports, profile):
+    """ links `websocket` with the serial ports until it closes """
+    framer = _framer(websocket, profile)
+
+    # the server may take fewer ports than we asked it to, and the rest
+    # keep only their history until a reconnect
+    count = 1
+    if framer.version >= 2:
+        count = min(proto.channels(websocket.response_headers), len(ports))
+    if count < len(ports):
+        print("server took {} of {} serial ports".format(count, len(ports)))
+    linked = ports[:count]
+
+    # with more than one port, each only sends as the server acks it
+    window = proto.WINDOW if count > 1 else None
+    acked = set()
+
+    for port in linked:
+        port.receiver.link(websocket, framer)
+    # version 1 servers can't say what they already have, so carry on from
+    # wherever we got to
+    if framer.version < 2:
+        ports[0].webserial.link(websocket, framer)
+
+    # measure latency for as long as we're connected
+    pinger = asyncio.ensure_future(proto.ping_loop(websocket, framer))
+
+    # read from the websocket into the serial device
+    try:
+        async for message in websocket:
+            # message is bytes if we send it as such, so no need to decode
+            # we do need to parse message type though
+            try:
+                frame = framer.unpack(message)
+            except proto.FrameError as error:
+                _log.warning("skipped a frame: %s", error)
+                continue
+
+            if frame.mtype == proto.PING:
+                await websocket.send(framer.pong(frame))
+                continue
+            if frame.channel >= count:
+                continue
+            webserial, receiver = linked[frame.channel]
+
+            if frame.mtype == proto.SERIAL:
+                _log.debug("received from server: %r", frame.payload)
+                _FRAMES.inc()
+                _BYTES.inc(len(frame.payload))
+                _FRAME_SIZES.observe(len(frame.payload))
+                if receiver.busy():
+                    # typing into a sync would break it
+                    receiver.held += frame.payload
+                    continue
+                # while the uart drains, this holds off reading any more
+                # messages, so a big paste backs up into the websocket
+                await webserial.write(frame.payload)
+            elif frame.mtype == proto.SYNC:
+                await receiver.receive(frame.payload)
+            elif frame.mtype == proto.ACK and frame.channel in acked:
+                webserial.grant(proto.read_offset(frame))
+            elif frame.mtype == proto.ACK:
+                # resend whatever the server missed, then carry on
+                acked.add(frame.channel)
+                webserial.link(
+                    websocket, framer, proto.read_offset(frame), window
+                )
+
+    except websockets.exceptions.ConnectionClosedError:
+        pass
+    finally:
+        pinger.cancel()
+        for port in linked:
+            port.webserial.unlink()
+            port.receiver.link(None, None)
+    print("connection lost.")
+
+
+async def _reconnect(profile, stream, closed):
+    """
+    retries connecting, waiting twice as long after each failure, until it
+    works or the Event `closed` is set. returns the websocket, or None
+    """
+    delay = float(profile["reconnect_min"])
+    while not closed.is_set():
+        try:
+            return await _connect(profile, stream)
+        except (OSError, asyncio.TimeoutError,
+                websockets.exceptions.InvalidHandshake) as error:
+            _RECONNECT_FAILURES.inc()
+            print("reconnect failed ({}), retrying in {:.2f}s".format(
+                error, delay
+            ))
+
+        # jitter keeps a room full of clients from retrying in lockstep
+        try:
+            await asyncio.wait_for(
+                closed.wait(), delay * random.uniform(0.8, 1.2)
+            )
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, float(profile["reconnect_max"]))
+    return None
+
+
+def _report(started, what, when=None):
+    """ prints how long after `started` something happened, if timing """
+    if started is not None:
+        print("{} after {:.3f}s".format(
+            what, (time.monotonic() if when is None else when) - started
+        ))
+
+
+async def _summarize(interval):
+    """ prints a summary of the metrics every `interval` seconds """
+    while True:
+        await asyncio.sleep(interval)
+        print("metrics:")
+        for line in metrics.REGISTRY.summary():
+            print("  " + line)
+
+
+async def _all_closed(ports, closed):
+    """ sets the Event `closed` once every port's serial port closes """
+    await asyncio.gather(*(port.webserial.closed.wait() for port in ports))
+    closed.set()
+
+
+def _receiver(webserial, path, baudrate):
+    """ returns a sync.Receiver for the device at `path` """
+    receiver = sync.Receiver(
+        webserial,
+        baudrate,
+        data.read_manifest(path),
+        lambda: data.write_manifest(path, receiver.manifest)
+    )
+    return receiver
+
+
+async def bridge(profile, event_loop, on_error=print, started=None):
+    """
+    connects serial ports with websocket, reconnecting whenever the
+    websocket drops, until the serial ports close
+    with several devices in the profile, they share the websocket, each on
+    its own channel
+    with `started`, a time.monotonic() time, prints how long startup took
+    """
+    # names this run's serial output, so the server can tell where we left
+    # off when we reconnect
+    stream = uuid.uuid4().hex
+
+    # get our connection
+    for tries in range(0,3):
+        print('try', tries)
+        try:
+            websocket = await _connect(profile, stream)
+        except OSError:
+            on_error("connection failed.")
+            if tries < 2:
+                print("connection failed. retrying...")
+                await asyncio.sleep(5/3)
+                continue
+            # after three tries (five seconds), give up
+            return
+        else:
+            break
+    _report(started, "connected to server")
+
+    # every port takes turns to send a frame
+    turn = asyncio.Lock()
+    ports = []
+    for channel, path in enumerate(_devices(profile)):
+        # create the protocol object for pyserial to write to
+        webserial = net.WebSerial(
+            None,
+            event_loop,
+            attach=device.AttachSequence(profile["attach"]),
+            max_frame=int(profile["max_frame"]),
+            flush_delay=float(profile["flush_delay"]),
+            replay_size=int(profile["replay_size"]),
+            channel=channel,
+            turn=turn
+        )
+
+        # read from the serial device into the websocket
+        await device.open_dev(
+            event_loop,
+            lambda webserial=webserial: webserial,
+            path,
+            profile["baudrate"]
+        )
+        _report(started, "opened serial port " + path)
+        webserial.first_sent.add_done_callback(
+            lambda sent, path=path: _report(
+                started, "sent first serial byte from " + path, sent.result()
+            )
+        )
+
+        # applies files the server syncs to the device
+        ports.append(_Port(
+            webserial, _receiver(webserial, path, profile["baudrate"])
+        ))
+
+    closed = asyncio.Event()
+    asyncio.ensure_future(_all_closed(ports, closed))
+
+    summarizer = None
+    if float(profile["metrics_interval"]) > 0:
+        summarizer = asyncio.ensure_future(
+            _summarize(float(profile["metrics_interval"]))
+        )
+
+    while websocket is not None:
+        serving = asyncio.ensure_future(_serve(websocket, ports, profile))
+        closing = asyncio.ensure_future(closed.wait())
+        await asyncio.wait(
+            [serving, closing], return_when=asyncio.FIRST_COMPLETED
+        )
+        closing.cancel()
+
+        if closed.is_set():
+            # the serial ports are gone, so there's nothing left to link
+            serving.cancel()
+            await websocket.close()
+            break
+
+        websocket = await _reconnect(profile, stream, closed)
+        if websocket is not None:
+            _RECONNECTS.inc()
+
+    if summarizer is not None:
+        summarizer.cancel()
+
+
+def run(profile, on_error=print, started=None):
+    """ runs the bridge until the serial ports close """
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bridge(profile, loop, on_error, started))
+    loop.close()
@@ -0,0 +1,98 @@
+"""
+optional compression of websocket frames, shared by client and server
+
+the client asks for it with an http header when connecting, and the server
+repeats the header back if it agrees. each direction is then one zlib
+stream, flushed at the end of every frame, so later frames are compressed
+against everything sent before them. frames smaller than a threshold (like
+single keystrokes) are sent as they are, and compressed frames have the
+high bit of their type byte set
+"""
+import time
+import zlib
+
+# the http header compression is negotiated with, and its only value
+HEADER = "X-Serialshare-Compression"
+ZLIB = "zlib"
+
+# the type byte bit marking a compressed frame
+FLAG = 0x80
+
+# frames with fewer payload bytes than this are sent uncompressed
+THRESHOLD = 64
+
+# what a sync flush ends every compressed frame with, so it isn't sent
+_SYNC_TAIL = b'\x00\x00\xff\xff'
+
+
+class _Stats:
+    """ counters for one direction of a compressed stream """
+    def __init__(self):
+        self.frames = 0
+        # frames sent or received as they were, under the threshold
+        self.frames_raw = 0
+        self.bytes_raw = 0
+        self.bytes_compressed = 0
+        self.cpu_time = 0.0
+
+    def stats(self):
+        """ returns a dict of counters, with the compression ratio """
+        return {
+            "frames": self.frames,
+            "frames_raw": self.frames_raw,
+            "bytes_raw": self.bytes_raw,
+            "bytes_compressed": self.bytes_compressed,
+            "ratio": self.bytes_raw / max(self.bytes_compressed, 1),
+            "cpu_time": self.cpu_time,
+        }
+
+
+class Compressor(_Stats):
+    """ compresses outgoing frames of at least `threshold` bytes """
+    def __init__(self, threshold=THRESHOLD, level=6):
+        super().__init__()
+        self.threshold = threshold
+        # a raw deflate stream, as permessage-deflate uses
+        self.zlib = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def pack(self, mtype, payload):
+        """ returns a frame of type `mtype` carrying `payload` """
+        if len(payload) < self.threshold:
+            self.frames_raw += 1
+            return bytes([mtype]) + payload
+
+        start = time.process_time()
+        data = self.zlib.compress(payload) + self.zlib.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.process_time() - start
+
+        self.frames += 1
+        self.bytes_raw += len(payload)
+        self.bytes_compressed += len(data) - len(_SYNC_TAIL)
+        return bytes([mtype | FLAG]) + data[:-len(_SYNC_TAIL)]
+
+
+class Decompressor(_Stats):
+    """ expands incoming frames that were sent compressed """
+    def __init__(self):
+        super().__init__()
+        self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def unpack(self, message):
+        """ returns `message` as it was before Compressor.pack """
+        if not message[0] & FLAG:
+            self.frames_raw += 1
+            return message
+
+        start = time.process_time()
+        payload = self.zlib.decompress(message[1:] + _SYNC_TAIL)
+        self.cpu_time += time.process_time() - start
+
+        self.frames += 1
+        self.bytes_raw += len(payload)
+        self.bytes_compressed += len(message) - 1
+        return bytes([message[0] & ~FLAG]) + payload
+
+
+def negotiated(headers):
+    """ returns whether `headers` agree to zlib compression """
+    return headers.get(HEADER, "").strip().lower() == ZLIB
@@ -9,20 +9,56 @@ from appdirs import AppDirs
 _dirs = AppDirs("serialshare", "Jadon Bennett")
 _config_dir = _dirs.user_config_dir
 _profile = os.path.join(_config_dir, "last_profile.json")
+_manifest = os.path.join(_config_dir, "sync_manifest.json")
 
 DEFAULT_PROFILE = {
+    # a serial device, or a list of them to share over one connection
     "device": None,
     "baudrate": 9600,
     "hostname": None,
+    # largest websocket frame to send serial data in, in bytes
+    "max_frame": 4096,
+    # how long to let serial reads coalesce before sending, in seconds
+    "flush_delay": 0.005,
+    # "zlib" to compress frames if the server agrees, "deflate" for
+    # websocket permessage-deflate, or "none"
+    "compression": "zlib",
+    # frames smaller than this, in bytes, are never compressed
+    "compress_threshold": 64,
+    # most recent serial output kept to resend after reconnecting, in bytes
+    "replay_size": 1024 * 1024,
+    # seconds to wait before the first reconnect attempt, doubling after
+    # each failure up to the maximum
+    "reconnect_min": 0.1,
+    "reconnect_max": 10,
+    # seconds between printed summaries of the client's metrics, or 0 for
+    # none
+    "metrics_interval": 60,
+    # steps run against the device when its port opens. each step can
+    # "send" a string, "expect" a string (giving up after "timeout" seconds),
+    # or "delay" for some seconds. these should reboot a CircuitPython device
+    # and open the REPL
+    "attach": [
+        {"send": "\x03"},
+        {"delay": 0.1},
+        {"send": "\x04"},
+        {"expect": "soft reboot", "timeout": 0.5},
+        {"send": "\x03"},
+        {"expect": "any key", "timeout": 0.5},
+        {"send": "\n"},
+        {"expect": ">>> ", "timeout": 2},
+    ],
 }
 
 
 def read_profile():
     """ returns the last used profile, or the default if it does not exist """
+    config = dict(DEFAULT_PROFILE)
     if os.path.isdir(_config_dir) and os.path.exists(_profile):
         with open(_profile, "r") as profile:
-            return json.load(profile)
-    return DEFAULT_PROFILE
+            # profiles saved by older versions may be missing newer keys
+            config.update(json.load(profile))
+    return config
 
 
 def write_profile(config):
@@ -32,3 +68,28 @@ def write_profile(config):
 
     with open(_profile, "w") as profile:
         json.dump(config, profile)
+
+
+def read_manifest(device):
+    """
+    returns the hashes of files synced to `device`, keyed by path on the
+    device, or an empty dict if nothing has been synced to it
+    """
+    if not os.path.exists(_manifest):
+        return {}
+    with open(_manifest, "r") as manifest:
+        return json.load(manifest).get(device, {})
+
+
+def write_manifest(device, files):
+    """ saves `files`, from read_manifest, as what `device` has """
+    pathlib.Path(_config_dir).mkdir(parents=True, exist_ok=True)
+
+    devices = {}
+    if os.path.exists(_manifest):
+        with open(_manifest, "r") as manifest:
+            devices = json.load(manifest)
+    devices[device] = files
+
+    with open(_manifest, "w") as manifest:
+        json.dump(devices, manifest)
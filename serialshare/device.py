@@ -2,15 +2,38 @@
 functions for communicating with serial devices
 """
 
+import asyncio
+import os
+import re
+import time
+
 import serial_asyncio
-import serial.tools.list_ports
+
+# a windows port name, as opposed to one of list_devices' descriptions
+_COM_PORT = re.compile(r"COM\d+", re.IGNORECASE)
 
 
 def list_devices():
     """ return a dict of device names, keyed by description """
+    # imported here, since enumerating ports is slow, and a client given a
+    # device path never needs to
+    import serial.tools.list_ports
+
     return {str(d): d.device for d in serial.tools.list_ports.comports()}
 
 
+def resolve(name):
+    """
+    returns the device path for `name`, which is either a path already or a
+    description from list_devices. ports are only listed for the latter
+    """
+    # windows ports aren't files. "COM3" is a port, but "COM3 - USB Serial
+    # (COM3)" is a description, to look up like any other
+    if os.path.exists(name) or _COM_PORT.fullmatch(name):
+        return name
+    return list_devices().get(name, name)
+
+
 def open_dev(loop, protofac, device, baudrate):
     """ return a local serial port connection """
     return serial_asyncio.create_serial_connection(
@@ -19,3 +42,66 @@ def open_dev(loop, protofac, device, baudrate):
         device,
         baudrate
     )
+
+
+class AttachSequence:
+    """
+    a list of steps to run against a serial device when it's opened
+    steps are dicts with any of the keys:
+        * "send": a string to write to the device
+        * "expect": a string to wait for the device to print
+        * "timeout": seconds to wait for "expect" before moving on anyway
+        * "delay": seconds to wait
+    """
+    # how much recent output to keep around for matching "expect" steps
+    _window = 1024
+
+    def __init__(self, steps):
+        self.steps = steps
+        # device output since the last "send"
+        self.seen = bytearray()
+        # the string an "expect" step is waiting on, and its signal
+        self.expecting = None
+        self.found = asyncio.Event()
+
+    def feed(self, data):
+        """ watches data read from the device for an expected string """
+        self.seen += data
+        del self.seen[:-self._window]
+
+        if self.expecting is not None and self.expecting in self.seen:
+            self.found.set()
+
+    async def run(self, transport):
+        """ runs each step in order, returning the seconds it took """
+        start = time.monotonic()
+
+        for step in self.steps:
+            if "send" in step:
+                self.seen.clear()
+                transport.write(step["send"].encode("latin-1"))
+
+            if "expect" in step:
+                await self._expect(
+                    step["expect"].encode("latin-1"),
+                    float(step.get("timeout", 1))
+                )
+
+            if "delay" in step:
+                await asyncio.sleep(float(step["delay"]))
+
+        return time.monotonic() - start
+
+    async def _expect(self, expected, timeout):
+        """ waits for `expected` to be printed, or for `timeout` seconds """
+        self.expecting = expected
+        self.found.clear()
+        # it might have turned up while we were busy with an earlier step
+        self.feed(b'')
+
+        try:
+            await asyncio.wait_for(self.found.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.expecting = None
@@ -0,0 +1,226 @@
+"""
+A module for counting what serialshare does, cheaply enough to leave on
+
+metrics are kept in a Registry, by name and labels. the server serves its
+registry at /metrics, in the Prometheus text format, and the client prints
+a summary of its own every so often
+
+metrics are plain numbers, updated without locks, so each one should only
+ever be updated from one thread
+"""
+
+import bisect
+import collections
+import math
+
+# upper bounds of the default histogram buckets, for sizes in bytes and for
+# times in seconds
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+TIME_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0
+)
+
+# the content type of Registry.render()'s output
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# every metric with the same name, by its labels as a sorted tuple of pairs
+_Family = collections.namedtuple("_Family", ["kind", "help", "metrics"])
+
+
+def _number(value):
+    """ returns a sample value as the text format spells it """
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _labels(pairs):
+    """ returns label pairs as {name="value",...}, or "" without any """
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace(
+            '"', '\\"'
+        ).replace("\n", "\\n"))
+        for name, value in pairs
+    ) + "}"
+
+
+class Counter:
+    """ a number that only goes up """
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """ adds `amount` to the count """
+        self.value += amount
+
+    def samples(self):
+        """ yields (name suffix, extra labels, value) to render """
+        yield "", (), self.value
+
+
+class Gauge:
+    """ a number that goes up and down """
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        """ replaces the value """
+        self.value = value
+
+    def samples(self):
+        """ yields (name suffix, extra labels, value) to render """
+        yield "", (), self.value
+
+
+class Histogram:
+    """
+    counts of observations falling in each of a few buckets, with their
+    total, so means and rough quantiles can be worked out later
+    """
+    kind = "histogram"
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        # observations in each bucket, not cumulative, with one more for
+        # anything above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """ adds one observation """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """
+        returns the upper bound of the bucket the `fraction` quantile falls
+        in, math.inf if it's past the last one, or None with no observations
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def samples(self):
+        """ yields (name suffix, extra labels, value) to render """
+        seen = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            seen += count
+            yield "_bucket", (("le", _number(bound)),), seen
+        yield "_sum", (), self.sum
+        yield "_count", (), self.count
+
+
+class Registry:
+    """
+    every metric by name and labels. asking for a metric again returns the
+    same one, so modules can look theirs up once and keep them
+    """
+    def __init__(self):
+        # _Families by metric name, in the order they were made
+        self.families = {}
+
+    def _metric(self, cls, name, help_text, labels, *args):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = _Family(cls.kind, help_text, {})
+        elif family.kind != cls.kind:
+            raise ValueError("{} is a {}".format(name, family.kind))
+
+        key = tuple(sorted(labels.items()))
+        metric = family.metrics.get(key)
+        if metric is None:
+            metric = family.metrics[key] = cls(*args)
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        """ returns the Counter called `name` with `labels` """
+        return self._metric(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, **labels):
+        """ returns the Gauge called `name` with `labels` """
+        return self._metric(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, **labels):
+        """ returns the Histogram called `name` with `labels` """
+        return self._metric(Histogram, name, help_text, labels, buckets)
+
+    def render(self):
+        """ returns every metric in the Prometheus text exposition format """
+        lines = []
+        for name, family in self.families.items():
+            lines.append("# HELP {} {}".format(name, family.help))
+            lines.append("# TYPE {} {}".format(name, family.kind))
+            for key, metric in family.metrics.items():
+                for suffix, extra, value in metric.samples():
+                    lines.append("{}{}{} {}".format(
+                        name, suffix, _labels(key + extra), _number(value)
+                    ))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        returns a line of text for each metric that has seen anything, with
+        a histogram's count, mean and rough p50 and p99
+        """
+        lines = []
+        for name, family in self.families.items():
+            for key, metric in family.metrics.items():
+                label = name + _labels(key)
+                if family.kind != Histogram.kind:
+                    if metric.value:
+                        lines.append("{} {}".format(
+                            label, _number(metric.value)
+                        ))
+                elif metric.count:
+                    lines.append(
+                        "{} count {} mean {:.4g} p50 <={} p99 <={}".format(
+                            label,
+                            metric.count,
+                            metric.sum / metric.count,
+                            _number(metric.quantile(0.5)),
+                            _number(metric.quantile(0.99))
+                        )
+                    )
+        return lines
+
+
+# the registry the rest of serialshare counts in
+REGISTRY = Registry()
+
+
+def traffic(direction):
+    """
+    returns the byte Counter, frame Counter and frame size Histogram for
+    SERIAL frames going `direction`, "to_device" or "from_device"
+    """
+    return (
+        REGISTRY.counter(
+            "serialshare_serial_bytes_total",
+            "serial data carried in SERIAL frames", direction=direction
+        ),
+        REGISTRY.counter(
+            "serialshare_serial_frames_total",
+            "SERIAL frames carried", direction=direction
+        ),
+        REGISTRY.histogram(
+            "serialshare_serial_frame_bytes",
+            "size of the serial data in each SERIAL frame",
+            SIZE_BUCKETS, direction=direction
+        ),
+    )
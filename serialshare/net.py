@@ -1,44 +1,335 @@
 """ networking and i/o """
 import asyncio
+import logging
 import time
 
 import websockets.client
+import websockets.exceptions
+
+from . import compress
+from . import metrics
+from . import proto
+from . import trace
+
+# largest payload sent in one websocket frame, in bytes
+MAX_FRAME = 4096
+# how long to wait for a burst of serial reads to coalesce, in seconds
+FLUSH_DELAY = 0.005
+# pause reading the serial port once this many bytes are waiting to be sent,
+# and resume once the backlog drops below the low watermark
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+# most recent serial data kept to resend after reconnecting, in bytes
+REPLAY_SIZE = 1024 * 1024
+
+_log = logging.getLogger(__name__)
+
+# serial data sent to the server
+_BYTES, _FRAMES, _FRAME_SIZES = metrics.traffic("from_device")
 
 
 class WebSerial(asyncio.Protocol):
-    """ represents serial port linked with websocket """
-    def __init__(self, websocket, loop):
+    """
+    represents serial port linked with websocket
+    the port stays open across reconnects: the websocket is swapped with
+    link() and unlink(), and output read in between is kept for replay
+    """
+    def __init__(self, websocket, loop, attach=None,
+                 max_frame=MAX_FRAME, flush_delay=FLUSH_DELAY,
+                 high_water=HIGH_WATER, low_water=LOW_WATER,
+                 framer=None, replay_size=REPLAY_SIZE, channel=0, turn=None):
         self.websocket = websocket
+        # the proto.Framer for the connection's negotiated protocol
+        self.framer = framer if framer is not None else proto.Framer()
         self.loop = loop
         self.transport = None
 
+        # the channel this port's frames are sent on, and a lock shared by
+        # every port sending over the same websocket. asyncio.Lock wakes
+        # waiters in order, so the ports take turns a frame at a time, and
+        # a busy port can't crowd out the rest
+        self.channel = channel
+        self.turn = turn if turn is not None else asyncio.Lock()
+
+        # a device.AttachSequence to run once the port opens, and its task
+        self.attach = attach
+        self.attacher = None
+        # while set, a callable that takes serial data instead of the server
+        self.divert = None
+
+        self.max_frame = max_frame
+        self.flush_delay = flush_delay
+        self.high_water = high_water
+        self.low_water = low_water
+
+        # the most recent serial data, sent or not, so whatever the server
+        # missed can be sent again after a reconnect. it holds the stream
+        # from offset self.base, and at most replay_size bytes of it
+        self.history = bytearray()
+        self.base = 0
+        self.replay_size = max(replay_size, high_water)
+        # the stream offset of the next byte to send
+        self.offset = 0
+        # with a window, the most bytes that may be sent past the offset the
+        # server last acked, and set whenever it acks more
+        self.window = None
+        self.acked = 0
+        self.credit = asyncio.Event()
+        # how far the server's count of the stream is behind ours, by the
+        # bytes it never got because they'd left the history
+        self.skew = 0
+        # set whenever self.history has new data in it
+        self.pending = asyncio.Event()
+        # whether we've asked the serial transport to stop reading
+        self.paused = False
+        # the task draining self.history into the websocket
+        self.sender = None
+        # set while the serial port's write buffer has room for more data
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # set once the serial port closes
+        self.closed = asyncio.Event()
+        # resolved with the time.monotonic() time the first frame was sent
+        self.first_sent = loop.create_future()
+
+        # counters, for comparing frame counts against bytes sent
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        # bytes resent after reconnecting, and bytes the server never got
+        # because they'd already left the history
+        self.bytes_replayed = 0
+        self.bytes_skipped = 0
+
     def connection_made(self, transport):
         self.transport = transport
         print('serial port opened')
-        # Ctrl-C, Ctrl-D, Ctrl-C, newline
-        # this should reboot a CircuitPython device and open the REPL
-        transport.write(b'\x03')
-        time.sleep(0.1)
-        transport.write(b'\x04')
-        time.sleep(0.1)
-        transport.write(b'\x03')
-        time.sleep(0.1)
-        transport.write(b'\x0a')
+
+        # keep about a second of data queued for the uart. anything more
+        # waits in the websocket (and the server) rather than in our memory
+        high = max(transport.serial.baudrate // 10, 256)
+        transport.set_write_buffer_limits(high=high, low=high // 4)
+
+        if self.websocket is not None:
+            self.sender = self.loop.create_task(self._send_loop())
+
+        if self.attach is not None:
+            self.attacher = self.loop.create_task(self._run_attach())
+
+    async def _run_attach(self):
+        """ runs the attach sequence without holding up other i/o """
+        elapsed = await self.attach.run(self.transport)
+        print("attach sequence finished in {:.3f}s".format(elapsed))
+
+    def end(self):
+        """ returns the stream offset just past the newest serial data """
+        return self.base + len(self.history)
 
     def data_received(self, data):
-        print("got data", data)
-        coro = self.websocket.send(b'\x00' + data)
-        return asyncio.create_task(coro)
+        _log.debug("got data %r", data)
+        if self.attacher is not None and not self.attacher.done():
+            self.attach.feed(data)
+        if self.divert is not None:
+            self.divert(data)
+            return
+        if self.channel == 0:
+            trace.mark("data_received", "stream", self.end(), len(data))
+        self.history += data
+        self.pending.set()
+
+        # forget the oldest data, sent or not, rather than grow forever
+        # while disconnected
+        excess = len(self.history) - self.replay_size
+        if excess > 0:
+            del self.history[:excess]
+            self.base += excess
+            if self.offset < self.base:
+                self.bytes_skipped += self.base - self.offset
+                self.offset = self.base
+
+        # with no websocket, keep reading, and let the history drop the
+        # oldest data instead
+        if self.websocket is None:
+            return
+        if not self.paused and self.backlog() >= self.high_water:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    async def write(self, data):
+        """
+        writes `data` to the serial port in one call
+        waits first if the port is still draining earlier writes
+        """
+        await self.writable.wait()
+        self.transport.write(data)
+
+    def link(self, websocket, framer, acked=None, window=None):
+        """
+        starts sending serial data to `websocket`, from stream offset
+        `acked` if the server said how much of the stream it already has,
+        and no more than `window` bytes past what it acks, if given
+        """
+        self.websocket = websocket
+        self.framer = framer
+        self.window = window
+
+        if acked is not None:
+            if acked < self.base:
+                self.bytes_skipped += self.base - acked
+            # the server may have got more than we counted as sent, or
+            # less, if it lost frames that were in flight as we dropped
+            offset = min(max(acked, self.base), self.end())
+            self.bytes_replayed += max(self.offset - offset, 0)
+            self.offset = offset
+            self.acked = offset
+            self.skew = offset - acked
+
+        if self.transport is not None:
+            self.sender = self.loop.create_task(self._send_loop())
+        self.pending.set()
+
+    def grant(self, acked):
+        """ notes that the server has taken the stream up to `acked` """
+        self.acked = max(self.acked, acked + self.skew)
+        self.credit.set()
+
+    def unlink(self):
+        """ stops sending, but keeps reading the serial port """
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
+        self.websocket = None
+
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
 
     def connection_lost(self, exc):
-        self.transport.loop.stop()
+        for task in (self.sender, self.attacher):
+            if task is not None:
+                task.cancel()
+        print("sent {} bytes in {} frames".format(
+            self.bytes_sent, self.frames_sent
+        ))
+        if self.bytes_replayed or self.bytes_skipped:
+            print("replayed {} bytes after reconnecting, lost {}".format(
+                self.bytes_replayed, self.bytes_skipped
+            ))
+        if self.framer.compressor is not None:
+            print("compressed {bytes_raw} bytes to {bytes_compressed} "
+                  "({ratio:.2f}x) in {cpu_time:.3f}s of cpu".format(
+                      **self.framer.compressor.stats()
+                  ))
+        if self.framer.rtts:
+            print("round trips {:.1f}ms p50, {:.1f}ms p99".format(
+                self.framer.stats()["rtt_p50"] * 1e3,
+                self.framer.stats()["rtt_p99"] * 1e3
+            ))
+        self.closed.set()
+
+    def backlog(self):
+        """ returns the number of bytes read but not yet handed to the OS """
+        size = self.end() - self.offset
+        ws_transport = getattr(self.websocket, "transport", None)
+        if ws_transport is not None:
+            size += ws_transport.get_write_buffer_size()
+        return size
+
+    def _maybe_resume(self):
+        """ resumes reading from the serial port once the backlog drains """
+        if self.paused and self.backlog() <= self.low_water:
+            self.paused = False
+            self.transport.resume_reading()
+
+    async def _send_loop(self):
+        """ sends coalesced frames of serial data until the socket closes """
+        try:
+            while True:
+                await self.pending.wait()
+
+                # give a burst of small reads the chance to pile up,
+                # unless there's already enough for a full frame
+                unsent = self.end() - self.offset
+                if self.flush_delay and unsent < self.max_frame:
+                    await asyncio.sleep(self.flush_delay)
+                self.pending.clear()
+
+                while self.offset < self.end():
+                    size = self.max_frame
+                    if self.window is not None:
+                        room = self.acked + self.window - self.offset
+                        size = min(size, room)
+                        if size <= 0:
+                            # wait for the server to take some of it
+                            self.credit.clear()
+                            await self.credit.wait()
+                            continue
+
+                    async with self.turn:
+                        start = self.offset - self.base
+                        chunk = bytes(self.history[start:start + size])
+                        self.offset += len(chunk)
+                        frame = self.framer.pack(
+                            proto.SERIAL, chunk, self.channel
+                        )
+                        if self.channel == 0:
+                            trace.mark(
+                                "ws_send", "stream", start + self.base,
+                                len(chunk)
+                            )
+
+                        # this waits for the websocket's write buffer to
+                        # drain, which is what holds the backlog down
+                        await self.websocket.send(frame)
+                    self.frames_sent += 1
+                    self.bytes_sent += len(chunk)
+                    _FRAMES.inc()
+                    _BYTES.inc(len(chunk))
+                    _FRAME_SIZES.observe(len(chunk))
+                    if not self.first_sent.done():
+                        self.first_sent.set_result(time.monotonic())
+
+                    self._maybe_resume()
+
+                # everything we had is with the OS now, so it's safe to read
+                if self.paused:
+                    self.paused = False
+                    self.transport.resume_reading()
+        except websockets.exceptions.ConnectionClosed:
+            return
 
 
-def connect(host):
-    """ returns a websocket connection """
+def connect(host, compression=compress.ZLIB, version=proto.VERSION,
+            stream=None, channels=1):
+    """
+    returns a websocket connection
+    `compression` is compress.ZLIB to ask the server for compressed frames,
+    "deflate" for permessage-deflate, or None (or "none") for neither.
+    `version` is the newest protocol version to ask for, and `stream`
+    names the serial stream, so the server can tell a reconnect apart from
+    a new device. `channels` is the number of serial ports to carry
+    """
+    headers = [(proto.HEADER, str(version))]
+    if stream is not None:
+        headers.append((proto.STREAM_HEADER, stream))
+    if channels > 1:
+        headers.append((proto.CHANNELS_HEADER, str(channels)))
+    if compression == compress.ZLIB:
+        headers.append((compress.HEADER, compress.ZLIB))
     # TODO: use wss, once the server is ready for deployment
     return websockets.client.connect(
         "ws://{}/ws".format(host),
         ping_interval=2,
-        ping_timeout=10
+        ping_timeout=10,
+        # only a few messages may wait while the serial port drains, so the
+        # server feels the backpressure instead of us buffering its paste
+        max_queue=4,
+        # zlib frames are already compressed, so never compress them twice
+        compression="deflate" if compression == "deflate" else None,
+        extra_headers=headers
     )
@@ -0,0 +1,239 @@
+"""
+the wire protocol spoken between client and server, shared by both
+
+every frame starts with a type byte. version 1 frames follow it with the
+payload and nothing else. version 2 frames follow it with a header of
+channel, sequence number and the sender's monotonic clock, then the
+payload. the client asks for a version with an http header when
+connecting, and the server answers with the version both sides will use
+
+frames may also be compressed, see compress.py, which wraps everything
+after the type byte
+
+a version 2 connection may carry several serial ports, one per channel.
+the client asks for a number of channels with another header, and the
+server answers with how many it took. channel 0 is the only one otherwise.
+one channel's backlog mustn't hold up the others, which share the same
+socket, so each channel has at most WINDOW bytes in flight: after the
+first ack, the server acks again as it takes a channel's data
+"""
+import asyncio
+import collections
+import struct
+import time
+import zlib
+
+import websockets.exceptions
+
+# the http header the protocol version is negotiated with
+HEADER = "X-Serialshare-Protocol"
+# the newest version this side speaks
+VERSION = 2
+# the http header naming a client's serial stream, which stays the same
+# across reconnects
+STREAM_HEADER = "X-Serialshare-Stream"
+# the http header with the number of channels asked for, or agreed to
+CHANNELS_HEADER = "X-Serialshare-Channels"
+# the most channels one connection may carry
+MAX_CHANNELS = 16
+# the most serial bytes a channel of several may send past the last ack
+WINDOW = 32 * 1024
+
+# frame types
+SERIAL = 0 # data to/from serial device
+SYNC = 1 # file sync
+PING = 2 # latency probe
+PONG = 3 # latency probe response, echoing the probe's timestamp
+ACK = 4 # serial bytes of the stream the server has, sent on connecting
+        # and, with several channels, as it takes them
+
+# version 2's header: channel, sequence number, microseconds timestamp
+_HEADER_V2 = struct.Struct("!HIQ")
+# a pong's payload: the timestamp of the ping it answers
+_ECHO = struct.Struct("!Q")
+# an ack's payload: a stream offset
+_OFFSET = struct.Struct("!Q")
+
+# seconds between latency probes
+PING_INTERVAL = 1.0
+
+# samples kept for latency percentiles
+_SAMPLES = 256
+
+Frame = collections.namedtuple(
+    "Frame", ["mtype", "channel", "seq", "timestamp", "payload"]
+)
+
+
+class FrameError(ValueError):
+    """ a message from the peer that isn't a frame at all """
+
+
+def now():
+    """ returns this side's monotonic clock, in whole microseconds """
+    return time.monotonic_ns() // 1000
+
+
+def negotiate(headers, version=VERSION):
+    """
+    returns the version to speak with a peer that sent `headers`: the
+    newest both know, or 1 for peers that never asked
+    """
+    try:
+        asked = int(headers.get(HEADER, "1"))
+    except ValueError:
+        return 1
+    return max(1, min(asked, version))
+
+
+def channels(headers, most=MAX_CHANNELS):
+    """
+    returns the number of channels in `headers`, at most `most`, or 1 if
+    they don't say
+    """
+    try:
+        asked = int(headers.get(CHANNELS_HEADER, "1"))
+    except ValueError:
+        return 1
+    return max(1, min(asked, most))
+
+
+def channel_stream(stream, channel):
+    """ returns the stream name for `channel` of a connection's `stream` """
+    if stream is None or channel == 0:
+        return stream
+    return "{}.{}".format(stream, channel)
+
+
+def _percentile(samples, share):
+    """ returns the `share` percentile of `samples`, or None if empty """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+class Framer:
+    """
+    builds and parses frames for one connection, at the negotiated version,
+    and keeps its latency statistics
+    `compressor` and `decompressor` are compress.Compressor and
+    Decompressor, if compression was negotiated
+    """
+    def __init__(self, version=1, compressor=None, decompressor=None):
+        self.version = version
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+        # the next sequence number to send, and the last one received
+        self.seq = 0
+        self.received_seq = None
+        # frames that never arrived, going by sequence numbers, and
+        # messages that weren't frames
+        self.lost = 0
+        self.malformed = 0
+
+        # round trip times of pings, in seconds
+        self.rtts = collections.deque(maxlen=_SAMPLES)
+        # the smallest gap seen between the peer's clock and ours. a frame
+        # arriving later than that was held up on the way, by that much
+        self.base_offset = None
+        self.delays = collections.deque(maxlen=_SAMPLES)
+
+    def pack(self, mtype, payload=b'', channel=0):
+        """ returns a frame of type `mtype` carrying `payload` """
+        if self.version >= 2:
+            payload = _HEADER_V2.pack(channel, self.seq, now()) + payload
+            self.seq = (self.seq + 1) & 0xffffffff
+
+        if self.compressor is not None:
+            return self.compressor.pack(mtype, payload)
+        return bytes([mtype]) + payload
+
+    def unpack(self, message):
+        """ returns the Frame in `message`, noting its latency """
+        if not isinstance(message, bytes) or not message:
+            self.malformed += 1
+            raise FrameError("expected a binary frame")
+
+        if self.decompressor is not None:
+            try:
+                message = self.decompressor.unpack(message)
+            except zlib.error as error:
+                self.malformed += 1
+                raise FrameError("bad compressed frame: {}".format(error))
+
+        mtype = message[0]
+        if self.version < 2:
+            return Frame(mtype, 0, None, None, message[1:])
+
+        if len(message) < 1 + _HEADER_V2.size:
+            self.malformed += 1
+            raise FrameError("frame shorter than its header")
+        channel, seq, timestamp = _HEADER_V2.unpack_from(message, 1)
+        frame = Frame(
+            mtype, channel, seq, timestamp, message[1 + _HEADER_V2.size:]
+        )
+        if mtype == ACK and len(frame.payload) < _OFFSET.size:
+            self.malformed += 1
+            raise FrameError("ack without an offset")
+
+        if self.received_seq is not None:
+            self.lost += (seq - self.received_seq - 1) & 0xffffffff
+        self.received_seq = seq
+
+        offset = now() - timestamp
+        if self.base_offset is None or offset < self.base_offset:
+            self.base_offset = offset
+        self.delays.append((offset - self.base_offset) / 1e6)
+
+        if mtype == PONG and len(frame.payload) >= _ECHO.size:
+            sent, = _ECHO.unpack_from(frame.payload)
+            self.rtts.append((now() - sent) / 1e6)
+
+        return frame
+
+    def ping(self):
+        """ returns a ping frame """
+        return self.pack(PING, _ECHO.pack(now()))
+
+    def pong(self, ping):
+        """ returns the pong frame answering the Frame `ping` """
+        return self.pack(PONG, ping.payload)
+
+    def ack(self, offset, channel=0):
+        """ returns an ack frame for stream offset `offset` """
+        return self.pack(ACK, _OFFSET.pack(offset), channel)
+
+    def stats(self):
+        """ returns a dict of latency counters, in seconds """
+        return {
+            "version": self.version,
+            "lost": self.lost,
+            "malformed": self.malformed,
+            "rtt_last": self.rtts[-1] if self.rtts else None,
+            "rtt_p50": _percentile(self.rtts, 0.5),
+            "rtt_p99": _percentile(self.rtts, 0.99),
+            "queue_delay_last": self.delays[-1] if self.delays else None,
+            "queue_delay_p99": _percentile(self.delays, 0.99),
+        }
+
+
+def read_offset(frame):
+    """ returns the stream offset in the ack Frame `frame` """
+    return _OFFSET.unpack_from(frame.payload)[0]
+
+
+async def ping_loop(websocket, framer, interval=PING_INTERVAL):
+    """
+    sends a ping every `interval` seconds until `websocket` closes, if the
+    peer speaks version 2
+    """
+    if framer.version < 2:
+        return
+    try:
+        while True:
+            await websocket.send(framer.ping())
+            await asyncio.sleep(interval)
+    except websockets.exceptions.ConnectionClosed:
+        return
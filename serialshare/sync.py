@@ -0,0 +1,525 @@
+"""
+file sync: pushing files from the server onto the device, rsync-style
+
+the exchange, in SYNC frames, goes:
+    * server OFFER: a file's destination, size, crc32 and block hashes
+    * client HAVE: the hashes of the blocks the device has now, checked
+      against the device, and how much of an interrupted copy survives
+    * server DELTA: the new file as instructions to copy blocks the
+      device already has, and literal data for everything else
+    * client DONE: whether the new file checked out on the device
+
+the client keeps the hashes of every file it has synced (see
+data.read_manifest), so the device never sends its files back. it writes
+through the device's raw REPL, a command at a time, so it can never get
+ahead of the uart
+"""
+import ast
+import asyncio
+import hashlib
+import json
+import struct
+import time
+import zlib
+
+from . import proto
+
+# bytes per block, matching a flash sector
+BLOCK_SIZE = 512
+
+# sync operations, the first byte of a SYNC frame's payload
+OFFER = 0
+HAVE = 1
+DELTA = 2
+DONE = 3
+
+# a DELTA frame's header: the start of the new file's digest, and the
+# offset into the new file its first instruction writes at
+_DELTA = struct.Struct("!8sI")
+# instructions: copy an old block, or write literal data
+_COPY = struct.Struct("!cI")
+_DATA = struct.Struct("!cH")
+
+# what an OFFER has to say about the file
+_OFFER_KEYS = ("dest", "digest", "size", "crc32", "block_size", "blocks")
+
+# the rolling checksum's modulus
+_MOD = 1 << 16
+
+
+def weak_hash(block):
+    """ returns the rolling checksum of `block` """
+    low = sum(block) % _MOD
+    high = sum((len(block) - i) * byte for i, byte in enumerate(block)) % _MOD
+    return low | high << 16
+
+
+def strong_hash(block):
+    """ returns a hash of `block` that blocks matching weakly can't share """
+    return hashlib.blake2b(block, digest_size=8).hexdigest()
+
+
+def block_hashes(data, block_size=BLOCK_SIZE):
+    """ returns [weak, strong] hashes for each whole block of `data` """
+    return [
+        [weak_hash(data[start:start + block_size]),
+         strong_hash(data[start:start + block_size])]
+        for start in range(0, len(data) - block_size + 1, block_size)
+    ]
+
+
+def describe(data, block_size=BLOCK_SIZE):
+    """ returns the OFFER fields describing `data` """
+    return {
+        "digest": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        "crc32": zlib.crc32(data),
+        "block_size": block_size,
+        "blocks": block_hashes(data, block_size),
+    }
+
+
+def delta(data, blocks, block_size=BLOCK_SIZE):
+    """
+    yields (offset, instruction) pairs that rebuild `data` from an old file
+    with block hashes `blocks`, each starting at `offset` in `data`
+    any run of bytes not found in the old file, at any alignment, is sent
+    as literal data of at most a block
+    """
+    strong = {}
+    for index, (weak, digest) in enumerate(blocks):
+        strong.setdefault(weak, {}).setdefault(digest, index)
+
+    literal = bytearray()
+    literal_start = 0
+    position = 0
+    # the rolling checksum's halves, for the window at `position`
+    low = high = None
+
+    def flush():
+        nonlocal literal
+        if literal:
+            yield literal_start, _DATA.pack(b'd', len(literal)) + literal
+            literal = bytearray()
+
+    while position < len(data):
+        window = data[position:position + block_size]
+        match = None
+        if len(window) == block_size and strong:
+            if low is None:
+                low = sum(window) % _MOD
+                high = sum(
+                    (block_size - i) * byte for i, byte in enumerate(window)
+                ) % _MOD
+            candidates = strong.get(low | high << 16)
+            if candidates is not None:
+                match = candidates.get(strong_hash(window))
+
+        if match is not None:
+            yield from flush()
+            yield position, _COPY.pack(b'c', match)
+            position += block_size
+            low = high = None
+            continue
+
+        # no match here, so this byte is literal and the window rolls on
+        if not literal:
+            literal_start = position
+        byte = data[position]
+        literal.append(byte)
+        if len(literal) >= block_size:
+            yield from flush()
+        if low is not None:
+            following = position + block_size
+            incoming = data[following] if following < len(data) else None
+            if incoming is None:
+                low = high = None
+            else:
+                low = (low - byte + incoming) % _MOD
+                high = (high - block_size * byte + low) % _MOD
+        position += 1
+
+    yield from flush()
+
+
+def pack(operation, body):
+    """ returns a SYNC payload for an operation with a json `body` """
+    return bytes([operation]) + json.dumps(body).encode("utf-8")
+
+
+def pack_delta(digest, offset, instructions):
+    """ returns a DELTA payload of `instructions` starting at `offset` """
+    return bytes([DELTA]) + _DELTA.pack(
+        bytes.fromhex(digest)[:8], offset
+    ) + b''.join(instructions)
+
+
+def unpack(payload):
+    """
+    returns (operation, body): a dict, or for DELTA frames, a tuple of the
+    digest prefix, offset and a list of ("copy", index) or ("data", bytes)
+    """
+    operation = payload[0]
+    if operation != DELTA:
+        return operation, json.loads(payload[1:].decode("utf-8"))
+
+    prefix, offset = _DELTA.unpack_from(payload, 1)
+    instructions = []
+    position = 1 + _DELTA.size
+    while position < len(payload):
+        kind = payload[position:position + 1]
+        if kind == b'c':
+            _, index = _COPY.unpack_from(payload, position)
+            instructions.append(("copy", index))
+            position += _COPY.size
+        else:
+            _, length = _DATA.unpack_from(payload, position)
+            position += _DATA.size
+            instructions.append(("data", payload[position:position + length]))
+            position += length
+    return operation, (prefix.hex(), offset, instructions)
+
+
+class RawRepl:
+    """
+    runs python on a CircuitPython (or MicroPython) device through its raw
+    REPL, one command at a time, while the serial port's output is diverted
+    away from the server
+    """
+    def __init__(self, webserial, baudrate):
+        self.webserial = webserial
+        # bytes per second the uart can carry, with start and stop bits
+        self.rate = max(baudrate, 1) / 10
+        self.output = bytearray()
+        self.arrived = asyncio.Event()
+        # when the uart will have sent everything written so far
+        self.drained = 0.0
+
+    def _receive(self, data):
+        self.output += data
+        self.arrived.set()
+
+    async def _write(self, data):
+        """ writes `data`, no faster than the uart can send it """
+        delay = self.drained - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.webserial.write(data)
+        now = max(self.drained, time.monotonic())
+        self.drained = now + len(data) / self.rate
+
+    async def _read_until(self, ending, timeout=10):
+        """ returns device output up to and including `ending` """
+        deadline = time.monotonic() + timeout
+        while ending not in self.output:
+            self.arrived.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("device stopped responding")
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        end = self.output.index(ending) + len(ending)
+        data = bytes(self.output[:end])
+        del self.output[:end]
+        return data
+
+    async def __aenter__(self):
+        self.webserial.divert = self._receive
+        # interrupt whatever is running, then switch to the raw REPL
+        await self._write(b'\r\x03\x03')
+        await asyncio.sleep(0.1)
+        self.output.clear()
+        await self._write(b'\r\x01')
+        await self._read_until(b'raw REPL; CTRL-B to exit\r\n>')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self._write(b'\x02')
+        finally:
+            self.webserial.divert = None
+
+    async def run(self, code, timeout=10):
+        """ runs `code`, returning its output, or raises its error """
+        await self._write(code.encode("utf-8") + b'\x04')
+        await self._read_until(b'OK', timeout)
+        output = await self._read_until(b'\x04', timeout)
+        error = await self._read_until(b'\x04', timeout)
+        await self._read_until(b'>', timeout)
+        if len(error) > 1:
+            raise RuntimeError(error[:-1].decode("utf-8", "replace"))
+        return output[:-1].decode("utf-8", "replace")
+
+    async def evaluate(self, expression, timeout=10):
+        """ returns the value of `expression`, a literal, on the device """
+        output = await self.run("print(repr({}))".format(expression), timeout)
+        return ast.literal_eval(output.strip())
+
+
+# defines, on the device, a function returning (size, crc32) of a file,
+# after closing any files an interrupted sync left open, so their buffers
+# can't land in the middle of the next one
+_STAT = """\
+import os, binascii
+for _ss_n in ('_ss_f', '_ss_g'):
+    try:
+        globals()[_ss_n].close()
+    except (KeyError, AttributeError):
+        pass
+def _ss_stat(p):
+    try:
+        f = open(p, 'rb')
+    except OSError:
+        return None
+    n = c = 0
+    while True:
+        b = f.read(512)
+        if not b:
+            break
+        n += len(b)
+        c = binascii.crc32(b, c)
+    f.close()
+    return (n, c)
+"""
+
+# source bytes of instructions to send in one command
+_BATCH = 1024
+
+
+class Receiver:
+    """
+    the client's side of a file sync, applying one offered file at a time
+    to the device
+    `manifest` is the dict of file hashes from data.read_manifest, and
+    `save` is called after it changes
+    """
+    def __init__(self, webserial, baudrate, manifest, save):
+        self.webserial = webserial
+        self.baudrate = baudrate
+        self.manifest = manifest
+        self.save = save
+
+        # the websocket and proto.Framer to answer on, while connected
+        self.websocket = None
+        self.framer = None
+
+        # the OFFER being applied, the HAVE sent for it, its task, and the
+        # DELTA frames that arrived for it
+        self.offer = None
+        self.have = None
+        self.task = None
+        self.deltas = asyncio.Queue()
+
+        # keys typed while the device is busy syncing, written once it's not
+        self.held = bytearray()
+
+    def link(self, websocket, framer):
+        """ answers on `websocket` from now on """
+        self.websocket = websocket
+        self.framer = framer
+
+    def busy(self):
+        """ returns whether a sync has the device """
+        return self.task is not None and not self.task.done()
+
+    async def _send(self, operation, body):
+        if self.websocket is None:
+            # the server offers again when we reconnect
+            return
+        await self.websocket.send(
+            self.framer.pack(
+                proto.SYNC, pack(operation, body), self.webserial.channel
+            )
+        )
+
+    async def receive(self, payload):
+        """ handles the payload of a SYNC frame from the server """
+        operation, body = unpack(payload)
+
+        if operation == DELTA:
+            offer = self.offer
+            if offer is not None and offer["digest"].startswith(body[0]):
+                self.deltas.put_nowait(body)
+            return
+
+        if operation != OFFER:
+            return
+
+        if not isinstance(body, dict):
+            # _apply turns it down, with a DONE saying why
+            body = {}
+
+        if self.busy() and body.get("digest") == self.offer.get("digest"):
+            # offered again after a reconnect: carry on from wherever the
+            # device got to. a sync still working out what the device has
+            # sends its HAVE once it knows
+            if self.have is not None:
+                await self._send(HAVE, self.have)
+            return
+
+        if self.busy():
+            self.task.cancel()
+        self.offer = body
+        self.have = None
+        self.deltas = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._apply(body))
+
+    async def _apply(self, offer):
+        """ writes the offered file to the device, then reports back """
+        start = time.monotonic()
+        result = {
+            "dest": offer.get("dest"), "digest": offer.get("digest"),
+            "ok": False
+        }
+
+        try:
+            missing = [key for key in _OFFER_KEYS if key not in offer]
+            if missing:
+                raise ValueError("offer is missing " + ", ".join(missing))
+            dest = offer["dest"]
+            if not isinstance(dest, str):
+                raise ValueError("offer's dest isn't a path")
+            temp = dest + ".sync"
+            # the file as the device should have it, per the last sync
+            known = self.manifest.get(dest)
+
+            # the attach sequence would type into the raw REPL
+            if self.webserial.attacher is not None:
+                await self.webserial.attacher
+            async with RawRepl(self.webserial, self.baudrate) as repl:
+                await repl.run(_STAT)
+                current, partial = await repl.evaluate(
+                    "(_ss_stat({!r}), _ss_stat({!r}))".format(dest, temp)
+                )
+                if current is not None:
+                    current = list(current)
+
+                # only trust the hashes if the device still has that file
+                blocks = []
+                if known is not None and current == [
+                        known["size"], known["crc32"]
+                ] and known["block_size"] == offer["block_size"]:
+                    blocks = known["blocks"]
+
+                # an interrupted copy of this same file, against the same
+                # old file, picks up where it stopped
+                resume = 0
+                pending = self.manifest.get(temp)
+                if partial is not None and pending == {
+                        "digest": offer["digest"], "base": current
+                }:
+                    resume = partial[0]
+                self.manifest[temp] = {
+                    "digest": offer["digest"], "base": current
+                }
+                self.save()
+
+                await repl.run(
+                    "_ss_f = open({!r}, 'rb')\n".format(dest)
+                    if blocks else "_ss_f = None\n"
+                )
+                await repl.run(
+                    "_ss_g = open({!r}, {!r})\n"
+                    "def c(i):\n"
+                    "    _ss_f.seek(i * {})\n"
+                    "    _ss_g.write(_ss_f.read({}))\n"
+                    "w = _ss_g.write\n".format(
+                        temp, "ab" if resume else "wb",
+                        offer["block_size"], offer["block_size"]
+                    )
+                )
+
+                self.have = {
+                    "dest": dest,
+                    "digest": offer["digest"],
+                    "blocks": blocks,
+                    "resume": resume,
+                }
+                await self._send(HAVE, self.have)
+
+                result["bytes_sent"] = await self._write(
+                    repl, offer, resume, temp
+                )
+
+                await repl.run("_ss_g.close()\nif _ss_f: _ss_f.close()\n")
+                written = await repl.evaluate("_ss_stat({!r})".format(temp))
+                if written is None:
+                    self.manifest.pop(temp, None)
+                    self.save()
+                    raise ValueError("copy on the device went missing")
+                if list(written) != [offer["size"], offer["crc32"]]:
+                    # so the next try starts over, rather than resuming
+                    self.manifest.pop(temp, None)
+                    self.save()
+                    raise ValueError("copy on the device didn't match")
+
+                await repl.run(
+                    "try:\n"
+                    "    os.remove({0!r})\n"
+                    "except OSError:\n"
+                    "    pass\n"
+                    "os.rename({1!r}, {0!r})\n".format(dest, temp)
+                )
+
+            self.manifest[dest] = {
+                key: offer[key] for key in ("size", "crc32", "block_size")
+            }
+            self.manifest[dest]["blocks"] = offer["blocks"]
+            self.manifest.pop(temp, None)
+            self.save()
+            result["ok"] = True
+        except (RuntimeError, ValueError, TimeoutError, SyntaxError) as error:
+            result["error"] = str(error)
+        except (KeyError, TypeError) as error:
+            # a field of the offer had the wrong type
+            result["error"] = "malformed offer: {!r}".format(error)
+        finally:
+            result["seconds"] = time.monotonic() - start
+            # whatever was typed meanwhile can go to the device now
+            held = bytes(self.held)
+            self.held.clear()
+            if held:
+                await self.webserial.write(held)
+
+        await self._send(DONE, result)
+
+    async def _write(self, repl, offer, resume, temp):
+        """
+        runs DELTA instructions from `resume` up to the end of the file in
+        `temp`, returning the bytes of literal data written
+        """
+        position = resume
+        sent = 0
+        while position < offer["size"]:
+            _, offset, instructions = await self.deltas.get()
+            if offset == 0 and position == resume and resume:
+                # the server couldn't resume there, so start over
+                await repl.run(
+                    "_ss_g.close()\n_ss_g = open({!r}, 'wb')\n"
+                    "w = _ss_g.write\n".format(temp)
+                )
+                position = 0
+            if offset != position:
+                # left over from before a reconnect
+                continue
+
+            lines = []
+            for kind, value in instructions:
+                if kind == "copy":
+                    lines.append("c({})".format(value))
+                    position += offer["block_size"]
+                else:
+                    lines.append("w({!r})".format(bytes(value)))
+                    position += len(value)
+                    sent += len(value)
+
+                if sum(map(len, lines)) >= _BATCH:
+                    await repl.run("\n".join(lines))
+                    lines = []
+            if lines:
+                await repl.run("\n".join(lines))
+
+            self.have["resume"] = position
+        return sent
@@ -0,0 +1,312 @@
+"""
+A module for tracing how long serial data spends in each stage between the
+device and the screen
+
+tracing is off unless enable()d. once it's on, every `every`th byte of
+device output is a sample, and each stage marks the time the sample got
+there with mark(). nothing travels with the data itself: samples are named
+by their offset in one of two byte streams, which every process counts the
+same way
+    "stream": the default session's serial stream, as the client reads it
+              off channel 0 and the server takes it off the websocket
+    "pipe":   everything the server writes down the pipe to the terminal,
+              connection markers and all
+the server's pipe_write stage marks both, which joins the two up
+
+times are time.monotonic_ns(), which is the same clock in every process on
+one machine, so the client's, server's and terminal's traces can be merged
+into one, if they ran on the same machine with the same `every`
+
+each process dumps its marks as a Chrome trace, which perfetto opens too,
+and `python -m serialshare.trace` merges several into one, and prints how
+long each stage took
+"""
+
+import argparse
+import collections
+import json
+import os
+import signal
+import threading
+import time
+
+from . import metrics
+
+# the stages, in the order data passes through them. each stage's latency
+# is the time since the sample was marked by the one before it
+STAGES = (
+    # the client reads it from the serial port
+    "data_received",
+    # the client hands it to the websocket
+    "ws_send",
+    # the server takes it off the websocket
+    "ws_receive",
+    # the server writes it to the terminal's pipe
+    "pipe_write",
+    # the terminal reads it from the pipe and queues it
+    "receive_bytes",
+    # the terminal takes it off the queue, and has fed it to pyte
+    "feed_start",
+    "feed_end",
+    # the terminal has drawn a frame with it on
+    "drawn",
+)
+_ORDER = {stage: number for number, stage in enumerate(STAGES)}
+
+# bytes between samples, and most samples kept, by default
+EVERY = 256
+LIMIT = 100000
+
+# one stage's mark of a sample: a process id and time in microseconds
+_Mark = collections.namedtuple(
+    "_Mark", ["pid", "stage", "space", "offset", "ts"]
+)
+
+
+def _previous(stages, stage):
+    """ returns the last stage in `stages` that comes before `stage` """
+    earlier = [
+        other for other in stages if _ORDER[other] < _ORDER[stage]
+    ]
+    return max(earlier, key=_ORDER.get) if earlier else None
+
+
+def _samples(marks):
+    """ returns {(space, offset): {stage: _Mark}} for a list of _Marks """
+    samples = {}
+    for mark in marks:
+        sample = samples.setdefault((mark.space, mark.offset), {})
+        # streams start over from 0 when a device does, so keep the first
+        sample.setdefault(mark.stage, mark)
+    return samples
+
+
+def latencies(marks):
+    """ returns {stage: [seconds, ...]} for a list of _Marks """
+    result = collections.defaultdict(list)
+    for sample in _samples(marks).values():
+        for stage, mark in sample.items():
+            previous = _previous(sample, stage)
+            if previous is not None:
+                result[stage].append((mark.ts - sample[previous].ts) / 1e6)
+    return result
+
+
+def chrome(marks, names, other=None):
+    """
+    returns a Chrome trace of a list of _Marks: an instant event for each,
+    and an async span for each stage of each sample. `names` maps process
+    ids to the names to show them by
+    """
+    events = [
+        {"name": "process_name", "ph": "M", "pid": pid,
+         "args": {"name": name}}
+        for pid, name in names.items()
+    ]
+    for mark in marks:
+        events.append({
+            "name": mark.stage, "ph": "i", "s": "p", "ts": mark.ts,
+            "pid": mark.pid, "tid": 0,
+            "args": {"space": mark.space, "offset": mark.offset},
+        })
+
+    for (space, offset), sample in _samples(marks).items():
+        for stage, mark in sample.items():
+            previous = _previous(sample, stage)
+            if previous is None:
+                continue
+            span = {
+                "name": stage, "cat": space, "pid": mark.pid, "tid": 0,
+                "id2": {"global": "{}:{}".format(space, offset)},
+                "args": {"offset": offset},
+            }
+            events.append(dict(span, ph="b", ts=sample[previous].ts))
+            events.append(dict(span, ph="e", ts=mark.ts))
+
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": other or {},
+    }
+
+
+class Tracer:
+    """
+    the samples one process has seen, and when each stage saw them
+    `role` names the process in the trace
+    """
+    def __init__(self, role, every=EVERY, limit=LIMIT):
+        self.role = role
+        self.every = max(1, every)
+        self.limit = limit
+
+        # the time.monotonic_ns() of each stage, by (space, offset)
+        self.samples = {}
+        # marks of samples that didn't fit under the limit
+        self.dropped = 0
+        # the terminal marks from its feeding and drawing threads too
+        self.lock = threading.Lock()
+
+    def mark(self, stage, space, start, size):
+        """
+        notes the time `stage` got the `size` bytes from `start` on in
+        `space`, if any of them are samples
+        """
+        end = start + size
+        first = -(-start // self.every) * self.every
+        if first >= end:
+            return
+
+        now = time.monotonic_ns()
+        with self.lock:
+            for offset in range(first, end, self.every):
+                sample = self.samples.get((space, offset))
+                if sample is None:
+                    if len(self.samples) >= self.limit:
+                        self.dropped += 1
+                        continue
+                    sample = self.samples[(space, offset)] = {}
+                if stage in sample:
+                    continue
+                sample[stage] = now
+
+                previous = _previous(sample, stage)
+                if previous is not None:
+                    metrics.REGISTRY.histogram(
+                        "serialshare_trace_stage_seconds",
+                        "time sampled serial data took to reach each stage "
+                        "from the one before", stage=stage
+                    ).observe((now - sample[previous]) / 1e9)
+
+    def marks(self):
+        """ returns a list of every _Mark so far """
+        pid = os.getpid()
+        with self.lock:
+            return [
+                _Mark(pid, stage, space, offset, ns / 1000)
+                for (space, offset), sample in self.samples.items()
+                for stage, ns in sample.items()
+            ]
+
+    def dump(self, path):
+        """ writes the samples to `path` as a Chrome trace """
+        trace = chrome(self.marks(), {os.getpid(): self.role}, {
+            "every": self.every,
+            "dropped": self.dropped,
+        })
+        with open(path, "w") as output:
+            json.dump(trace, output)
+
+
+# this process's Tracer, while tracing is on
+TRACER = None
+
+
+def enable(role, every=EVERY, limit=LIMIT):
+    """ turns tracing on for this process, and returns its Tracer """
+    global TRACER
+    TRACER = Tracer(role, every, limit)
+    return TRACER
+
+
+def mark(stage, space, start, size):
+    """ marks samples with Tracer.mark, if tracing is on """
+    if TRACER is not None:
+        TRACER.mark(stage, space, start, size)
+
+
+def trace_path(prefix, role):
+    """ returns where the process called `role` dumps its trace """
+    return "{}.{}.json".format(prefix, role)
+
+
+def dump(prefix):
+    """ writes this process's trace next to `prefix`, if tracing is on """
+    if TRACER is not None:
+        TRACER.dump(trace_path(prefix, TRACER.role))
+
+
+def _terminated(signum, frame):
+    """ SIGTERM handler, exiting the way an exception would """
+    del signum, frame  # resolves pylint w0613
+    raise SystemExit(0)
+
+
+def exit_on_sigterm():
+    """
+    makes SIGTERM raise SystemExit, so a process stopped with it still gets
+    to dump its trace on the way out
+    """
+    signal.signal(signal.SIGTERM, _terminated)
+
+
+def read(path):
+    """ returns the _Marks and process names in a Chrome trace at `path` """
+    with open(path) as source:
+        events = json.load(source)["traceEvents"]
+
+    marks = []
+    names = {}
+    for event in events:
+        if event["ph"] == "M" and event["name"] == "process_name":
+            names[event["pid"]] = event["args"]["name"]
+        elif event["ph"] == "i" and event["name"] in _ORDER:
+            marks.append(_Mark(
+                event["pid"], event["name"], event["args"]["space"],
+                event["args"]["offset"], event["ts"]
+            ))
+    return marks, names
+
+
+def merge(paths):
+    """ returns (Chrome trace, latencies) for the traces at `paths` """
+    marks = []
+    names = {}
+    for path in paths:
+        more, more_names = read(path)
+        marks += more
+        names.update(more_names)
+    return chrome(marks, names), latencies(marks)
+
+
+def _percentile(samples, share):
+    return samples[min(int(len(samples) * share), len(samples) - 1)]
+
+
+def report(stage_latencies):
+    """ prints a table of each stage's latencies """
+    print("{:>14} {:>8} {:>9} {:>9} {:>9}".format(
+        "stage", "samples", "p50 ms", "p99 ms", "max ms"
+    ))
+    for stage in STAGES:
+        samples = sorted(stage_latencies.get(stage, ()))
+        if not samples:
+            continue
+        print("{:>14} {:>8} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            stage,
+            len(samples),
+            _percentile(samples, 0.5) * 1e3,
+            _percentile(samples, 0.99) * 1e3,
+            samples[-1] * 1e3,
+        ))
+
+
+def main():
+    """ merges traces given as arguments, and reports on the stages """
+    parser = argparse.ArgumentParser(prog="python -m serialshare.trace")
+    parser.add_argument("traces", nargs="+", help="traces to merge")
+    parser.add_argument(
+        "-o", "--output", metavar="FILE",
+        help="write the merged trace to FILE, to open in perfetto"
+    )
+    args = parser.parse_args()
+
+    trace, stage_latencies = merge(args.traces)
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(trace, output)
+    report(stage_latencies)
+
+
+if __name__ == "__main__":
+    main()
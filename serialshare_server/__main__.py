@@ -2,41 +2,127 @@
 """
 Server component for serialshare.
 Accepts a websocket connection and links it to the local terminal
+
+With --headless, there is no local terminal. Sessions' screens can be read
+over http instead, at /screen/<session-id>[.json], or followed as diffs
+over a websocket at /view/<session-id>
+
+Metrics are served at /metrics, in the Prometheus text format. They're
+the network half's: with a --transport that runs the terminal in a process
+of its own, the terminal's metrics (its queue depth, key latency and so on)
+stay in that process and aren't served
 """
 
+import argparse
 import asyncio
+import logging
 import multiprocessing
 import signal
 
-import aiopipe
+from serialshare import trace
 
 from . import net
-from . import term
+from . import push
+from . import session
+from . import transport
+
+_log = logging.getLogger("serialshare_server")
 
 
-async def net_server(pipe):
+async def net_server(pipe, args):
     """ wrapper function for starting a net.Server connected to `pipe` """
-    server = await net.Server(pipe, host="0.0.0.0", port=8080)
+    hub = session.Hub(
+        width=args.width,
+        height=args.height,
+        scrollback_dir=args.scrollback
+    )
+    server = await net.Server(
+        pipe,
+        host=args.host,
+        port=args.port,
+        hub=hub,
+        max_frame=args.max_frame,
+        flush_window=args.flush_window,
+        compression=args.compression,
+        compress_threshold=args.compress_threshold,
+        pusher=push.Pusher(args.sync) if args.sync else None,
+        static_dir=args.static
+    )
     return await server.wait_closed()
 
 
-def net_proc(pipe):
+def net_proc(pipe, args):
     """ wrapper for running net_server on its own thread/process """
-    asyncio.run(net_server(pipe))
-
-
-async def main():
+    if args.trace is not None:
+        trace.enable("server", args.trace_every)
+        # the terminal stops us with SIGTERM
+        trace.exit_on_sigterm()
+    try:
+        asyncio.run(net_server(pipe, args))
+    finally:
+        trace.dump(args.trace)
+
+
+def _net_stopped(terminal, task):
+    """
+    ends the terminal once the network half, running in its process, has
+    stopped, since nothing would ever connect to it
+    """
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is None:
+        reason = "network server stopped"
+    else:
+        reason = "network server failed: {}".format(error)
+    terminal.quitqueue.put_nowait(reason)
+    # wake input_loop, so it sees the reason
+    terminal.input_ready.set()
+
+
+async def main(args):
     """ wait for both terminal and websocket handlers to run """
 
-    # duplex pipe for communication between network and terminal i/o tasks
-    net_pipe, term_pipe = aiopipe.aioduplex()
-
-    # network process
-    with net_pipe.detach() as net_pipe:
-        proc = multiprocessing.Process(target=net_proc, args=(net_pipe,))
-        proc.start()
-
-    terminal = term.Terminal(term_pipe, fps=60)
+    # duplex link for communication between network and terminal i/o tasks
+    net_pipe, term_pipe = transport.duplex(args.transport)
+
+    # the terminal keeps a trace of its own, unless the network shares its
+    # process
+    if args.trace is not None:
+        trace.enable(
+            "server" if transport.in_process(args.transport) else "terminal",
+            args.trace_every
+        )
+
+    # network task, or process
+    proc = None
+    net_task = None
+    if transport.in_process(args.transport):
+        net_task = asyncio.ensure_future(net_server(net_pipe, args))
+    else:
+        with net_pipe.detach() as net_pipe:
+            proc = multiprocessing.Process(
+                target=net_proc,
+                args=(net_pipe, args)
+            )
+            proc.start()
+
+    # imported here, since asciimatics is slow to load and headless servers
+    # never need it
+    from . import term
+
+    terminal = term.Terminal(
+        term_pipe,
+        fps=60,
+        scrollback_dir=args.scrollback,
+        record_path=args.record,
+        paste_baudrate=args.paste_baudrate
+    )
+
+    if net_task is not None:
+        net_task.add_done_callback(
+            lambda task: _net_stopped(terminal, task)
+        )
 
     # catch ctrl-c and send it to the terminal task
     signal.signal(signal.SIGINT, terminal.sig_handler)
@@ -52,15 +138,111 @@ async def main():
         terminal.cleanup()
     finally:
         print(reason if not None else 'closed terminal?')
+        trace.dump(args.trace)
+
+        if net_task is not None:
+            if not net_task.done():
+                net_task.cancel()
+            elif not net_task.cancelled() and net_task.exception():
+                # logged now the terminal is back to normal, not over the
+                # screen curses was drawing
+                _log.error(
+                    "network server failed", exc_info=net_task.exception()
+                )
 
         # restore the default handler for the ctrl-c event
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-        proc.terminate()
-
-# disable general catching of ctrl-c
-signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if proc is not None:
+            proc.terminate()
+
+
+parser = argparse.ArgumentParser(prog="python -m serialshare_server")
+parser.add_argument("--host", default="0.0.0.0")
+parser.add_argument("--port", type=int, default=8080)
+parser.add_argument(
+    "--transport", choices=transport.MODES, default=transport.PIPE,
+    help="how the terminal talks to the network half of the server. "
+         "/metrics only includes the terminal's metrics when they share a "
+         "process"
+)
+parser.add_argument(
+    "--headless", action="store_true",
+    help="run without a local terminal, e.g. as a background service"
+)
+parser.add_argument(
+    "--width", type=int, default=session.WIDTH,
+    help="width of each session's virtual screen"
+)
+parser.add_argument(
+    "--height", type=int, default=session.HEIGHT,
+    help="height of each session's virtual screen"
+)
+parser.add_argument(
+    "--scrollback", metavar="DIR",
+    help="keep every session's full history in files in DIR"
+)
+parser.add_argument(
+    "--max-frame", type=int, default=net.MAX_FRAME, metavar="BYTES",
+    help="most bytes of terminal input sent to a device in one frame"
+)
+parser.add_argument(
+    "--flush-window", type=float, default=0.0, metavar="SECONDS",
+    help="hold a frame of terminal input open up to SECONDS for the rest "
+         "of a burst, rather than sending whatever has arrived at once"
+)
+parser.add_argument(
+    "--no-compression", dest="compression", action="store_false",
+    help="refuse devices' requests for compressed frames"
+)
+parser.add_argument(
+    "--compress-threshold", type=int, default=64, metavar="BYTES",
+    help="send terminal input frames smaller than this uncompressed"
+)
+parser.add_argument(
+    "--static", metavar="DIR",
+    help="serve the web page and its assets from DIR, instead of only the "
+         "index.html next to the server"
+)
+parser.add_argument(
+    "--sync", metavar="PATH[:DEST]", action="append", type=push.parse_spec,
+    help="keep the file at PATH synced to DEST on devices, /<name> if not "
+         "given. may be given more than once"
+)
+parser.add_argument(
+    "--record", metavar="FILE",
+    help="record the terminal session to FILE, in asciicast v2 format"
+)
+parser.add_argument(
+    "--paste-baudrate", type=int, metavar="BAUD",
+    help="send pastes no faster than a serial line at BAUD takes them, "
+         "e.g. the device's baud rate"
+)
+parser.add_argument(
+    "--trace", metavar="PREFIX",
+    help="time sampled device output through the server and terminal, and "
+         "write the traces to PREFIX.server.json and PREFIX.terminal.json "
+         "on exit"
+)
+parser.add_argument(
+    "--trace-every", type=int, default=trace.EVERY, metavar="BYTES",
+    help="bytes of device output between samples. the client's must match"
+)
+args = parser.parse_args()
+
+if args.headless:
+    if args.trace is not None:
+        trace.enable("server", args.trace_every)
+    # no terminal to pass ctrl-c to, so let it stop the server
+    try:
+        asyncio.run(net_server(None, args))
+    except KeyboardInterrupt:
+        pass
+    trace.dump(args.trace)
+else:
+    # disable general catching of ctrl-c
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-asyncio.run(main())
+    asyncio.run(main(args))
 
-print('connection lost.')
+    print('connection lost.')
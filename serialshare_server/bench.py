@@ -0,0 +1,815 @@
+"""
+Benchmarks for serialshare-server
+
+run with `python -m serialshare_server.bench <benchmark> --help` for options
+"""
+
+import argparse
+import asyncio
+import fcntl
+import http
+import json
+import multiprocessing
+import os
+import pty
+import signal
+import statistics
+import struct
+import sys
+import tempfile
+import termios
+import time
+import tty
+
+import websockets
+
+from serialshare import trace
+
+from . import net
+from . import static
+from . import transport
+
+# something like what a chatty device prints: colored log lines
+_SAMPLE_LINE = b"\x1b[32mINFO\x1b[0m sensor %05d: temp=23.4C rh=41%%\r\n"
+
+
+def _sample_output(size):
+    """ returns `size` bytes of terminal output to feed through a session """
+    lines = bytearray()
+    number = 0
+    while len(lines) < size:
+        lines += _SAMPLE_LINE % number
+        number += 1
+    return bytes(lines[:size])
+
+
+async def _run_sessions(count, size, frame, port):
+    """
+    connects `count` devices to one server, each sending `size` bytes, and
+    returns the seconds taken until every session's screen has drawn it all
+    """
+    server = net.Server(None, host="127.0.0.1", port=port)
+    await server
+
+    output = _sample_output(size)
+    frames = [
+        b'\x00' + output[start:start + frame]
+        for start in range(0, size, frame)
+    ]
+
+    async def device(number):
+        uri = "ws://127.0.0.1:{}/ws/bench-{}".format(port, number)
+        async with websockets.connect(uri) as websocket:
+            for message in frames:
+                await websocket.send(message)
+            # stay connected until our session has caught up
+            dev_session = server.hub.sessions["bench-{}".format(number)]
+            while dev_session.bytes_fed < size:
+                await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(device(number) for number in range(count)))
+    elapsed = time.perf_counter() - start
+
+    feed_times = [s["feed_time"] for s in server.hub.stats().values()]
+
+    server.close()
+    await server.wait_closed()
+
+    return elapsed, min(feed_times), max(feed_times)
+
+
+def sessions(args):
+    """ reports throughput as the number of concurrent sessions grows """
+    print("{:>8} {:>10} {:>12} {:>14} {:>14}".format(
+        "sessions", "seconds", "total MB/s", "session KB/s", "feed min/max"
+    ))
+
+    for count in args.counts:
+        elapsed, fastest, slowest = asyncio.run(
+            _run_sessions(count, args.bytes, args.frame, args.port)
+        )
+        total = count * args.bytes
+        print("{:>8} {:>10.3f} {:>12.2f} {:>14.1f} {:>6.3f}/{:<6.3f}".format(
+            count,
+            elapsed,
+            total / elapsed / 1e6,
+            args.bytes / elapsed / 1e3,
+            fastest,
+            slowest
+        ))
+
+
+async def _echo(end):
+    """ sends everything read from `end` straight back """
+    async with end.open() as (reader, writer):
+        while not reader.at_eof():
+            writer.write(await reader.read(64 * 1024))
+            await writer.drain()
+
+
+def _echo_proc(end):
+    asyncio.run(_echo(end))
+
+
+async def _run_transport(mode, rounds, size, chunk):
+    """
+    measures round trips of one byte, then the time to stream `size` bytes
+    through an echo on the far end of a `mode` transport
+    """
+    near, far = transport.duplex(mode)
+
+    proc = None
+    if transport.in_process(mode):
+        asyncio.ensure_future(_echo(far))
+    else:
+        with far.detach() as far:
+            proc = multiprocessing.Process(target=_echo_proc, args=(far,))
+            proc.start()
+
+    async with near.open() as (reader, writer):
+        latencies = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            writer.write(b'x')
+            await writer.drain()
+            await reader.read(1)
+            latencies.append(time.perf_counter() - start)
+
+        payload = bytes(chunk)
+        total = size // chunk * chunk
+
+        async def pump():
+            for _ in range(size // chunk):
+                writer.write(payload)
+                await writer.drain()
+
+        start = time.perf_counter()
+        pumping = asyncio.ensure_future(pump())
+        received = 0
+        while received < total:
+            received += len(await reader.read(64 * 1024))
+        await pumping
+        elapsed = time.perf_counter() - start
+
+    if proc is not None:
+        proc.join(5)
+        proc.terminate()
+
+    latencies.sort()
+    return (
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99)],
+        total / elapsed,
+    )
+
+
+def transports(args):
+    """ compares latency and throughput of each terminal transport """
+    print("{:>8} {:>12} {:>12} {:>12}".format(
+        "mode", "p50 rtt us", "p99 rtt us", "MB/s"
+    ))
+
+    for mode in args.modes:
+        median, p99, rate = asyncio.run(
+            _run_transport(mode, args.rounds, args.bytes, args.chunk)
+        )
+        print("{:>8} {:>12.1f} {:>12.1f} {:>12.2f}".format(
+            mode, median * 1e6, p99 * 1e6, rate / 1e6
+        ))
+
+
+class _ReportingWriter:
+    """ a stand-in for the pipe to the network, passing input to an fd """
+    def __init__(self, fileno):
+        self.fileno = fileno
+
+    def write(self, data):
+        os.write(self.fileno, data)
+
+    async def drain(self):
+        pass
+
+
+def _input_proc(mode, fps, report):
+    """
+    runs in a pty, reading keys with a real Terminal, and writes each lot
+    it sends to the `report` fd. `mode` is "add_reader" for
+    Terminal.input_loop, or "polling" for how it used to read input
+    """
+    # a new pty has no size, and curses can't open a screen that small
+    fcntl.ioctl(
+        sys.stdin.fileno(), termios.TIOCSWINSZ,
+        struct.pack("HHHH", 24, 80, 0, 0)
+    )
+    os.environ.setdefault("TERM", "xterm")
+
+    # imported here, since asciimatics is slow to load and the other
+    # benchmarks never need it
+    from . import term
+
+    async def run():
+        terminal = term.Terminal(None, fps=fps)
+        # as if a device had connected, so keys are sent
+        terminal.status.set(2)
+        writer = _ReportingWriter(report)
+        if mode == "add_reader":
+            await terminal.input_loop(writer)
+        else:
+            while True:
+                await terminal.send_input(writer)
+                await asyncio.sleep(1000 / fps / 1000)
+
+    asyncio.run(run())
+
+
+async def _run_input(mode, rounds, fps):
+    """
+    types `rounds` keys into a Terminal running in a pty, reading them as
+    `mode` says, and times how long each takes to be sent on
+    returns a list of latencies
+    """
+    loop = asyncio.get_running_loop()
+    report, report_end = os.pipe()
+    pid, keyboard = pty.fork()
+    if pid == 0:
+        os.close(report)
+        try:
+            _input_proc(mode, fps, report_end)
+        finally:
+            os._exit(0)
+    os.close(report_end)
+    os.set_blocking(report, False)
+
+    def discard():
+        # what curses draws has to be read, or the pty fills up
+        try:
+            os.read(keyboard, 65536)
+        except OSError:
+            loop.remove_reader(keyboard)
+    loop.add_reader(keyboard, discard)
+
+    reported = asyncio.Event()
+    loop.add_reader(report, reported.set)
+
+    async def key():
+        start = time.perf_counter()
+        os.write(keyboard, b'x')
+        while True:
+            await reported.wait()
+            reported.clear()
+            try:
+                os.read(report, 4096)
+            except BlockingIOError:
+                # woken for a report that was already read
+                continue
+            return time.perf_counter() - start
+
+    try:
+        # the terminal takes a while to start, so wait until it's sending
+        while True:
+            try:
+                await asyncio.wait_for(key(), 0.5)
+                break
+            except asyncio.TimeoutError:
+                continue
+        await asyncio.sleep(0.1)
+        reported.clear()
+        while True:
+            try:
+                os.read(report, 4096)
+            except BlockingIOError:
+                break
+
+        latencies = []
+        for number in range(rounds):
+            # keys arrive at different points between polls
+            await asyncio.sleep(1 / fps * (number % 7) / 7)
+            latencies.append(await key())
+        return latencies
+    finally:
+        loop.remove_reader(keyboard)
+        loop.remove_reader(report)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(keyboard)
+        os.close(report)
+
+
+def keyboard_input(args):
+    """
+    compares keystroke latency through Terminal's input path, event driven
+    against polling as it used to
+    """
+    woken = asyncio.run(_run_input("add_reader", args.rounds, args.fps))
+    polled = asyncio.run(
+        _run_input("polling", min(args.rounds, args.fps * 2), args.fps)
+    )
+
+    print("{:>10} {:>12} {:>12}".format("input", "p50 us", "p99 us"))
+    for name, latencies in (("add_reader", woken), ("polling", polled)):
+        latencies.sort()
+        print("{:>10} {:>12.1f} {:>12.1f}".format(
+            name,
+            statistics.median(latencies) * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6
+        ))
+
+
+class _PtyDevice:
+    """
+    a pty pair standing in for a serial device: the client opens the slave
+    by name, as it would a real port, and the benchmark is the device
+    """
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        # like a uart, pass every byte through untouched
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+
+        # whether typed bytes are echoed back, as a REPL would
+        self.echo = True
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.master, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            # the client closed the port
+            self.loop.remove_reader(self.master)
+            return
+        if self.echo:
+            self.loop.create_task(self.write(data))
+
+    async def write(self, data):
+        """ writes `data` to the client, waiting while the pty is full """
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.master, view):]
+            except BlockingIOError:
+                pass
+            if view:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.master, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.master)
+
+    async def stream(self, data, baudrate, chunk=256):
+        """
+        writes `data` no faster than a uart at `baudrate` would send it, or
+        as fast as the client reads it if `baudrate` is 0
+        """
+        start = time.perf_counter()
+        for offset in range(0, len(data), chunk):
+            piece = data[offset:offset + chunk]
+            if baudrate:
+                # a uart takes 10 bits per byte, with start and stop bits,
+                # and a piece is only all there once its last byte is
+                done = offset + len(piece)
+                delay = start + done * 10 / baudrate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.write(piece)
+
+    def close(self):
+        self.loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+async def _serve_term(end, port):
+    server = await net.Server(end, host="127.0.0.1", port=port)
+    await server.wait_closed()
+
+
+def _traced(role, prefix):
+    """
+    turns tracing on for a benchmark process, if there's a `prefix` to dump
+    the trace to, which happens when the benchmark terminates it
+    """
+    if prefix is not None:
+        trace.enable(role)
+        trace.exit_on_sigterm()
+
+
+def _server_proc(end, port, trace_prefix=None):
+    _traced("server", trace_prefix)
+    try:
+        asyncio.run(_serve_term(end, port))
+    finally:
+        trace.dump(trace_prefix)
+
+
+def _client_proc(profile, trace_prefix=None):
+    # imported here, since only this benchmark needs the client package
+    from serialshare import client
+    from serialshare import data
+
+    # the client's messages would drown out ours
+    sys.stdout = open(os.devnull, "w")
+    # don't touch the loop inherited from the benchmark's process
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    _traced("client", trace_prefix)
+    try:
+        client.run(dict(data.DEFAULT_PROFILE, **profile))
+    finally:
+        trace.dump(trace_prefix)
+
+
+async def _wait_for_port(port, timeout=10):
+    """ waits until something is listening on `port` """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+def _cpu_seconds(pid):
+    """
+    returns the cpu seconds, user and system, that process `pid` has used,
+    or None without a linux /proc to read it from
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            # the process name may contain spaces, so split after it
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15, counting from the pid as 1
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def _run_e2e(baudrate, rounds, size, port, compression,
+                   trace_prefix=None):
+    """
+    links a pty device through a client process and a server process to a
+    stand-in terminal, then times `rounds` keystrokes echoed by the device,
+    and `size` bytes of device output streamed at `baudrate`, with the
+    client asking for `compression`
+    with `trace_prefix`, every process traces the device output, and
+    dumps its trace to a file starting with it
+    returns a dict of results
+    """
+    device = _PtyDevice()
+    _traced("terminal", trace_prefix)
+
+    net_end, term_end = transport.duplex(transport.PIPE)
+    with net_end.detach() as net_end:
+        server = multiprocessing.Process(
+            target=_server_proc, args=(net_end, port, trace_prefix)
+        )
+        server.start()
+    await _wait_for_port(port)
+
+    client = multiprocessing.Process(target=_client_proc, args=({
+        "device": device.path,
+        # a pty has no line rate, but the client sizes buffers by it
+        "baudrate": baudrate or 921600,
+        "hostname": "127.0.0.1:{}".format(port),
+        "compression": compression,
+        "attach": [],
+    }, trace_prefix))
+    client.start()
+
+    async with term_end.open() as (reader, writer):
+        # the server signals a connected device with a 0x01
+        offset = len(await reader.readuntil(b'\x01'))
+
+        async def keystroke():
+            nonlocal offset
+            start = time.perf_counter()
+            writer.write(b'x')
+            await writer.drain()
+            await reader.readexactly(1)
+            trace.mark("receive_bytes", "pipe", offset, 1)
+            offset += 1
+            return time.perf_counter() - start
+
+        # the first key also waits for the client to open the port
+        await keystroke()
+        latencies = sorted([await keystroke() for _ in range(rounds)])
+
+        device.echo = False
+        output = _sample_output(size)
+        procs = (client, server)
+        cpu_before = [_cpu_seconds(proc.pid) for proc in procs]
+
+        start = time.perf_counter()
+        streaming = asyncio.ensure_future(device.stream(output, baudrate))
+        received = 0
+        while received < size:
+            data = await reader.read(64 * 1024)
+            trace.mark("receive_bytes", "pipe", offset, len(data))
+            offset += len(data)
+            received += len(data)
+        elapsed = time.perf_counter() - start
+        await streaming
+
+        cpu_after = [_cpu_seconds(proc.pid) for proc in procs]
+
+    for proc in procs:
+        proc.terminate()
+        proc.join()
+        # release the process's fds now, before the pipe's ends are
+        # collected, since they close their fds again and could hit these
+        proc.close()
+    device.close()
+    trace.dump(trace_prefix)
+
+    cpu_per_mb = {}
+    names = ("client", "server")
+    for name, before, after in zip(names, cpu_before, cpu_after):
+        cpu_per_mb[name] = None
+        if before is not None and after is not None:
+            cpu_per_mb[name] = (after - before) / (size / 1e6)
+
+    return {
+        "baudrate": baudrate,
+        "rtt_p50_ms": statistics.median(latencies) * 1e3,
+        "rtt_p99_ms": latencies[int(len(latencies) * 0.99)] * 1e3,
+        "bytes": size,
+        "bytes_per_s": size / elapsed,
+        # the share of the line rate that made it to the terminal
+        "line_rate": size / elapsed / (baudrate / 10) if baudrate else None,
+        "cpu_s_per_mb": cpu_per_mb,
+    }
+
+
+def end_to_end(args):
+    """
+    measures the whole device to terminal path, over a pty, the client, the
+    server and the terminal pipe, at each baud rate
+    """
+    results = []
+    # the merged trace and stage latencies for each baud rate, if tracing
+    traces = []
+    for baudrate in args.baudrates:
+        size = args.bytes
+        if baudrate:
+            size = min(size, int(baudrate / 10 * args.seconds))
+
+        prefix = None
+        if args.trace is not None:
+            prefix = "{}-{}".format(args.trace, baudrate or "max")
+        results.append(asyncio.run(
+            _run_e2e(
+                baudrate, args.rounds, size, args.port, args.compression,
+                prefix
+            )
+        ))
+
+        if prefix is not None:
+            merged, stages = trace.merge([
+                trace.trace_path(prefix, role)
+                for role in ("client", "server", "terminal")
+            ])
+            with open(prefix + ".json", "w") as output:
+                json.dump(merged, output)
+            results[-1]["trace"] = prefix + ".json"
+            traces.append((baudrate, prefix + ".json", stages))
+
+    report = json.dumps({"benchmark": "e2e", "results": results}, indent=1)
+    if args.json == "-":
+        print(report)
+        return
+    if args.json is not None:
+        with open(args.json, "w") as output:
+            output.write(report + "\n")
+
+    def cpu(value):
+        return "-" if value is None else "{:.3f}".format(value)
+
+    print("{:>8} {:>11} {:>11} {:>10} {:>6} {:>12} {:>12}".format(
+        "baud", "p50 rtt ms", "p99 rtt ms", "KB/s", "line", "client s/MB",
+        "server s/MB"
+    ))
+    for result in results:
+        line_rate = result["line_rate"]
+        print("{:>8} {:>11.2f} {:>11.2f} {:>10.1f} {:>6} {:>12} {:>12}".format(
+            result["baudrate"] or "max",
+            result["rtt_p50_ms"],
+            result["rtt_p99_ms"],
+            result["bytes_per_s"] / 1e3,
+            "-" if line_rate is None else "{:.0%}".format(line_rate),
+            cpu(result["cpu_s_per_mb"]["client"]),
+            cpu(result["cpu_s_per_mb"]["server"]),
+        ))
+
+    for baudrate, path, stages in traces:
+        print("\nstages at {} baud, traced to {}".format(
+            baudrate or "max", path
+        ))
+        trace.report(stages)
+
+
+def _read_index(directory):
+    """ returns a process_request reading index.html on every request """
+    async def process_request(path, headers):
+        del headers
+        if path != "/":
+            return None
+        with open(os.path.join(directory, static.INDEX), "rb") as index:
+            return http.HTTPStatus.OK, [
+                ("Content-Type", "text/html")
+            ], index.read()
+    return process_request
+
+
+async def _run_static(mode, directory, seconds, concurrency, port):
+    """
+    requests / from a server answering with `mode` for `seconds`, from
+    `concurrency` clients at once, and returns (requests, bytes received)
+    """
+    if mode == "uncached":
+        process_request = _read_index(directory)
+    else:
+        assets = static.Assets(directory)
+
+        async def process_request(path, headers):
+            return assets.respond(path, headers)
+
+    request = "GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+    if mode == "gzip":
+        request += "Accept-Encoding: gzip\r\n"
+    elif mode == "304":
+        etag = assets.respond("/", {})[1][0][1]
+        request += "If-None-Match: {}\r\n".format(etag)
+    request = (request + "\r\n").encode("ascii")
+
+    ws_server = await websockets.serve(
+        None, "127.0.0.1", port, process_request=process_request
+    )
+
+    counts = [0, 0]
+    deadline = time.perf_counter() + seconds
+
+    async def client():
+        while time.perf_counter() < deadline:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            # the server closes the connection after each response
+            response = await reader.read()
+            counts[0] += 1
+            counts[1] += len(response)
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    ws_server.close()
+    await ws_server.wait_closed()
+    return counts
+
+
+def static_assets(args):
+    """
+    compares requests/s for the web page read from disk on every request,
+    against the cache, gzipped, and revalidated with If-None-Match
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        page = b"<!doctype html>\n<title>serialshare</title>\n<script>\n"
+        while len(page) < args.bytes:
+            page += b"  term.write(line(%d));\n" % len(page)
+        with open(os.path.join(directory, static.INDEX), "wb") as index:
+            index.write(page[:args.bytes])
+
+        print("{:>10} {:>12} {:>14}".format(
+            "mode", "requests/s", "KB/response"
+        ))
+        for mode in args.modes:
+            requests, received = asyncio.run(_run_static(
+                mode, directory, args.seconds, args.concurrency, args.port
+            ))
+            print("{:>10} {:>12.0f} {:>14.2f}".format(
+                mode, requests / args.seconds, received / requests / 1e3
+            ))
+
+
+def main():
+    """ parses arguments and runs the chosen benchmark """
+    parser = argparse.ArgumentParser(prog="python -m serialshare_server.bench")
+    benchmarks = parser.add_subparsers(dest="benchmark")
+    benchmarks.required = True
+
+    parser_sessions = benchmarks.add_parser(
+        "sessions", help="throughput as sessions scale from 1 to 100"
+    )
+    parser_sessions.add_argument(
+        "--counts", type=int, nargs="+", default=[1, 2, 5, 10, 20, 50, 100],
+        help="numbers of concurrent sessions to try"
+    )
+    parser_sessions.add_argument(
+        "--bytes", type=int, default=32 * 1024,
+        help="bytes each device sends"
+    )
+    parser_sessions.add_argument(
+        "--frame", type=int, default=1024,
+        help="bytes per websocket frame"
+    )
+    parser_sessions.add_argument("--port", type=int, default=8765)
+    parser_sessions.set_defaults(func=sessions)
+
+    parser_transports = benchmarks.add_parser(
+        "transports", help="latency and throughput of terminal transports"
+    )
+    parser_transports.add_argument(
+        "--modes", nargs="+", choices=transport.MODES,
+        default=list(transport.MODES)
+    )
+    parser_transports.add_argument(
+        "--rounds", type=int, default=2000,
+        help="one byte round trips to time"
+    )
+    parser_transports.add_argument(
+        "--bytes", type=int, default=64 * 1024 * 1024,
+        help="bytes to stream through the echo"
+    )
+    parser_transports.add_argument(
+        "--chunk", type=int, default=4096,
+        help="bytes per write while streaming"
+    )
+    parser_transports.set_defaults(func=transports)
+
+    parser_input = benchmarks.add_parser(
+        "input", help="keystroke latency through the terminal's input path"
+    )
+    parser_input.add_argument(
+        "--rounds", type=int, default=5000, help="keys to type"
+    )
+    parser_input.add_argument(
+        "--fps", type=int, default=60, help="rate of the polling comparison"
+    )
+    parser_input.set_defaults(func=keyboard_input)
+
+    parser_e2e = benchmarks.add_parser(
+        "e2e", help="device to terminal latency and throughput, over a pty"
+    )
+    parser_e2e.add_argument(
+        "--baudrates", type=int, nargs="+",
+        default=[9600, 115200, 921600, 0],
+        help="line rates to stream device output at, 0 for unlimited"
+    )
+    parser_e2e.add_argument(
+        "--rounds", type=int, default=500, help="keystroke round trips to time"
+    )
+    parser_e2e.add_argument(
+        "--seconds", type=float, default=5,
+        help="how long to stream for at each baud rate"
+    )
+    parser_e2e.add_argument(
+        "--bytes", type=int, default=4 * 1024 * 1024,
+        help="most bytes to stream at each baud rate"
+    )
+    parser_e2e.add_argument(
+        "--json", metavar="FILE",
+        help="also write the results as json to FILE, or only to stdout "
+             "if FILE is -"
+    )
+    parser_e2e.add_argument(
+        "--compression", choices=["zlib", "deflate", "none"], default="none",
+        help="what the client asks the server to compress frames with"
+    )
+    parser_e2e.add_argument(
+        "--trace", metavar="PREFIX",
+        help="trace device output through every stage, writing a merged "
+             "Chrome trace to PREFIX-<baud>.json for each baud rate"
+    )
+    parser_e2e.add_argument("--port", type=int, default=8766)
+    parser_e2e.set_defaults(func=end_to_end)
+
+    parser_static = benchmarks.add_parser(
+        "static", help="requests/s for the web page, with and without caching"
+    )
+    parser_static.add_argument(
+        "--modes", nargs="+", choices=["uncached", "cached", "gzip", "304"],
+        default=["uncached", "cached", "gzip", "304"]
+    )
+    parser_static.add_argument(
+        "--bytes", type=int, default=64 * 1024, help="size of the page"
+    )
+    parser_static.add_argument(
+        "--seconds", type=float, default=3, help="how long to run each mode"
+    )
+    parser_static.add_argument(
+        "--concurrency", type=int, default=20,
+        help="clients requesting at once"
+    )
+    parser_static.add_argument("--port", type=int, default=8767)
+    parser_static.set_defaults(func=static_assets)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
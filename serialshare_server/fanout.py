@@ -0,0 +1,134 @@
+"""
+A module for sharing one session's output with any number of observers
+"""
+
+import asyncio
+import collections
+import itertools
+
+# what to do with a subscriber that falls more than its queue behind
+DROP = "drop"  # lose the oldest frames it hasn't read yet
+SNAPSHOT = "snapshot"  # skip to the newest frame, after a screen snapshot
+DISCONNECT = "disconnect"  # close its connection
+POLICIES = (DROP, SNAPSHOT, DISCONNECT)
+
+# frames kept in the shared buffer, and the most any subscriber may lag
+CAPACITY = 1024
+MAX_QUEUE = 256
+
+
+class Broadcast:
+    """
+    a shared buffer of recent frames
+    each frame is stored once, however many subscribers there are; a
+    subscriber is just a position in the buffer
+    """
+    def __init__(self, capacity=CAPACITY):
+        self.frames = collections.deque(maxlen=capacity)
+        # sequence number of the next frame to be published
+        self.next = 0
+        self.subscribers = set()
+        # resolved, and replaced, whenever a frame is published
+        self._published = asyncio.get_event_loop().create_future()
+
+    @property
+    def first(self):
+        """ sequence number of the oldest frame still in the buffer """
+        return self.next - len(self.frames)
+
+    def publish(self, frame):
+        """ adds `frame` to the buffer and wakes waiting subscribers """
+        self.frames.append(frame)
+        self.next += 1
+
+        self._published.set_result(None)
+        self._published = asyncio.get_event_loop().create_future()
+
+        # the only policy that can't wait for the subscriber to come back
+        # around, since a stalled connection may never come back around
+        for subscriber in list(self.subscribers):
+            if subscriber.policy == DISCONNECT and subscriber.lagging():
+                subscriber.close()
+
+    def subscribe(self, max_queue=MAX_QUEUE, policy=DROP):
+        """ returns a new Subscriber, starting from the newest frame """
+        subscriber = Subscriber(
+            self, min(max_queue, self.frames.maxlen), policy
+        )
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    async def wait(self, position):
+        """ waits until there's a frame at or after `position` """
+        if position >= self.next:
+            await asyncio.shield(self._published)
+
+
+class Subscriber:
+    """
+    one reader of a Broadcast, with a bounded queue of unread frames
+    """
+    def __init__(self, broadcast, max_queue, policy):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy: {}".format(policy))
+        # a subscriber that may not fall behind at all would never be sent
+        # anything
+        if max_queue < 1:
+            raise ValueError("queue must be at least 1")
+
+        self.broadcast = broadcast
+        self.max_queue = max_queue
+        self.policy = policy
+        self.position = broadcast.next
+
+        # set once the subscriber has been cut off
+        self.closed = asyncio.Event()
+
+        # counters
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.snapshots = 0
+
+    def lagging(self):
+        """ returns whether more than max_queue frames are unread """
+        return self.broadcast.next - self.position > self.max_queue
+
+    def close(self):
+        """ stops the subscription """
+        self.broadcast.subscribers.discard(self)
+        self.closed.set()
+
+    async def get(self):
+        """
+        waits for new frames and returns a list of them
+        if the subscriber fell behind and should be sent a snapshot instead,
+        the list is just [None]
+        raises EOFError once the subscriber is closed
+        """
+        if self.closed.is_set():
+            raise EOFError
+        await self.broadcast.wait(self.position)
+        if self.closed.is_set():
+            raise EOFError
+
+        if self.lagging():
+            newest = self.broadcast.next
+            if self.policy == DISCONNECT:
+                self.close()
+                raise EOFError
+
+            if self.policy == SNAPSHOT:
+                self.frames_dropped += newest - self.position
+                self.snapshots += 1
+                self.position = newest
+                return [None]
+
+            skip_to = newest - self.max_queue
+            self.frames_dropped += skip_to - self.position
+            self.position = skip_to
+
+        start = self.position - self.broadcast.first
+        frames = list(itertools.islice(self.broadcast.frames, start, None))
+        self.position = self.broadcast.next
+        self.frames_sent += len(frames)
+        return frames
@@ -2,6 +2,8 @@
 functions for translating keycodes for serial transmission
 """
 
+import sys
+
 try:
     # Windows doesn't have _CursesScreen
     from asciimatics.screen import _WindowsScreen as AsciimaticsScreen
@@ -82,13 +84,30 @@ _key_map[AsciimaticsScreen.KEY_MENU] = b''
 
 _key_map[ord('\n')] = b'\r'
 
+# the bytes for every ASCII code, worked out once, since that's almost
+# everything typed or pasted. codes from 128 on are characters like any
+# other, sent as utf-8 rather than as single latin-1 bytes
+_table = tuple(_key_map.get(code, bytes([code])) for code in range(128))
+
 
 def lookup(code):
     """
     returns the ASCII character for an asciimatics key_code
     if the code isn't in the dict, assume it was untranslated by asciimatics,
-    so doesn't need to be translated back
+    so doesn't need to be translated back: other characters are sent as
+    utf-8, and other special keys not at all
     """
+    if 0 <= code < 128:
+        return _table[code]
     if code in _key_map:
         return _key_map[code]
-    return code.to_bytes(1, 'big', signed=False)
+    if not 0 <= code <= sys.maxunicode:
+        return b''
+    return chr(code).encode('utf-8', 'replace')
+
+
+def translate(codes):
+    """ returns the bytes for a list of asciimatics key_codes, joined """
+    return b''.join([
+        _table[code] if 0 <= code < 128 else lookup(code) for code in codes
+    ])
@@ -3,97 +3,665 @@ A module for handling the network component of serialshare-server
 """
 
 import asyncio
+import concurrent.futures
 import http
-import os
-import sys
+import json
+import logging
+import re
+import urllib.parse
 
 import websockets
 
-_MESSAGE_SERIAL = 0
-_MESSAGE_SYNC = 1
+from serialshare import compress
+from serialshare import metrics
+from serialshare import proto
+from serialshare import trace
 
+from . import fanout
+from . import session
+from . import static
+from . import view
 
-async def process_request(path, headers):
-    """ if the index is requested, display a webpage """
-    del headers  # revolves pylint w0163
+# most bytes of terminal input to send to a device in one frame
+MAX_FRAME = 4096
 
-    if path == "/":
-        dir_path = os.path.dirname(os.path.abspath(sys.argv[0]))
-        index_file = os.path.join(dir_path, 'index.html')
+# most lines one search returns, and seconds it may take before giving up
+MAX_SEARCH_RESULTS = 1000
+SEARCH_TIMEOUT = 5.0
 
-        # prepare for the worst :)
-        status = http.HTTPStatus.INTERNAL_SERVER_ERROR
-        headers = []
-        body = f"500 - couldn't read {index_file}.\n".encode('utf-8')
+_log = logging.getLogger(__name__)
 
-        try:
-            with open(index_file, 'rb') as index:
-                status = http.HTTPStatus.OK
-                headers = [('Content-Type', 'text/html')]
-                body = index.read()
-        except FileNotFoundError:
-            status = http.HTTPStatus.NOT_FOUND
-            body = b"404 - couldn't find index.html"
-        finally:
-            return status, headers, body
+# device websockets connect to /ws, or /ws/<session-id> for other sessions.
+# read-only observers connect to /observe or /observe/<session-id>, and
+# browsers wanting screen diffs rather than raw output to /view[/<id>]
+_SESSION_PATH = re.compile(r"^/(ws|observe|view)(?:/([\w.-]+))?/?$")
+# the endpoints that only read sessions, so may not create them
+_READERS = ("observe", "view")
+
+# a session's screen is served as text at /screen/<session-id>, or as json
+# at /screen/<session-id>.json, with ?history=<n> lines of scrollback.
+# /sessions lists every session
+_SCREEN_PATH = re.compile(r"^/screen(?:/([\w.-]+?))?(\.json|\.txt)?/?$")
+
+# history is searched with /search/<session-id>?q=<regular expression>
+_SEARCH_PATH = re.compile(r"^/search(?:/([\w.-]+))?/?$")
 
-    return None
+# serial data from devices, terminal input sent to them, and devices that
+# came back to carry on a stream
+_BYTES_IN, _FRAMES_IN, _FRAME_SIZES_IN = metrics.traffic("from_device")
+_BYTES_OUT, _FRAMES_OUT, _FRAME_SIZES_OUT = metrics.traffic("to_device")
+_RECONNECTS = metrics.REGISTRY.counter(
+    "serialshare_reconnects_total", "connections made again after dropping"
+)
+
+
+def _log_failure(task):
+    """ logs the exception a background task ended with, if it did """
+    if not task.cancelled() and task.exception() is not None:
+        _log.error(
+            "%s failed", task.get_coro().__qualname__,
+            exc_info=task.exception()
+        )
+
+
+def route(path):
+    """
+    returns the endpoint ("ws", "observe" or "view"), session id and query
+    dict a websocket path refers to, or Nones if it refers to nothing
+    """
+    url = urllib.parse.urlsplit(path)
+    match = _SESSION_PATH.match(url.path)
+    if match is None:
+        return None, None, None
+
+    endpoint, sid = match.groups()
+    query = dict(urllib.parse.parse_qsl(url.query))
+    return endpoint, sid or session.DEFAULT_SESSION, query
 
 
 class Server:
     """
     network handling class
+    hosts any number of device sessions. the default session is also linked
+    to the local terminal through `pipe`, if there is one
     """
-    def __init__(self, pipe, host="0.0.0.0", port=8080):
+    def __init__(self, pipe, host="0.0.0.0", port=8080, hub=None,
+                 max_frame=MAX_FRAME, flush_window=0.0, compression=True,
+                 compress_threshold=compress.THRESHOLD, pusher=None,
+                 static_dir=None):
         self.pipe = pipe
-        self.websocket = None
         self.host = host
         self.port = port
+        self.hub = hub if hub is not None else session.Hub()
+
+        # the writer half of self.pipe, once it's open, and the bytes
+        # written to it so far, which the terminal counts the same way
+        self.to_term = None
+        self.term_offset = 0
+
+        # terminal input is sent in frames of whatever has arrived, up to
+        # max_frame bytes. with a flush window, a frame is held open up to
+        # that many seconds for the rest of a burst
+        self.max_frame = max_frame
+        self.flush_window = flush_window
+
+        # whether devices may ask for zlib or permessage-deflate frames,
+        # and the smallest frame of terminal input compressed for them
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+        # a push.Pusher syncing files to devices, if there are any to sync
+        self.pusher = pusher
+
+        # the web page and its assets. without a directory to serve, only
+        # index.html is served, from next to the script that was run
+        if static_dir is None:
+            self.assets = static.Assets(files=[static.INDEX])
+        else:
+            self.assets = static.Assets(static_dir)
+
+        # history searches run one at a time in a thread of their own, so a
+        # slow pattern holds up other searches but never the event loop
+        self.searches = concurrent.futures.ThreadPoolExecutor(1)
+
+        # counters for frames sent from the terminal
+        self.term_frames = 0
+        self.term_bytes = 0
+
+        # the websockets server, once it's started, and the tasks running
+        # alongside it. asyncio only keeps weak references to tasks, so
+        # these are what stop them being collected while still pending
+        self.ws_server = None
+        self.tasks = []
+
+    def stats(self):
+        """ returns a dict of counters for the terminal link and sessions """
+        return {
+            "term_frames": self.term_frames,
+            "term_bytes": self.term_bytes,
+            "term_avg_frame": self.term_bytes / max(self.term_frames, 1),
+            "sessions": self.hub.stats(),
+            "sync": self.pusher.stats() if self.pusher is not None else {},
+            "static": self.assets.stats(),
+        }
 
     def __await__(self):
-        coro = websockets.serve(
+        return self._serve().__await__()
+
+    def _start(self, coroutine):
+        """ runs `coroutine` in a task until it ends or the server closes """
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(_log_failure)
+        self.tasks.append(task)
+
+    async def _serve(self):
+        """
+        starts the session scheduler, terminal link and websocket server
+        returns the server itself, to close() or wait_closed() on
+        """
+        self._start(self.hub.schedule())
+
+        if self.pipe is not None:
+            self._start(self._term_link())
+
+        if self.pusher is not None:
+            self._start(self.pusher.watch(self.hub))
+
+        self.ws_server = await websockets.serve(
             self.ws_handler,
             host=self.host,
             port=self.port,
-            process_request=process_request
+            process_request=self.process_request,
+            compression="deflate" if self.compression else None,
+            extra_headers=self._extra_headers
         )
-        return coro.__await__()
+        return self
+
+    def close(self):
+        """ stops accepting connections, and closes the ones there are """
+        self.ws_server.close()
+
+    async def wait_closed(self):
+        """
+        waits for the server to close, then cancels its background tasks
+        and waits for those too. the tasks outlive the connections, since
+        a device's handler may be waiting on the scheduler to make room
+        """
+        try:
+            await self.ws_server.wait_closed()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            # without waiting on a search that's still running
+            self.searches.shutdown(wait=False)
+
+    def _extra_headers(self, path, request_headers):
+        """
+        answers with the protocol version to speak, the number of channels
+        it takes, and agrees to zlib compression if it's allowed and asked
+        for
+        """
+        del path  # websockets passes it, but it makes no difference
+        version = proto.negotiate(request_headers)
+        headers = [(proto.HEADER, str(version))]
+        if version >= 2 and proto.CHANNELS_HEADER in request_headers:
+            headers.append((
+                proto.CHANNELS_HEADER, str(proto.channels(request_headers))
+            ))
+        if self.compression and compress.negotiated(request_headers):
+            headers.append((compress.HEADER, compress.ZLIB))
+        return headers
+
+    def _metrics(self):
+        """ returns the metrics, with the session gauges brought up to date """
+        sessions = list(self.hub.sessions.values())
+        metrics.REGISTRY.gauge(
+            "serialshare_sessions", "device sessions, connected or not"
+        ).set(len(sessions))
+        metrics.REGISTRY.gauge(
+            "serialshare_sessions_connected", "sessions with a device"
+        ).set(sum(s.websocket is not None for s in sessions))
+        metrics.REGISTRY.gauge(
+            "serialshare_pending_bytes",
+            "device output waiting to be parsed, over every session"
+        ).set(sum(len(s.pending) for s in sessions))
+        return metrics.REGISTRY.render()
+
+    async def process_request(self, path, headers):
+        """
+        serves session screens, stats and metrics over plain http, and
+        anything else from the static assets
+        """
+        url = urllib.parse.urlsplit(path)
+        if url.path == "/sessions":
+            body = json.dumps(self.stats(), indent=1).encode('utf-8')
+            return http.HTTPStatus.OK, [
+                ('Content-Type', 'application/json'),
+            ], body
+        if url.path == "/metrics":
+            body = self._metrics().encode('utf-8')
+            return http.HTTPStatus.OK, [
+                ('Content-Type', metrics.CONTENT_TYPE),
+            ], body
+
+        endpoint, sid, _ = route(path)
+        if endpoint in _READERS and self._existing(sid) is None:
+            return http.HTTPStatus.NOT_FOUND, [], b"404 - no such session\n"
+
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        match = _SEARCH_PATH.match(url.path)
+        if match is not None:
+            return await self._search(match.group(1), query)
+
+        match = _SCREEN_PATH.match(url.path)
+        if match is None:
+            return self.assets.respond(path, headers)
+
+        sid, kind = match.groups()
+        dev_session = self.hub.sessions.get(sid or session.DEFAULT_SESSION)
+        if dev_session is None:
+            return http.HTTPStatus.NOT_FOUND, [], b"404 - no such session\n"
+
+        # ?history=<n> sets how many lines of scrollback come with the screen
+        try:
+            history = int(query.get("history", session.HISTORY))
+        except ValueError:
+            return http.HTTPStatus.BAD_REQUEST, [], b"400 - bad history\n"
+
+        if kind == ".json":
+            content_type = 'application/json'
+            body = json.dumps(dev_session.to_dict(history)).encode('utf-8')
+        else:
+            content_type = 'text/plain; charset=utf-8'
+            body = dev_session.text(history).encode('utf-8')
+
+        return http.HTTPStatus.OK, [('Content-Type', content_type)], body
+
+    def _existing(self, sid):
+        """
+        returns the session `sid` for a reader, or None. only devices make
+        sessions, except for the default one, which the terminal shows
+        whether or not a device has connected yet
+        """
+        if sid == session.DEFAULT_SESSION:
+            return self.hub.session(sid)
+        return self.hub.sessions.get(sid)
+
+    async def _search(self, sid, query):
+        """ returns an http response listing history lines matching ?q= """
+        dev_session = self.hub.sessions.get(sid or session.DEFAULT_SESSION)
+        if dev_session is None:
+            return http.HTTPStatus.NOT_FOUND, [], b"404 - no such session\n"
+
+        try:
+            limit = int(query.get("limit", 100))
+            if limit < 1:
+                raise ValueError("limit must be positive")
+            matches = await asyncio.wait_for(
+                dev_session.search(
+                    query.get("q", ""),
+                    min(limit, MAX_SEARCH_RESULTS),
+                    executor=self.searches
+                ),
+                SEARCH_TIMEOUT
+            )
+        except (re.error, ValueError) as error:
+            body = "400 - {}\n".format(error).encode('utf-8')
+            return http.HTTPStatus.BAD_REQUEST, [], body
+        except asyncio.TimeoutError:
+            # the search carries on in its thread, but nobody's waiting
+            return http.HTTPStatus.SERVICE_UNAVAILABLE, [], (
+                b"503 - search timed out\n"
+            )
+
+        body = json.dumps([
+            {"line": number, "text": text} for number, text in matches
+        ]).encode('utf-8')
+        return http.HTTPStatus.OK, [('Content-Type', 'application/json')], body
+
+    async def _term_link(self):
+        """ keeps the pipe to the local terminal open for the server's life """
+        async with self.pipe.open() as (from_term, to_term):
+            self.to_term = to_term
+            try:
+                await self._from_term_handler(from_term)
+            finally:
+                self.to_term = None
 
     async def ws_handler(self, websocket, path):
         """
         process incoming data
         """
-        del path  # revolves pylint w0163
+        endpoint, sid, query = route(path)
+        if endpoint is None:
+            await websocket.close(1008, "unknown path")
+            return
 
-        if self.websocket is not None:
-            websocket.close()
+        if endpoint in _READERS:
+            dev_session = self._existing(sid)
+            if dev_session is None:
+                await websocket.close(1008, "no such session")
+            elif endpoint == "observe":
+                await self._observe(websocket, dev_session, query)
+            else:
+                await self._view(websocket, dev_session, query)
             return
 
-        self.websocket = websocket
+        try:
+            dev_session = self.hub.session(sid)
+        except OverflowError as error:
+            await websocket.close(1013, str(error))
+            return
 
+        # a device may carry several serial ports over its connection, each
+        # in a session of its own: <id> for channel 0, <id>.1 for channel 1
+        # and so on
+        framer = proto.Framer(proto.negotiate(websocket.request_headers))
+        count = 1
+        if framer.version >= 2:
+            count = proto.channels(websocket.request_headers)
         try:
-            async with self.pipe.open() as (from_term, to_term):
+            dev_sessions = [dev_session] + [
+                self.hub.session("{}.{}".format(sid, channel))
+                for channel in range(1, count)
+            ]
+        except OverflowError as error:
+            await websocket.close(1013, str(error))
+            return
+
+        # a device reconnecting may beat the server to noticing its old
+        # connection is dead, so a connection for the same stream replaces
+        # the old one
+        stream = websocket.request_headers.get(proto.STREAM_HEADER)
+        streams = [
+            proto.channel_stream(stream, channel) for channel in range(count)
+        ]
+        reconnecting = [
+            name is not None and name == dev_session.stream_id
+            for name, dev_session in zip(streams, dev_sessions)
+        ]
+        if any(reconnecting):
+            _RECONNECTS.inc()
+        for dev_session, replacing in zip(dev_sessions, reconnecting):
+            if dev_session.websocket is not None and replacing:
+                dev_session.websocket.transport.abort()
+                await dev_session.free.wait()
+
+        # only one device per session
+        if any(other.websocket is not None for other in dev_sessions):
+            await websocket.close(1008, "session already connected")
+            return
+
+        # each connection starts a fresh protocol state and zlib streams
+        if self.compression and compress.negotiated(websocket.request_headers):
+            framer.compressor = compress.Compressor(self.compress_threshold)
+            framer.decompressor = compress.Decompressor()
+
+        for channel, dev_session in enumerate(dev_sessions):
+            dev_session.websocket = websocket
+            dev_session.framer = framer
+            dev_session.channel = channel
+            dev_session.free.clear()
+            if not reconnecting[channel]:
+                # anything else is a new stream, counted from the start
+                dev_session.stream_id = streams[channel]
+                dev_session.stream_offset = 0
+        pinger = asyncio.ensure_future(proto.ping_loop(websocket, framer))
+        # channels of a shared connection wait for acks before sending more
+        granters = []
+        if count > 1:
+            granters = [
+                asyncio.ensure_future(self._grant(websocket, dev_session))
+                for dev_session in dev_sessions
+            ]
+
+        try:
+            # tell the device where to carry on each stream from
+            if framer.version >= 2:
+                for channel, dev_session in enumerate(dev_sessions):
+                    await websocket.send(
+                        framer.ack(dev_session.stream_offset, channel)
+                    )
+
+            if sid == session.DEFAULT_SESSION and self.to_term is not None:
                 # send some garbage data ending in 0x01 to signal a connection
-                to_term.write(b'\x00\x01')
-                await to_term.drain()
+                self.to_term.write(b'\x00\x01')
+                self.term_offset += 2
+                await self.to_term.drain()
 
-                await asyncio.gather(
-                    self._from_term_handler(from_term),
-                    self._to_term_handler(to_term)
-                )
+            await self._to_term_handler(websocket, framer, dev_sessions)
         except websockets.exceptions.ConnectionClosedError:
             return
+        except OSError as error:
+            # the terminal's pipe broke (ConnectionResetError,
+            # BrokenPipeError and the like), so there's nowhere left to
+            # show the output
+            _log.warning("lost the terminal: %s", error)
+            self.to_term = None
+            await websocket.close(1011, "terminal closed")
+        finally:
+            pinger.cancel()
+            for granter in granters:
+                granter.cancel()
+            for dev_session in dev_sessions:
+                dev_session.websocket = None
+                dev_session.free.set()
+
+    async def _grant(self, websocket, dev_session):
+        """
+        acks a channel's stream as its session takes the data off the
+        buffer, so the device can send more
+        """
+        framer = dev_session.framer
+        granted = dev_session.stream_offset
+        try:
+            while True:
+                await dev_session.wait_changed(dev_session.revision)
+                taken = dev_session.stream_offset - len(dev_session.pending)
+                # a quarter of a window at a time keeps the acks few
+                if taken - granted >= proto.WINDOW // 4:
+                    granted = taken
+                    await websocket.send(
+                        framer.ack(taken, dev_session.channel)
+                    )
+        except websockets.exceptions.ConnectionClosed:
+            return
+
+    async def _observe(self, websocket, dev_session, query):
+        """
+        sends a session's device output to a read-only observer
+        the query string may set "policy" (see fanout.POLICIES) and "queue",
+        the number of frames the observer may fall behind by
+        """
+        try:
+            subscriber = dev_session.broadcast.subscribe(
+                max_queue=int(query.get("queue", fanout.MAX_QUEUE)),
+                policy=query.get("policy", fanout.DROP)
+            )
+        except ValueError as error:
+            await websocket.close(1008, str(error))
+            return
+
+        # start from a full picture of the screen, taken as the
+        # subscription starts so no frame is both in it and sent after it
+        first = b'\x00' + dev_session.snapshot()
+
+        async def send_frames():
+            try:
+                await websocket.send(first)
+                while True:
+                    for frame in await subscriber.get():
+                        if frame is None:
+                            frame = b'\x00' + dev_session.snapshot()
+                        await websocket.send(frame)
+            except (EOFError, websockets.exceptions.ConnectionClosed):
+                return
+
+        async def ignore_input():
+            # observers are read-only, but their messages still need reading
+            try:
+                async for _ in websocket:
+                    pass
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+        tasks = [
+            asyncio.ensure_future(send_frames()),
+            asyncio.ensure_future(ignore_input()),
+            asyncio.ensure_future(subscriber.closed.wait()),
+        ]
+        try:
+            # a stalled observer can sit in send() forever, so also stop
+            # when the broadcast cuts it off
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            subscriber.close()
+
+        if websocket.open:
+            await websocket.close(1008, "observer fell too far behind")
+
+    async def _view(self, websocket, dev_session, query):
+        """
+        sends a session's screen to a viewer, as a snapshot then diffs
+        the query string may set "fps", the most diffs to send a second
+        """
+        try:
+            viewer = view.Viewer(
+                dev_session, fps=float(query.get("fps", view.FPS))
+            )
+        except ValueError as error:
+            await websocket.close(1008, str(error))
+            return
+
+        async def send_diffs():
+            try:
+                await viewer.run(websocket)
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+        async def ignore_input():
+            # viewers are read-only, but their messages still need reading
+            try:
+                async for _ in websocket:
+                    pass
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+        tasks = [
+            asyncio.ensure_future(send_diffs()),
+            asyncio.ensure_future(ignore_input()),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def _from_term_handler(self, reader):
+        """ forwards local keyboard input to the default session's device """
+        default = self.hub.session(session.DEFAULT_SESSION)
+
         while not reader.at_eof():
-            await self.websocket.send(b'\x00' + await reader.read(16))
-
-    async def _to_term_handler(self, writer):
-        async for message in self.websocket:
-            mtype = message[0]
-            if mtype == _MESSAGE_SERIAL:
-                writer.write(message[1:])
-                await writer.drain()
-            elif mtype == _MESSAGE_SYNC:
-                # TODO: implement file sync
+            # whatever has arrived, without waiting for more
+            data = await reader.read(self.max_frame)
+            if self.flush_window:
+                data += await self._read_burst(
+                    reader, self.max_frame - len(data)
+                )
+
+            if default.websocket is None or not data:
+                continue
+
+            try:
+                await default.websocket.send(
+                    default.framer.pack(proto.SERIAL, data, default.channel)
+                )
+                self.term_frames += 1
+                self.term_bytes += len(data)
+                _FRAMES_OUT.inc()
+                _BYTES_OUT.inc(len(data))
+                _FRAME_SIZES_OUT.observe(len(data))
+            except websockets.exceptions.ConnectionClosed:
+                # input typed as the device drops is lost, as it would be
+                # with nothing connected at all
                 pass
+
+    async def _read_burst(self, reader, limit):
+        """
+        returns up to `limit` more bytes from `reader`, read within
+        self.flush_window seconds
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_window
+        data = bytearray()
+
+        while len(data) < limit and not reader.at_eof():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                data += await asyncio.wait_for(
+                    reader.read(limit - len(data)), remaining
+                )
+            except asyncio.TimeoutError:
+                break
+
+        return data
+
+    async def _to_term_handler(self, websocket, framer, dev_sessions):
+        """
+        queues each channel's device output for its session's screen (and
+        the terminal, for the default session)
+        """
+        async for message in websocket:
+            try:
+                frame = framer.unpack(message)
+            except proto.FrameError as error:
+                # one bad frame shouldn't cost the device its session
+                _log.warning("skipped a frame: %s", error)
+                continue
+            if frame.mtype == proto.PING:
+                await websocket.send(framer.pong(frame))
+                continue
+            if frame.channel >= len(dev_sessions):
+                continue
+            dev_session = dev_sessions[frame.channel]
+
+            if frame.mtype == proto.SERIAL:
+                start = dev_session.stream_offset
+                default = dev_session.session_id == session.DEFAULT_SESSION
+                if default:
+                    trace.mark(
+                        "ws_receive", "stream", start, len(frame.payload)
+                    )
+                _FRAMES_IN.inc()
+                _BYTES_IN.inc(len(frame.payload))
+                _FRAME_SIZES_IN.observe(len(frame.payload))
+
+                if default and self.to_term is not None:
+                    trace.mark(
+                        "pipe_write", "stream", start, len(frame.payload)
+                    )
+                    trace.mark(
+                        "pipe_write", "pipe", self.term_offset,
+                        len(frame.payload)
+                    )
+                    self.to_term.write(frame.payload)
+                    self.term_offset += len(frame.payload)
+                    await self.to_term.drain()
+                await self.hub.put(dev_session, frame.payload)
+                # counted once it's in the buffer, so _grant never acks
+                # bytes still waiting in put() for room
+                dev_session.stream_offset += len(frame.payload)
+                # published once it's queued, so an observer's snapshot
+                # holds every frame it wasn't sent. observers speak version
+                # 1, so all of them can be sent this very object
+                dev_session.broadcast.publish(
+                    bytes([proto.SERIAL]) + frame.payload
+                )
+            elif frame.mtype == proto.SYNC and self.pusher is not None:
+                await self.pusher.receive(dev_session, frame.payload)
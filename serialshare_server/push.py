@@ -0,0 +1,200 @@
+"""
+A module for syncing local files onto connected devices as they change
+
+the exchange itself is described in serialshare/sync.py
+"""
+
+import asyncio
+import os
+
+import websockets
+
+from serialshare import proto
+from serialshare import sync
+
+# seconds between checks for changed files
+POLL_INTERVAL = 1.0
+
+# most bytes of instructions in one DELTA frame
+MAX_DELTA = 4096
+
+
+def parse_spec(spec):
+    """
+    returns (local path, path on the device) for a --sync argument of the
+    form PATH[:DEST], where DEST defaults to PATH's name at the root
+    """
+    path, _, dest = spec.partition(":")
+    return path, dest or "/" + os.path.basename(path)
+
+
+class Pusher:
+    """
+    watches local files, and syncs each one to every connected device when
+    it changes, one file per device at a time
+    `files` is a list of (local path, path on the device) pairs
+    """
+    def __init__(self, files, block_size=sync.BLOCK_SIZE,
+                 interval=POLL_INTERVAL):
+        self.files = files
+        self.block_size = block_size
+        self.interval = interval
+
+        # each local file's mtime when last read, its OFFER and its contents
+        self.seen = {}
+        # per session id: {dest: digest} of what its device has, the
+        # (dest, digest, websocket) of the sync in progress, and the last
+        # DONE for each dest
+        self.synced = {}
+        self.active = {}
+        self.results = {}
+        # the tasks sending DELTAs, kept so they aren't collected midway
+        self.sending = set()
+
+    def _load(self, path, dest):
+        """ returns the current OFFER for `path`, or None if it's missing """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        cached = self.seen.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as local:
+                data = local.read()
+            offer = sync.describe(data, self.block_size)
+            offer["dest"] = dest
+            cached = self.seen[path] = (mtime, offer, data)
+        return cached[1]
+
+    async def _send(self, dev_session, payload):
+        websocket = dev_session.websocket
+        if websocket is None:
+            raise websockets.exceptions.ConnectionClosed(1006, "gone")
+        await websocket.send(dev_session.framer.pack(
+            proto.SYNC, payload, dev_session.channel
+        ))
+
+    async def watch(self, hub):
+        """ offers changed files to every connected device, forever """
+        while True:
+            offers = [self._load(path, dest) for path, dest in self.files]
+
+            for dev_session in list(hub.sessions.values()):
+                if dev_session.websocket is None:
+                    continue
+                try:
+                    await self._offer(dev_session, offers)
+                except websockets.exceptions.ConnectionClosed:
+                    # offered again when the device is back
+                    pass
+
+            await asyncio.sleep(self.interval)
+
+    async def _offer(self, dev_session, offers):
+        """ offers `dev_session`'s device the next file it's missing """
+        sid = dev_session.session_id
+        synced = self.synced.setdefault(sid, {})
+
+        active = self.active.get(sid)
+        if active is not None:
+            dest, digest, websocket = active
+            current = [
+                offer for offer in offers
+                if offer is not None and offer["digest"] == digest
+            ]
+            if current:
+                if websocket is not dev_session.websocket:
+                    # offered again after a reconnect, the device picks up
+                    # where it left off
+                    self.active[sid] = (dest, digest, dev_session.websocket)
+                    await self._send(dev_session, sync.pack(
+                        sync.OFFER, current[0]
+                    ))
+                return
+            # the file changed under the sync, so offer the new one instead
+
+        for offer in offers:
+            if offer is None or synced.get(offer["dest"]) == offer["digest"]:
+                continue
+            self.active[sid] = (
+                offer["dest"], offer["digest"], dev_session.websocket
+            )
+            await self._send(dev_session, sync.pack(sync.OFFER, offer))
+            return
+        self.active.pop(sid, None)
+
+    async def receive(self, dev_session, payload):
+        """ handles the payload of a SYNC frame from a device """
+        operation, body = sync.unpack(payload)
+        sid = dev_session.session_id
+
+        if operation == sync.HAVE:
+            if not isinstance(body, dict) or not (
+                    "digest" in body and "blocks" in body
+            ):
+                # a malformed HAVE has nothing to build a delta against
+                return
+            for _, offer, data in self.seen.values():
+                if offer["digest"] == body["digest"]:
+                    task = asyncio.ensure_future(
+                        self._send_delta(dev_session, offer, data, body)
+                    )
+                    self.sending.add(task)
+                    task.add_done_callback(self.sending.discard)
+                    return
+
+        elif operation == sync.DONE:
+            self.results.setdefault(sid, {})[body["dest"]] = body
+            if body.get("ok"):
+                self.synced.setdefault(sid, {})[body["dest"]] = body["digest"]
+            active = self.active.get(sid)
+            if active is not None and active[1] == body["digest"]:
+                del self.active[sid]
+
+    async def _send_delta(self, dev_session, offer, data, have):
+        """ sends the instructions rebuilding `data` from what `have` says """
+        instructions = list(
+            sync.delta(data, have["blocks"], offer["block_size"])
+        )
+
+        # resume after the instructions the device already ran, if it
+        # stopped cleanly between two of them
+        resume = have.get("resume", 0)
+        starts = [offset for offset, _ in instructions]
+        if resume not in starts:
+            resume = 0
+        instructions = instructions[starts.index(resume) if resume else 0:]
+
+        frame = []
+        frame_start = None
+        frame_size = 0
+        try:
+            for offset, instruction in instructions:
+                if frame and frame_size + len(instruction) > MAX_DELTA:
+                    await self._send(dev_session, sync.pack_delta(
+                        offer["digest"], frame_start, frame
+                    ))
+                    frame = []
+                if not frame:
+                    frame_start = offset
+                    frame_size = 0
+                frame.append(instruction)
+                frame_size += len(instruction)
+            if frame:
+                await self._send(dev_session, sync.pack_delta(
+                    offer["digest"], frame_start, frame
+                ))
+        except websockets.exceptions.ConnectionClosed:
+            # the device asks again, from where it got to, once it's back
+            return
+
+    def stats(self):
+        """ returns a dict of each session's files and their last syncs """
+        return {
+            sid: {
+                "syncing": self.active[sid][0] if sid in self.active else None,
+                "results": self.results.get(sid, {}),
+            }
+            for sid in set(self.active) | set(self.results)
+        }
@@ -0,0 +1,209 @@
+"""
+A module for recording terminal sessions, and replaying them
+
+recordings are asciicast v2 files, so they also play in asciinema. replay
+one with `python -m serialshare_server.record <file>`; see --help
+"""
+
+import argparse
+import codecs
+import json
+import queue
+import threading
+import time
+
+import pyte.screens
+import pyte.streams
+
+# seconds between the recorder thread's writes to disk
+FLUSH_INTERVAL = 0.5
+
+
+class Recorder:
+    """
+    appends timestamped output and input to an asciicast v2 file
+    events are only queued on the calling thread; a background thread
+    decodes and writes them, so recording never waits on the disk
+    """
+    def __init__(self, path, width, height, flush_interval=FLUSH_INTERVAL):
+        self.file = open(path, "w", encoding="utf-8")
+        self.flush_interval = flush_interval
+        self.start = time.monotonic()
+
+        json.dump({
+            "version": 2,
+            "width": width,
+            "height": height,
+            "timestamp": int(time.time()),
+        }, self.file)
+        self.file.write("\n")
+
+        self.events = queue.SimpleQueue()
+        self.stopping = threading.Event()
+        # output and input are decoded separately, so a character split
+        # across two chunks of one isn't garbled by the other
+        self.decoders = {
+            kind: codecs.getincrementaldecoder("utf-8")("surrogateescape")
+            for kind in "oi"
+        }
+
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def output(self, data):
+        """ records bytes printed by the device """
+        self.events.put((time.monotonic() - self.start, "o", data))
+
+    def input(self, data):
+        """ records bytes typed to the device """
+        self.events.put((time.monotonic() - self.start, "i", data))
+
+    def _write_events(self):
+        """ writes out every queued event """
+        lines = []
+        while True:
+            try:
+                when, kind, data = self.events.get_nowait()
+            except queue.Empty:
+                break
+            text = self.decoders[kind].decode(data)
+            if text:
+                lines.append(json.dumps([round(when, 6), kind, text]) + "\n")
+
+        if lines:
+            self.file.writelines(lines)
+            self.file.flush()
+
+    def _write_loop(self):
+        while not self.stopping.wait(self.flush_interval):
+            self._write_events()
+        self._write_events()
+
+    def close(self):
+        """ writes anything still queued and closes the file """
+        self.stopping.set()
+        self.thread.join()
+        self.file.close()
+
+
+def read_header(path):
+    """ returns the header of a recording as a dict """
+    with open(path, encoding="utf-8") as recording:
+        return json.loads(recording.readline())
+
+
+def read_events(path):
+    """ yields (seconds, kind, bytes) for each event in a recording """
+    with open(path, encoding="utf-8") as recording:
+        recording.readline()  # the header
+        for line in recording:
+            if line.strip():
+                when, kind, text = json.loads(line)
+                yield when, kind, text.encode("utf-8", "surrogateescape")
+
+
+def replay(path, feed, speed=1.0):
+    """
+    calls feed(data) with the output in a recording, spaced out as it was
+    recorded divided by `speed`, or as fast as possible if `speed` is 0
+    returns the number of bytes fed
+    """
+    start = time.monotonic()
+    fed = 0
+
+    for when, kind, data in read_events(path):
+        if kind != "o":
+            continue
+
+        if speed:
+            delay = start + when / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        feed(data)
+        fed += len(data)
+
+    return fed
+
+
+def _replay_headless(args):
+    """ replays into a pyte screen alone, reporting parser throughput """
+    header = read_header(args.file)
+    screen = pyte.screens.HistoryScreen(
+        args.width or header["width"],
+        args.height or header["height"],
+        150
+    )
+    stream = pyte.streams.ByteStream(screen=screen, strict=False)
+
+    start = time.perf_counter()
+    fed = replay(args.file, stream.feed, args.speed)
+    return fed, time.perf_counter() - start, None
+
+
+def _replay_screen(args):
+    """ replays onto the real terminal, as the server would draw it """
+    # imported here, since asciimatics is slow to load and headless replays
+    # never need it
+    from . import term
+
+    screen = term.Screen()
+    status = term.Status(2)
+    status.on_change = screen.wake
+    drawer = threading.Thread(target=screen.drawloop, args=(status, 60))
+    drawer.start()
+
+    def feed(data):
+        with screen.lock:
+            screen.stream.feed(data)
+        screen.wake()
+
+    try:
+        start = time.perf_counter()
+        fed = replay(args.file, feed, args.speed)
+        elapsed = time.perf_counter() - start
+    finally:
+        status.set(3)
+        drawer.join()
+        screen.cleanup()
+
+    return fed, elapsed, screen.frame_stats()
+
+
+def main():
+    """ parses arguments and replays a recording """
+    parser = argparse.ArgumentParser(prog="python -m serialshare_server.record")
+    parser.add_argument("file", help="an asciicast v2 recording")
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="playback speed multiplier; 0 plays as fast as possible"
+    )
+    parser.add_argument(
+        "--headless", action="store_true",
+        help="only parse the recording, without drawing it"
+    )
+    parser.add_argument(
+        "--width", type=int,
+        help="headless screen width, if not the recording's"
+    )
+    parser.add_argument(
+        "--height", type=int,
+        help="headless screen height, if not the recording's"
+    )
+    args = parser.parse_args()
+
+    if args.headless:
+        fed, elapsed, frames = _replay_headless(args)
+    else:
+        fed, elapsed, frames = _replay_screen(args)
+
+    print("replayed {} bytes in {:.3f}s ({:.2f} MB/s)".format(
+        fed, elapsed, fed / max(elapsed, 1e-9) / 1e6
+    ))
+    if frames is not None:
+        print("drew {frames} frames, {mean_ms:.2f}ms mean, "
+              "{max_ms:.2f}ms max".format(**frames))
+
+
+if __name__ == "__main__":
+    main()
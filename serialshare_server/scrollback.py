@@ -0,0 +1,208 @@
+"""
+A module for keeping unlimited scrollback on disk, at a fixed memory cost
+"""
+
+import mmap
+import os
+import re
+import struct
+
+import pyte.screens
+
+# the index holds one fixed width offset per line, so finding line n is just
+# reading the offset at n * _OFFSET.size
+_OFFSET = struct.Struct("<Q")
+
+
+def _scan(expression, data, start=0, limit=None):
+    """
+    returns the offsets of the first match of `expression` on each of up
+    to `limit` lines of `data`, from `start` on
+    """
+    offsets = []
+    position = start
+    while limit is None or len(offsets) < limit:
+        end = data.find(b"\n", position)
+        if end < 0:
+            break
+        # searching up to the end of the line, the way one line on its own
+        # would be, so a match can't carry on into the next
+        match = expression.search(data, position, end)
+        if match is not None:
+            offsets.append(match.start())
+        position = end + 1
+    return offsets
+
+
+class Scrollback:
+    """
+    an append-only file of lines, and an index of where each line starts
+    both are read back through mmap, so nothing is loaded into memory that
+    isn't asked for
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path + ".log", "a+b")
+        self.index = open(path + ".idx", "a+b")
+
+        self.size = self.data.tell()
+        self.count = self.index.tell() // _OFFSET.size
+
+        # read-only maps of each file, and the sizes they were made at
+        self._data_map = None
+        self._index_map = None
+        self._mapped = (0, 0)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, text):
+        """ adds a line to the end of the scrollback """
+        encoded = text.rstrip().encode("utf-8") + b"\n"
+        self.index.write(_OFFSET.pack(self.size))
+        self.data.write(encoded)
+        self.size += len(encoded)
+        self.count += 1
+
+    def _maps(self):
+        """ returns maps of the data and index, remade if they've grown """
+        if self._mapped != (self.size, self.count):
+            self.data.flush()
+            self.index.flush()
+            self.close_maps()
+            if self.count:
+                self._data_map = mmap.mmap(
+                    self.data.fileno(), 0, access=mmap.ACCESS_READ
+                )
+                self._index_map = mmap.mmap(
+                    self.index.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            self._mapped = (self.size, self.count)
+        return self._data_map, self._index_map
+
+    def _offset(self, number):
+        """ returns the offset line `number` starts at in the data file """
+        if number >= self.count:
+            return self.size
+        return _OFFSET.unpack_from(self._index_map, number * _OFFSET.size)[0]
+
+    def line(self, number):
+        """ returns line `number`, counting from 0 as the oldest line """
+        if number < 0:
+            number += self.count
+        if not 0 <= number < self.count:
+            raise IndexError("scrollback line out of range")
+
+        data_map, _ = self._maps()
+        start = self._offset(number)
+        end = self._offset(number + 1) - 1
+        return data_map[start:end].decode("utf-8", errors="replace")
+
+    def lines(self, start=0, stop=None):
+        """ returns a list of lines from `start` up to `stop` """
+        start, stop, _ = slice(start, stop).indices(self.count)
+        return [self.line(number) for number in range(start, stop)]
+
+    def _line_at(self, offset):
+        """ returns the number of the line containing byte `offset` """
+        low, high = 0, self.count - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._offset(middle) <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def scanner(self, pattern, limit=None, window=None):
+        """
+        returns a function that returns the offsets of the first match on
+        each of up to `limit` lines matching `pattern`, a regular expression
+        string or bytes, oldest first, in the last `window` bytes of lines
+        the function searches a map of its own of the file as it is now, so
+        it can run in another thread while lines are appended. lines_at()
+        turns the offsets into lines afterwards
+        raises re.error straight away if `pattern` doesn't compile
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode("utf-8")
+        # ^ matches at the start of every line, not just the first
+        expression = re.compile(pattern, re.MULTILINE)
+
+        # flushes the file, and brings the index map up to date
+        self._maps()
+        size = self.size
+        start = 0
+        if window is not None and size > window:
+            # from the start of the first whole line in the window
+            number = self._line_at(size - window)
+            if self._offset(number) < size - window:
+                number += 1
+            start = self._offset(number)
+        if start >= size:
+            return lambda: []
+
+        data_map = mmap.mmap(self.data.fileno(), size, access=mmap.ACCESS_READ)
+
+        def scan():
+            try:
+                return _scan(expression, data_map, start, limit)
+            finally:
+                data_map.close()
+        return scan
+
+    def lines_at(self, offsets):
+        """ returns (line number, line) for the line at each byte offset """
+        self._maps()
+        return [
+            (number, self.line(number))
+            for number in map(self._line_at, offsets)
+        ]
+
+    def search(self, pattern, limit=None, window=None):
+        """
+        returns (line number, line) for each line matching `pattern`, as
+        scanner() finds them, oldest first
+        """
+        return self.lines_at(self.scanner(pattern, limit, window)())
+
+    def close_maps(self):
+        """ drops the maps, e.g. before they're remade """
+        for mapped in (self._data_map, self._index_map):
+            if mapped is not None:
+                mapped.close()
+        self._data_map = None
+        self._index_map = None
+
+    def close(self):
+        """ closes the scrollback's files """
+        self.close_maps()
+        self.data.close()
+        self.index.close()
+
+
+class SpillingScreen(pyte.screens.HistoryScreen):
+    """
+    a HistoryScreen that also appends every line scrolled off the top to a
+    Scrollback, so the in-memory history can stay short
+    """
+    def __init__(self, columns, lines, history, scrollback):
+        super().__init__(columns, lines, history)
+        self.scrollback = scrollback
+
+    def index(self):
+        """ overloaded to spill the line about to be scrolled away """
+        top, bottom = self.margins or pyte.screens.Margins(0, self.lines - 1)
+        if self.cursor.y == bottom:
+            line = self.buffer[top]
+            # wide characters are followed by a stub cell with empty data
+            self.scrollback.append("".join(
+                line[column].data for column in range(self.columns)
+            ))
+        super().index()
+
+
+def open_scrollback(directory, name):
+    """ returns a Scrollback for `name` in `directory`, creating both """
+    os.makedirs(directory, exist_ok=True)
+    return Scrollback(os.path.join(directory, name))
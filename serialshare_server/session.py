@@ -0,0 +1,323 @@
+"""
+A module for hosting many device sessions in one serialshare-server process
+"""
+
+import asyncio
+import collections
+import itertools
+import re
+import time
+
+import pyte.screens
+import pyte.streams
+
+from . import fanout
+from . import scrollback
+
+# the session a plain "/ws" connection belongs to, linked to the local terminal
+DEFAULT_SESSION = "default"
+
+# size of each session's virtual screen, and lines of history kept
+WIDTH = 80
+HEIGHT = 24
+HISTORY = 150
+
+# bytes of device output a session may queue before its websocket stops
+# being read
+MAX_PENDING = 64 * 1024
+
+# bytes fed to one session's screen before moving on to the next session
+BUDGET = 4096
+
+# most bytes of scrollback, counting back from the newest line, one search
+# looks through
+SEARCH_WINDOW = 64 * 1024 * 1024
+
+
+def _matching(expression, lines, limit):
+    """ returns (index, line) for up to `limit` of `lines` that match """
+    return list(itertools.islice(
+        (
+            (number, line) for number, line in enumerate(lines)
+            if expression.search(line)
+        ),
+        limit
+    ))
+
+
+class Session:
+    """
+    a single device connection, with its own virtual screen and a bounded
+    buffer of output waiting to be drawn on it
+    """
+    def __init__(self, session_id, width=WIDTH, height=HEIGHT,
+                 history=HISTORY, max_pending=MAX_PENDING,
+                 scrollback_dir=None):
+        self.session_id = session_id
+        # the device's websocket, while one is connected
+        self.websocket = None
+        # the proto.Framer for the device's connection, once there's been
+        # one, and the channel of it that carries this session's port
+        self.framer = None
+        self.channel = 0
+        # set while no device is connected
+        self.free = asyncio.Event()
+        self.free.set()
+        # the serial stream the device last named, and how many bytes of it
+        # have arrived, so a device reconnecting knows what to resend
+        self.stream_id = None
+        self.stream_offset = 0
+
+        # with a scrollback directory, all history is also kept on disk
+        self.scrollback = None
+        if scrollback_dir is None:
+            self.screen = pyte.screens.HistoryScreen(width, height, history)
+        else:
+            self.scrollback = scrollback.open_scrollback(
+                scrollback_dir, "session-" + session_id
+            )
+            self.screen = scrollback.SpillingScreen(
+                width, height, history, self.scrollback
+            )
+        self.stream = pyte.streams.ByteStream(
+            screen=self.screen,
+            strict=False
+        )
+
+        # device output frames, shared with any observers
+        self.broadcast = fanout.Broadcast()
+
+        # counts feeds of the screen, and notes the last one to change each
+        # line, so viewers can be sent just the lines that changed
+        self.revision = 0
+        self.line_revisions = {}
+        # resolved, and replaced, whenever the screen is fed
+        self._changed = asyncio.get_event_loop().create_future()
+
+        # device output not yet fed to self.stream
+        self.pending = bytearray()
+        self.max_pending = max_pending
+        # set while self.pending has room for more
+        self.room = asyncio.Event()
+        self.room.set()
+        # whether the session is waiting in a Hub's run queue
+        self.queued = False
+
+        # counters
+        self.bytes_in = 0
+        self.bytes_fed = 0
+        self.feed_time = 0.0
+
+    async def put(self, data):
+        """ queues device output, waiting while the buffer is full """
+        await self.room.wait()
+        self.pending += data
+        self.bytes_in += len(data)
+
+        if len(self.pending) >= self.max_pending:
+            self.room.clear()
+
+    def _render(self, line):
+        """ returns the text of one line of the screen or its history """
+        # wide characters are followed by a stub cell with empty data, so
+        # joining every cell gives the same text as pyte's Screen.display
+        return "".join(
+            line[column].data for column in range(self.screen.columns)
+        )
+
+    def lines(self):
+        """ returns the text of each line on the screen """
+        return [
+            self._render(self.screen.buffer[number])
+            for number in range(self.screen.lines)
+        ]
+
+    def history(self, count=HISTORY):
+        """
+        returns the text of up to `count` lines scrolled off the top, oldest
+        first, from disk if there's a scrollback file
+        """
+        if count <= 0:
+            return []
+        if self.scrollback is not None:
+            return self.scrollback.lines(max(len(self.scrollback) - count, 0))
+
+        top = self.screen.history.top
+        start = max(len(top) - count, 0)
+        return [
+            self._render(line) for line in itertools.islice(top, start, None)
+        ]
+
+    async def search(self, pattern, limit=100, window=SEARCH_WINDOW,
+                     executor=None):
+        """
+        returns a list of (line number, text) for history lines matching
+        the regular expression `pattern`, oldest first, looking at no more
+        than the last `window` bytes of scrollback
+        the matching runs in `executor`, off the event loop, over the
+        history as it was when called. re.error is raised for a bad pattern
+        """
+        loop = asyncio.get_running_loop()
+        if self.scrollback is not None:
+            scan = self.scrollback.scanner(pattern, limit, window)
+            offsets = await loop.run_in_executor(executor, scan)
+            return self.scrollback.lines_at(offsets)
+
+        expression = re.compile(pattern)
+        lines = self.history(len(self.screen.history.top))
+        return await loop.run_in_executor(
+            executor, _matching, expression, lines, limit
+        )
+
+    def to_dict(self, history=HISTORY):
+        """ returns the screen, and `history` lines of history, as a dict """
+        return {
+            "session": self.session_id,
+            "connected": self.websocket is not None,
+            "width": self.screen.columns,
+            "height": self.screen.lines,
+            "cursor": {"x": self.screen.cursor.x, "y": self.screen.cursor.y},
+            "lines": self.lines(),
+            "history": self.history(history),
+        }
+
+    def text(self, history=HISTORY):
+        """ returns `history` lines of history, then the screen, as text """
+        lines = self.history(history) + self.lines()
+        return "\n".join(line.rstrip() for line in lines) + "\n"
+
+    def snapshot(self):
+        """
+        returns bytes that redraw the current screen from scratch on a
+        terminal, for observers that join late or fall behind
+        output still waiting for the scheduler is fed first, since it's
+        already been broadcast and observers wouldn't see it otherwise
+        """
+        if self.pending:
+            # a feed like the scheduler's, so viewers hear of the change
+            # and the device's put() gets its room back
+            self.feed(len(self.pending))
+
+        lines = "\r\n".join(line.rstrip() for line in self.lines())
+        cursor = "\x1b[{};{}H".format(
+            self.screen.cursor.y + 1, self.screen.cursor.x + 1
+        )
+        return ("\x1b[2J\x1b[H" + lines + cursor).encode("utf-8")
+
+    def feed(self, budget):
+        """ parses up to `budget` bytes of queued output into the screen """
+        chunk = bytes(self.pending[:budget])
+        del self.pending[:budget]
+
+        if len(self.pending) < self.max_pending:
+            self.room.set()
+
+        start = time.process_time()
+        self.stream.feed(chunk)
+        self.feed_time += time.process_time() - start
+        self.bytes_fed += len(chunk)
+
+        self.revision += 1
+        for number in self.screen.dirty:
+            self.line_revisions[number] = self.revision
+        self.screen.dirty.clear()
+        self._changed.set_result(None)
+        self._changed = asyncio.get_event_loop().create_future()
+
+    def changed_since(self, revision):
+        """
+        returns the numbers of the lines changed since `revision`, or of
+        every line if `revision` is None
+        """
+        if revision is None:
+            return range(self.screen.lines)
+        return [
+            number for number, changed in self.line_revisions.items()
+            if changed > revision and number < self.screen.lines
+        ]
+
+    async def wait_changed(self, revision):
+        """ waits until the screen has been fed since `revision` """
+        while self.revision == revision:
+            await asyncio.shield(self._changed)
+
+
+class Hub:
+    """
+    a collection of sessions, keyed by id, and a scheduler that shares the
+    screen parsing work between them
+    """
+    def __init__(self, budget=BUDGET, max_sessions=256, **session_args):
+        self.sessions = {}
+        self.budget = budget
+        self.max_sessions = max_sessions
+        # keyword arguments for each new Session
+        self.session_args = session_args
+
+        # sessions with output waiting to be parsed, in the order they'll run
+        self.ready = collections.deque()
+        self.wakeup = asyncio.Event()
+
+    def session(self, session_id):
+        """ returns the session for `session_id`, creating it if needed """
+        if session_id not in self.sessions:
+            if len(self.sessions) >= self.max_sessions:
+                raise OverflowError("too many sessions")
+            self.sessions[session_id] = Session(
+                session_id, **self.session_args
+            )
+        return self.sessions[session_id]
+
+    async def put(self, session, data):
+        """ queues device output for `session` and schedules it to run """
+        await session.put(data)
+
+        if not session.queued:
+            session.queued = True
+            self.ready.append(session)
+            self.wakeup.set()
+
+    async def schedule(self):
+        """
+        feeds each session with queued output at most self.budget bytes at a
+        time, round robin, so a busy session can't starve the quiet ones
+        """
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            while self.ready:
+                session = self.ready.popleft()
+                session.feed(self.budget)
+
+                if session.pending:
+                    self.ready.append(session)
+                else:
+                    session.queued = False
+
+                # let the network handlers run between slices
+                await asyncio.sleep(0)
+
+    def stats(self):
+        """ returns a dict of counters for each session """
+        stats = {}
+        for session_id, session in self.sessions.items():
+            stats[session_id] = {
+                "connected": session.websocket is not None,
+                "channel": session.channel,
+                "stream_offset": session.stream_offset,
+                "bytes_in": session.bytes_in,
+                "bytes_fed": session.bytes_fed,
+                "pending": len(session.pending),
+                "feed_time": session.feed_time,
+            }
+            framer = session.framer
+            if framer is None:
+                continue
+            stats[session_id]["latency"] = framer.stats()
+            if framer.compressor is not None:
+                stats[session_id]["compression"] = {
+                    "sent": framer.compressor.stats(),
+                    "received": framer.decompressor.stats(),
+                }
+        return stats
@@ -0,0 +1,201 @@
+"""
+A module for serving the web page and its assets from memory
+
+files are read once and kept, along with a gzipped copy, until their mtime
+changes. every response carries an ETag, so browsers can revalidate with
+If-None-Match and get an empty 304 back when nothing changed
+"""
+
+import collections
+import gzip
+import hashlib
+import http
+import mimetypes
+import os
+import sys
+import urllib.parse
+
+# where assets are served from unless told otherwise: next to the script
+# that was run, where index.html has always been looked for
+DEFAULT_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+# the file served for / (and any other directory)
+INDEX = "index.html"
+
+# files smaller than this aren't worth gzipping, in bytes
+GZIP_THRESHOLD = 256
+
+# content types worth gzipping. images and fonts mostly come compressed
+_COMPRESSIBLE = (
+    "text/", "application/javascript", "application/json", "image/svg+xml"
+)
+
+_Asset = collections.namedtuple(
+    "_Asset", ["mtime", "size", "etag", "content_type", "body", "gzipped"]
+)
+
+
+def _accepts_gzip(headers):
+    """ returns whether the request's Accept-Encoding allows gzip """
+    for coding in headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+def _matches(headers, etag):
+    """ returns whether the request's If-None-Match names `etag` """
+    tags = headers.get("If-None-Match")
+    if tags is None:
+        return False
+    for tag in tags.split(","):
+        # a weak match is enough for a GET
+        tag = tag.strip()
+        if tag == "*" or tag.replace("W/", "", 1) == etag:
+            return True
+    return False
+
+
+class Assets:
+    """
+    a cache of the files in `directory`, answering http requests for them
+    as process_request would
+    `files` limits which names in it are served, if it isn't None
+    """
+    def __init__(self, directory=DEFAULT_DIR, files=None,
+                 gzip_threshold=GZIP_THRESHOLD):
+        self.directory = os.path.abspath(directory)
+        self.files = files
+        self.gzip_threshold = gzip_threshold
+
+        # _Assets by file name
+        self.cache = {}
+
+        # counters: responses served from memory, files (re)read from disk,
+        # and 304s sent instead of a body
+        self.hits = 0
+        self.loads = 0
+        self.not_modified = 0
+
+    def _resolve(self, path):
+        """
+        returns the file name a request path refers to, or None if it
+        points outside of the directory or at a file not being served
+        """
+        name = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        if name.endswith("/"):
+            name += INDEX
+        filename = os.path.normpath(
+            os.path.join(self.directory, name.lstrip("/"))
+        )
+        if not filename.startswith(self.directory + os.sep):
+            return None
+        if (self.files is not None and os.path.relpath(
+                filename, self.directory
+        ) not in self.files):
+            return None
+        return filename
+
+    def _load(self, filename):
+        """ returns the _Asset for `filename`, reading it if it changed """
+        stat = os.stat(filename)
+        asset = self.cache.get(filename)
+        if (asset is not None and asset.mtime == stat.st_mtime_ns
+                and asset.size == stat.st_size):
+            self.hits += 1
+            return asset
+
+        with open(filename, "rb") as source:
+            body = source.read()
+        content_type, _ = mimetypes.guess_type(filename)
+        content_type = content_type or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+
+        asset = _Asset(
+            stat.st_mtime_ns,
+            stat.st_size,
+            '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest()),
+            content_type,
+            body,
+            self._gzipped(filename, stat, body, content_type)
+        )
+        self.cache[filename] = asset
+        self.loads += 1
+        return asset
+
+    def _gzipped(self, filename, stat, body, content_type):
+        """
+        returns the gzipped body for `filename`: a precompressed .gz next to
+        it if that's up to date, or one made now, or None if not worth it
+        """
+        try:
+            if os.stat(filename + ".gz").st_mtime_ns >= stat.st_mtime_ns:
+                with open(filename + ".gz", "rb") as precompressed:
+                    return precompressed.read()
+        except OSError:
+            pass
+
+        if (len(body) < self.gzip_threshold
+                or not content_type.startswith(_COMPRESSIBLE)):
+            return None
+        # mtime=0 keeps the output the same for the same file
+        gzipped = gzip.compress(body, 9, mtime=0)
+        return gzipped if len(gzipped) < len(body) else None
+
+    def respond(self, path, headers):
+        """
+        returns (status, headers, body) for a request for `path`, or None
+        to carry on with the websocket handshake if no such file exists
+        """
+        filename = self._resolve(path)
+        if filename is None:
+            return None
+
+        try:
+            asset = self._load(filename)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            self.cache.pop(filename, None)
+            if os.path.basename(filename) == INDEX:
+                return (
+                    http.HTTPStatus.NOT_FOUND, [],
+                    b"404 - couldn't find index.html"
+                )
+            return None
+        except OSError:
+            return (
+                http.HTTPStatus.INTERNAL_SERVER_ERROR, [],
+                "500 - couldn't read {}.\n".format(filename).encode("utf-8")
+            )
+
+        response_headers = [
+            ("ETag", asset.etag),
+            # always revalidate, which is cheap, so edits show up at once
+            ("Cache-Control", "no-cache"),
+        ]
+        if asset.gzipped is not None:
+            response_headers.append(("Vary", "Accept-Encoding"))
+
+        if _matches(headers, asset.etag):
+            self.not_modified += 1
+            return http.HTTPStatus.NOT_MODIFIED, response_headers, b''
+
+        response_headers.append(("Content-Type", asset.content_type))
+        if asset.gzipped is not None and _accepts_gzip(headers):
+            response_headers.append(("Content-Encoding", "gzip"))
+            return http.HTTPStatus.OK, response_headers, asset.gzipped
+        return http.HTTPStatus.OK, response_headers, asset.body
+
+    def stats(self):
+        """ returns a dict of cache counters """
+        return {
+            "files": len(self.cache),
+            "bytes": sum(
+                len(asset.body) + len(asset.gzipped or b'')
+                for asset in self.cache.values()
+            ),
+            "hits": self.hits,
+            "loads": self.loads,
+            "not_modified": self.not_modified,
+        }
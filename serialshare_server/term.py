@@ -5,6 +5,7 @@ A module for handling terminal input/output for serialshare-server
 import asyncio
 import atexit
 import signal
+import sys
 import time
 import threading
 import queue
@@ -16,20 +17,58 @@ import pyte.modes
 import pyte.screens
 import pyte.streams
 
+from serialshare import metrics
+from serialshare import trace
+
 from . import keycodes
+from . import record
+from . import scrollback
+
+# most bytes of output fed to the pyte stream at a time
+FEED_LIMIT = 64 * 1024
+
+# input from one poll of at least this many bytes is taken to be a paste,
+# which is paced when there's a baud rate to pace it to
+PASTE_THRESHOLD = 64
+# seconds between the writes a paced paste is split into
+PASTE_TICK = 0.02
+
+# chunks of output waiting for _feed_bytes, the time taken to draw each
+# frame, and the time from keyboard input arriving to it being sent on
+_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    "serialshare_term_queue_depth",
+    "chunks of output waiting to be fed to the terminal's screen"
+)
+_FRAME_TIME = metrics.REGISTRY.histogram(
+    "serialshare_term_frame_seconds", "time taken to draw each frame"
+)
+_KEY_LATENCY = metrics.REGISTRY.histogram(
+    "serialshare_keystroke_seconds",
+    "time from keyboard input arriving to its bytes being sent"
+)
 
 
 class Screen:
     """
     a wrapper for connecting a pyte Screen with an asciimatics Screen
     """
-    def __init__(self):
+    def __init__(self, scrollback_dir=None):
         self.real = asciimatics.screen.Screen.open()
-        self.virt = pyte.screens.HistoryScreen(
-            self.real.width,
-            self.real.height - 2,
-            150
-        )
+
+        # with a scrollback directory, all history is also kept on disk
+        if scrollback_dir is None:
+            self.virt = pyte.screens.HistoryScreen(
+                self.real.width,
+                self.real.height - 2,
+                150
+            )
+        else:
+            self.virt = scrollback.SpillingScreen(
+                self.real.width,
+                self.real.height - 2,
+                150,
+                scrollback.open_scrollback(scrollback_dir, "terminal")
+            )
 
         # draw the status line separator
         self.real.centre('--------------------', self.real.height - 2)
@@ -52,6 +91,21 @@ class Screen:
             "y": self.virt.cursor.y,
         }
 
+        # set when the virtual screen has changed and needs drawing
+        self.damage = threading.Event()
+        # held while the virtual screen is changed or read
+        self.lock = threading.Lock()
+
+        # bytes of the pipe from the server fed to the virtual screen, and
+        # how many of them the frame being drawn shows, for tracing
+        self.offset = 0
+        self.drawing = 0
+
+        # frame time statistics, in seconds
+        self.frames = 0
+        self.frame_time = 0.0
+        self.frame_time_max = 0.0
+
     def cleanup(self):
         """ clears, resets, and closes all displays components """
         self.real.clear()
@@ -59,77 +113,152 @@ class Screen:
         self.real.refresh()
         self.real.close()
 
+    def wake(self):
+        """ tells drawloop the virtual screen changed. safe from any thread """
+        self.damage.set()
+
+    def frame_stats(self):
+        """ returns a dict of statistics about the frames drawn so far """
+        return {
+            "frames": self.frames,
+            "mean_ms": self.frame_time / max(self.frames, 1) * 1000,
+            "max_ms": self.frame_time_max * 1000,
+        }
+
     def drawloop(self, status, fps=60):
         """
-        loops up to fps times per second
-        redraws terminal lines if necessary
-        updates the cursor location every frame
-        draws the status line every frame
+        sleeps until the virtual screen changes or the status clock ticks
+        redraws only lines that changed, plus the cursor, and the status line
+        only when its text changed
+        draws at most fps times per second, so a burst of output shares a
+        single refresh
         """
+        last_frame = 0.0
+        # the status text and clock last drawn
+        last_status = None
+        # bytes of the pipe on screen
+        drawn = 0
 
         while status.get() < 3:
-            self.real.print_at(
-                self.virt.display[self.cursor["y"]],
-                0, self.cursor["y"]
-            )
+            # wake at the next second at the latest, to tick the clock
+            self.damage.wait(1 - time.time() % 1)
 
-            # unhighlight old cursor location
-            self.real.highlight(
-                self.cursor["x"], self.cursor["y"],
-                1, 1,
-                self.real.COLOUR_WHITE, self.real.COLOUR_BLACK
-            )
+            # let the rest of a burst land before drawing any of it
+            wait = last_frame + 1 / fps - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
 
-            # we work off a copy of the dirty line set so it doesn't change in
-            # another thread while we're reading it, which would cause an error
-            dirties = self.virt.dirty.copy()
-            self.virt.dirty.clear()
-
-            # redraw all lines that have changed
-            for dirty in dirties:
-                self.real.print_at(
-                    self.virt.display[dirty], 0,
-                    dirty
-                )
-
-            # highlight new cursor location
-            self.real.highlight(
-                self.virt.cursor.x, self.virt.cursor.y,
-                1, 1,
-                self.real.COLOUR_BLACK, self.real.COLOUR_WHITE
-            )
+            # clear before reading the screen, so changes made while we
+            # draw wake us again
+            self.damage.clear()
+            start = time.perf_counter()
 
-            # store new cursor location
-            self.cursor["x"] = self.virt.cursor.x
-            self.cursor["y"] = self.virt.cursor.y
+            drew = self._draw_lines()
 
-            # clear status line
-            self.real.centre(
-                '\t'.expandtabs(self.real.width),
-                self.real.height - 1
-            )
+            current_status = (status.string(), time.ctime())
+            if current_status != last_status:
+                self._draw_status(*current_status)
+                last_status = current_status
+                drew = True
 
-            current_time = time.ctime()
-            self.real.print_at(
-                current_time,
-                self.real.width - len(current_time),
-                self.real.height - 1
-            )
-
-            # draw status line
-            self.real.centre(
-                status.string(),
-                self.real.height - 1
-            )
+            if not drew:
+                continue
 
             # render screen to user's real terminal
             self.real.refresh()
+            last_frame = time.monotonic()
+            trace.mark("drawn", "pipe", drawn, self.drawing - drawn)
+            drawn = self.drawing
+
+            frame_time = time.perf_counter() - start
+            self.frames += 1
+            self.frame_time += frame_time
+            self.frame_time_max = max(self.frame_time_max, frame_time)
+            _FRAME_TIME.observe(frame_time)
+
+    def _line(self, number):
+        """ returns the text of one line of the virtual screen """
+        line = self.virt.buffer[number]
+        # wide characters are followed by a stub cell with empty data, so
+        # joining every cell gives the same text as pyte's Screen.display
+        return "".join(
+            line[column].data for column in range(self.virt.columns)
+        )
+
+    def snapshot(self):
+        """
+        returns the cursor position and the text of every line changed since
+        the last snapshot, all taken at one instant
+        """
+        with self.lock:
+            cursor = {"x": self.virt.cursor.x, "y": self.virt.cursor.y}
+            self.drawing = self.offset
+
+            # swap out the dirty set, rather than copying and clearing it,
+            # so the feeder thread goes straight on with a fresh one
+            dirties = self.virt.dirty
+            self.virt.dirty = set()
+
+            # the old cursor line needs redrawing to unhighlight it
+            if dirties or cursor != self.cursor:
+                dirties.add(self.cursor["y"])
+            lines = {number: self._line(number) for number in dirties}
+
+        return cursor, lines
+
+    def _draw_lines(self):
+        """
+        redraws changed lines and moves the cursor
+        returns whether anything was drawn
+        """
+        cursor, lines = self.snapshot()
+        if not lines:
+            return False
+
+        # redraw all lines that have changed
+        for number, text in lines.items():
+            self.real.print_at(text, 0, number)
+
+        # unhighlight old cursor location
+        self.real.highlight(
+            self.cursor["x"], self.cursor["y"],
+            1, 1,
+            self.real.COLOUR_WHITE, self.real.COLOUR_BLACK
+        )
+
+        # highlight new cursor location
+        self.real.highlight(
+            cursor["x"], cursor["y"],
+            1, 1,
+            self.real.COLOUR_BLACK, self.real.COLOUR_WHITE
+        )
+
+        # store new cursor location
+        self.cursor = cursor
+        return True
+
+    def _draw_status(self, status_string, current_time):
+        """ redraws the status line """
+        # clear status line
+        self.real.centre(
+            '\t'.expandtabs(self.real.width),
+            self.real.height - 1
+        )
+
+        self.real.print_at(
+            current_time,
+            self.real.width - len(current_time),
+            self.real.height - 1
+        )
 
-            # only fire up to fps times per second
-            time.sleep(1000 / fps / 1000)
+        # draw status line
+        self.real.centre(
+            status_string,
+            self.real.height - 1
+        )
 
 
-class _Status:
+class Status:
     """
     a class shared by Terminal and Screen to pass a status line back and forth
     this is broken out into its own class for easier thread safety
@@ -144,15 +273,20 @@ class _Status:
 
     def __init__(self, value=0):
         self.lock = threading.Lock()
+        # called with no arguments whenever the status changes
+        self.on_change = None
         self.set(value)
 
     def set(self, value):
         """ sets the value of raw and updates string """
         self.lock.acquire(True)
         self.raw = value
-        self.raw_string = _Status._status_strings[value]
+        self.raw_string = Status._status_strings[value]
         self.lock.release()
 
+        if self.on_change is not None:
+            self.on_change()
+
     def get(self):
         """ returns the value of raw """
         self.lock.acquire(True)
@@ -173,12 +307,18 @@ class Terminal:
     a terminal-based terminal emulator that reads data to display and writes
     received input to/from a pipe
     """
-    def __init__(self, pipe, fps=60):
+    def __init__(self, pipe, fps=60, scrollback_dir=None, record_path=None,
+                 paste_baudrate=None):
         self.pipe = pipe
         self.fps = fps
 
+        # pastes are sent no faster than a uart at this rate would take
+        # them, if it's set, so the device keeps up, and a ctrl-c isn't
+        # stuck in the buffers behind the rest of the paste
+        self.paste_baudrate = paste_baudrate
+
         # status index
-        self.status = _Status()
+        self.status = Status()
 
         # catch ctrl-c so we can send it across the websocket
         self.ctrlc = asyncio.Event()
@@ -187,13 +327,32 @@ class Terminal:
         # queue for knowing when to return from await self
         self.quitqueue = asyncio.Queue()
 
-        self.screen = Screen()
+        # set when there may be keyboard input (or a ctrl-c) to send, and
+        # the time.perf_counter() time stdin first became readable since
+        # the last send_input
+        self.input_ready = asyncio.Event()
+        self.input_since = None
+        # the loop termloop runs in, for waking it from the signal handler
+        self.loop = None
+
+        self.screen = Screen(scrollback_dir)
+        # redraw the status line as soon as it changes
+        self.status.on_change = self.screen.wake
+
+        # records everything received and typed, if asked to
+        self.recorder = None
+        if record_path is not None:
+            self.recorder = record.Recorder(
+                record_path, self.screen.virt.columns, self.screen.virt.lines
+            )
 
         atexit.register(self.cleanup)
 
     def cleanup(self):
-        """ closes self.screen, maybe other things later """
+        """ closes self.screen and the recording, if there is one """
         self.screen.cleanup()
+        if self.recorder is not None:
+            self.recorder.close()
         atexit.unregister(self.cleanup)
 
     def sig_handler(self, signum, frame):
@@ -202,6 +361,9 @@ class Terminal:
 
         if signum == signal.SIGINT:
             self.ctrlc.set()
+            # the loop may be asleep in select(), which a signal won't end
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.input_ready.set)
 
     def __await__(self):
         return self.termloop().__await__()
@@ -216,13 +378,16 @@ class Terminal:
             outputqueue = queue.Queue()
             loop = asyncio.get_running_loop()
 
-            asyncio.create_task(self.receive_bytes(from_ws, outputqueue))
+            # kept, since asyncio only holds weak references to tasks
+            receiver = asyncio.create_task(
+                self.receive_bytes(from_ws, outputqueue)
+            )
             loop.run_in_executor(
                 None,
                 _feed_bytes,
                 self.status,
                 outputqueue,
-                self.screen.stream
+                self.screen
             )
 
             loop.run_in_executor(
@@ -232,31 +397,77 @@ class Terminal:
                 self.fps
             )
 
-            # run up to self.fps times per second
+            try:
+                await self.input_loop(to_ws)
+                return self.quitqueue.get_nowait()
+            finally:
+                # however input_loop ended, the drawing and feeding threads
+                # have to stop too, or the executor waits on them at exit
+                receiver.cancel()
+                self.status.set(3)
+                # let _feed_bytes out of its wait on the queue
+                outputqueue.put(None)
+                await asyncio.gather(receiver, return_exceptions=True)
+
+
+    async def input_loop(self, writer):
+        """
+        sends keyboard input to `writer` as soon as stdin is readable, until
+        something is put in self.quitqueue
+        """
+        self.loop = asyncio.get_running_loop()
+        fileno = sys.stdin.fileno()
+
+        try:
+            self.loop.add_reader(fileno, self._stdin_readable)
+        except NotImplementedError:
+            # no readiness notifications for stdin here (i.e. windows), so
+            # poll up to self.fps times per second instead
             while self.quitqueue.empty():
-                await self.send_input(to_ws)
+                await self.send_input(writer)
                 await asyncio.sleep(1000 / self.fps / 1000)
+            return
 
-            self.status.set(3)
-            return self.quitqueue.get_nowait()
-
+        try:
+            while self.quitqueue.empty():
+                await self.input_ready.wait()
+                self.input_ready.clear()
+                await self.send_input(writer)
+        finally:
+            self.loop.remove_reader(fileno)
+
+    def _stdin_readable(self):
+        """ notes when keyboard input arrived, and wakes input_loop """
+        if self.input_since is None:
+            self.input_since = time.perf_counter()
+        self.input_ready.set()
 
     async def receive_bytes(self, reader, screen_queue):
         """ takes bytes from reader and feeds them to the queue.Queue """
         # this byte is sent in net.py to indicate a connection's ready
-        await reader.readuntil(b'\x01')
+        offset = len(await reader.readuntil(b'\x01'))
+        self.screen.offset = offset
         if self.status.get() < 2:
             self.status.set(2)
 
         while not reader.at_eof():
             data = await reader.read(128)
+            trace.mark("receive_bytes", "pipe", offset, len(data))
+            offset += len(data)
             screen_queue.put(data)
+            if self.recorder is not None:
+                self.recorder.output(data)
 
 
     async def send_input(self, writer):
         """
         captures input from user's real terminal and sends it to `writer`
         """
+        since = self.input_since
+        if since is None:
+            since = time.perf_counter()
+        self.input_since = None
+
         if self.ctrlc.is_set():
             self.ctrlc.clear()
 
@@ -273,28 +484,91 @@ class Terminal:
         else:
             event = self.screen.real.get_event()
 
+        # every key waiting is sent in one write, so a paste goes out in a
+        # few big frames rather than one per character
+        codes = []
         while event is not None:
             if isinstance(event, asciimatics.event.KeyboardEvent):
-                # get the byte sequence for the key(s) pressed
-                code = keycodes.lookup(event.key_code)
-
-                # send it
-                if self.status.get() >= 2:
-                    try:
-                        await writer.drain()
-                    except ConnectionResetError as reset_error:
-                        await self.quitqueue.put(
-                            "connection error: " + str(reset_error)
-                        )
-                    writer.write(code)
+                codes.append(event.key_code)
 
             # skip waiting if there's another keypress to read
             event = self.screen.real.get_event()
 
+        if not codes or self.status.get() < 2:
+            return
+        # get the byte sequence for the key(s) pressed
+        data = keycodes.translate(codes)
+
+        # send it
+        try:
+            await writer.drain()
+        except ConnectionResetError as reset_error:
+            await self.quitqueue.put("connection error: " + str(reset_error))
+        _KEY_LATENCY.observe(time.perf_counter() - since)
+        if self.paste_baudrate and len(data) >= PASTE_THRESHOLD:
+            data = await self._paste(writer, data)
+        else:
+            writer.write(data)
+        if self.recorder is not None:
+            self.recorder.input(data)
+
+    async def _paste(self, writer, data):
+        """
+        writes `data` in pieces, no faster than self.paste_baudrate allows,
+        until it's all written or ctrl-c is pressed
+        returns the part of `data` written
+        """
+        # a uart takes 10 bits per byte, with start and stop bits
+        rate = self.paste_baudrate / 10
+        step = max(1, int(rate * PASTE_TICK))
+        start = time.monotonic()
+
+        for offset in range(0, len(data), step):
+            if self.ctrlc.is_set():
+                # the ctrl-c goes next, and the rest of the paste never
+                return data[:offset]
+            writer.write(data[offset:offset + step])
+            try:
+                await writer.drain()
+            except (ConnectionResetError, BrokenPipeError) as error:
+                # the rest of the paste has nowhere to go
+                await self.quitqueue.put("connection error: " + str(error))
+                return data[:offset]
+            await asyncio.sleep(
+                start + (offset + step) / rate - time.monotonic()
+            )
+        return data
+
 
-def _feed_bytes(status, screen_queue, feedable):
+def _feed_bytes(status, screen_queue, screen, limit=FEED_LIMIT):
     """
-    accepts a queue.Queue and continuously reads it into feedable
+    accepts a queue.Queue and continuously reads it into screen's stream
+    every chunk already waiting is fed in one go, up to `limit` bytes, with
+    the screen locked, and the screen's drawloop is woken after each feed
+    returns once a None is queued, or the status says we're shutting down
     """
-    while status.get() < 3:
-        feedable.feed(screen_queue.get(block=True, timeout=None))
+    done = False
+    while not done and status.get() < 3:
+        chunk = screen_queue.get(block=True, timeout=None)
+        if chunk is None:
+            return
+        _QUEUE_DEPTH.set(screen_queue.qsize())
+
+        batch = bytearray(chunk)
+        while len(batch) < limit:
+            try:
+                chunk = screen_queue.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                # draw what we have, then stop
+                done = True
+                break
+            batch += chunk
+
+        trace.mark("feed_start", "pipe", screen.offset, len(batch))
+        with screen.lock:
+            screen.stream.feed(bytes(batch))
+            screen.offset += len(batch)
+        trace.mark("feed_end", "pipe", screen.offset - len(batch), len(batch))
+        screen.wake()
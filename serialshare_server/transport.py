@@ -0,0 +1,447 @@
+"""
+A module for linking the network and terminal halves of serialshare-server
+
+every mode gives a pair of duplex ends with the same interface as
+aiopipe.AioDuplex: `detach()` before handing an end to another process, and
+`async with end.open() as (reader, writer)` to use it
+"""
+
+import asyncio
+import collections
+import contextlib
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import aiopipe
+
+# an os pipe between the terminal and a network process
+PIPE = "pipe"
+# asyncio queues, with the network running in the terminal's process
+QUEUE = "queue"
+# shared memory ring buffers between the terminal and a network process
+SHM = "shm"
+MODES = (PIPE, QUEUE, SHM)
+
+# chunks a QUEUE channel holds before writers have to drain
+QUEUE_LIMIT = 64
+# bytes of data in each direction of a SHM ring
+RING_SIZE = 1024 * 1024
+# longest a SHM reader sleeps between checks if it misses a wakeup, seconds
+RING_POLL = 0.01
+
+
+def duplex(mode=PIPE):
+    """ returns a connected (network end, terminal end) pair """
+    if mode == PIPE:
+        return aiopipe.aioduplex()
+    if mode == QUEUE:
+        return _queue_duplex()
+    if mode == SHM:
+        return _shm_duplex()
+    raise ValueError("unknown transport: {}".format(mode))
+
+
+def in_process(mode):
+    """ returns whether the network half runs in the terminal's process """
+    return mode == QUEUE
+
+
+class _Reader:
+    """
+    the parts of asyncio.StreamReader that serialshare uses, reading from
+    chunks returned by self._fetch()
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def _fetch(self):
+        """ returns the next chunk, or b'' at the end of the stream """
+        raise NotImplementedError
+
+    async def _fill(self):
+        chunk = await self._fetch()
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+
+    def at_eof(self):
+        """ returns whether the stream ended and everything has been read """
+        return self._eof and not self._buffer
+
+    async def read(self, n=-1):
+        """ returns up to `n` bytes, waiting only if nothing is buffered """
+        if not self._buffer and not self._eof:
+            await self._fill()
+
+        if n < 0:
+            n = len(self._buffer)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readuntil(self, separator=b'\n'):
+        """ returns bytes up to and including `separator` """
+        while True:
+            index = self._buffer.find(separator)
+            if index >= 0:
+                end = index + len(separator)
+                data = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return data
+
+            if self._eof:
+                partial = bytes(self._buffer)
+                self._buffer.clear()
+                raise asyncio.IncompleteReadError(partial, None)
+
+            await self._fill()
+
+
+class _Channel:
+    """ one direction of an in-process duplex: a bounded deque of chunks """
+    def __init__(self, limit=QUEUE_LIMIT):
+        self.chunks = collections.deque()
+        self.limit = limit
+        self.closed = False
+        self.readable = None
+        self.writable = None
+
+    def events(self):
+        """ creates the channel's events, once there's a loop to use """
+        if self.readable is None:
+            self.readable = asyncio.Event()
+            self.writable = asyncio.Event()
+            self.writable.set()
+
+
+class _QueueReader(_Reader):
+    def __init__(self, channel):
+        super().__init__()
+        self._channel = channel
+
+    async def _fetch(self):
+        channel = self._channel
+        while not channel.chunks:
+            if channel.closed:
+                return b''
+            channel.readable.clear()
+            await channel.readable.wait()
+
+        chunk = channel.chunks.popleft()
+        if len(channel.chunks) < channel.limit:
+            channel.writable.set()
+        return chunk
+
+
+class _QueueWriter:
+    def __init__(self, channel):
+        self._channel = channel
+
+    def write(self, data):
+        """ queues `data` without waiting, like asyncio.StreamWriter """
+        channel = self._channel
+        channel.chunks.append(bytes(data))
+        channel.readable.set()
+        if len(channel.chunks) >= channel.limit:
+            channel.writable.clear()
+
+    async def drain(self):
+        """ waits until the reader has caught up """
+        await self._channel.writable.wait()
+
+    def close(self):
+        """ ends the stream for the reader """
+        self._channel.closed = True
+        self._channel.readable.set()
+
+
+class QueueEnd:
+    """ one end of an in-process duplex """
+    def __init__(self, rx_channel, tx_channel):
+        self._rx = rx_channel
+        self._tx = tx_channel
+
+    @contextlib.contextmanager
+    def detach(self):
+        """ there's nothing to detach in-process """
+        yield self
+
+    @contextlib.asynccontextmanager
+    async def open(self):
+        """ yields a (reader, writer) pair """
+        self._rx.events()
+        self._tx.events()
+        writer = _QueueWriter(self._tx)
+        try:
+            yield _QueueReader(self._rx), writer
+        finally:
+            writer.close()
+
+
+def _queue_duplex():
+    one, two = _Channel(), _Channel()
+    return QueueEnd(one, two), QueueEnd(two, one)
+
+
+# a ring's header: bytes ever written, bytes ever read, whether the writer
+# closed, and whether the reader is asleep waiting for a wakeup
+_RING_HEADER = struct.Struct("<QQQQ")
+_HEAD, _TAIL, _CLOSED, _WAITING = (offset * 8 for offset in range(4))
+_U64 = struct.Struct("<Q")
+
+
+def _attach(name, track):
+    """
+    returns the existing SharedMemory called `name`. unless `track` is set,
+    it's kept out of this process's resource tracker, which before python
+    3.13 takes every segment attached to as one to unlink at exit. that's
+    for the end that owns the segment to do
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=track)
+
+    shm = shared_memory.SharedMemory(name=name)
+    # only posix segments are tracked
+    if not track and os.name == "posix":
+        # pylint: disable=protected-access
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class _Ring:
+    """
+    a single producer, single consumer byte ring in shared memory
+    the producer only ever stores the head and the consumer only ever
+    stores the tail, so neither side takes a lock. that relies on the other
+    process seeing each 8 byte, aligned header store whole, and after the
+    data stored before it. x86-64 does both, but python makes no promise
+    of either, and weaker memory models like arm's may reorder the stores,
+    so SHM is only safe where the hardware orders them
+    `track` is whether this process unlinks the memory (see _attach)
+    """
+    def __init__(self, name, size, track=True):
+        self.shm = _attach(name, track)
+        self.size = size
+        self.base = _RING_HEADER.size
+
+    def load(self, offset):
+        """ returns the header word at `offset` """
+        return _U64.unpack_from(self.shm.buf, offset)[0]
+
+    def store(self, offset, value):
+        """ sets the header word at `offset` """
+        _U64.pack_into(self.shm.buf, offset, value)
+
+    def put(self, data):
+        """ copies as much of `data` as fits, returning how many bytes did """
+        head = self.load(_HEAD)
+        free = self.size - (head - self.load(_TAIL))
+        count = min(free, len(data))
+        if count == 0:
+            return 0
+
+        start = head % self.size
+        first = min(count, self.size - start)
+        data = memoryview(data)
+        buf = self.shm.buf
+        buf[self.base + start:self.base + start + first] = data[:first]
+        buf[self.base:self.base + count - first] = data[first:count]
+
+        # publish the data only once it's all in place
+        self.store(_HEAD, head + count)
+        return count
+
+    def get(self):
+        """ returns everything available to read, possibly b'' """
+        tail = self.load(_TAIL)
+        count = self.load(_HEAD) - tail
+        if count == 0:
+            return b''
+
+        start = tail % self.size
+        first = min(count, self.size - start)
+        buf = self.shm.buf
+        data = bytes(buf[self.base + start:self.base + start + first])
+        if first < count:
+            data += bytes(buf[self.base:self.base + count - first])
+
+        self.store(_TAIL, tail + count)
+        return data
+
+    def close(self):
+        self.shm.close()
+
+
+class _ShmReader(_Reader):
+    # seconds to keep checking the ring, letting other tasks run in
+    # between, before going to sleep on the bell. with one cpu, spinning
+    # only keeps the writer from running
+    _spin = 0.0002 if (os.cpu_count() or 1) > 1 else 0
+
+    def __init__(self, ring, bell):
+        super().__init__()
+        self._ring = ring
+        self._bell = bell
+        self._rung = asyncio.Event()
+        asyncio.get_running_loop().add_reader(bell.fileno(), self._on_bell)
+
+    def _on_bell(self):
+        # swallow every ring, since one read covers them all
+        while self._bell.poll():
+            self._bell.recv_bytes()
+        self._rung.set()
+
+    def close(self):
+        """ stops listening for the bell """
+        asyncio.get_running_loop().remove_reader(self._bell.fileno())
+
+    async def _fetch(self):
+        ring = self._ring
+        spin_until = None
+        while True:
+            chunk = ring.get()
+            if chunk:
+                return chunk
+            if ring.load(_CLOSED):
+                # anything written before closing has been read by now
+                return ring.get()
+
+            # a busy writer is usually only a moment away
+            now = time.perf_counter()
+            if spin_until is None:
+                spin_until = now + self._spin
+            if now < spin_until:
+                await asyncio.sleep(0)
+                continue
+
+            # ask for a wakeup, then check once more in case the writer
+            # was already done before it could see the request
+            self._rung.clear()
+            ring.store(_WAITING, 1)
+            chunk = ring.get()
+            if chunk:
+                ring.store(_WAITING, 0)
+                return chunk
+
+            # the timer covers a wakeup lost to the race above
+            timer = asyncio.get_running_loop().call_later(
+                RING_POLL, self._rung.set
+            )
+            await self._rung.wait()
+            timer.cancel()
+            ring.store(_WAITING, 0)
+            spin_until = None
+
+
+class _ShmWriter:
+    def __init__(self, ring, bell):
+        self._ring = ring
+        self._bell = bell
+        # data that didn't fit in the ring yet
+        self._pending = bytearray()
+
+    def _put(self, data):
+        """ puts what fits of `data` in the ring, returning the byte count """
+        written = self._ring.put(data)
+        if written and self._ring.load(_WAITING):
+            self._ring.store(_WAITING, 0)
+            self._bell.send_bytes(b'\x00')
+        return written
+
+    def _flush(self):
+        if self._pending:
+            del self._pending[:self._put(self._pending)]
+
+    def write(self, data):
+        """ copies `data` into the ring, holding on to what doesn't fit """
+        if self._pending:
+            self._pending += data
+            self._flush()
+            return
+
+        data = memoryview(data)
+        self._pending += data[self._put(data):]
+
+    async def drain(self):
+        """ waits until everything written is in the ring """
+        self._flush()
+        while self._pending:
+            await asyncio.sleep(RING_POLL / 10)
+            self._flush()
+
+    def close(self):
+        """ ends the stream for the reader """
+        self._flush()
+        self._ring.store(_CLOSED, 1)
+        if self._ring.load(_WAITING):
+            self._bell.send_bytes(b'\x00')
+
+
+class ShmEnd:
+    """
+    one end of a shared memory duplex
+    picklable, so it can be passed to a multiprocessing.Process as is
+    """
+    def __init__(self, rx_name, tx_name, size, rx_bell, tx_bell, owner):
+        self.rx_name = rx_name
+        self.tx_name = tx_name
+        self.size = size
+        # multiprocessing connections used only to wake a sleeping reader
+        self.rx_bell = rx_bell
+        self.tx_bell = tx_bell
+        # whether this end unlinks the shared memory once it's done
+        self.owner = owner
+
+    @contextlib.contextmanager
+    def detach(self):
+        """ stops this process from owning the shared memory """
+        self.owner = False
+        yield self
+
+    @contextlib.asynccontextmanager
+    async def open(self):
+        """ yields a (reader, writer) pair """
+        rx_ring = _Ring(self.rx_name, self.size, self.owner)
+        tx_ring = _Ring(self.tx_name, self.size, self.owner)
+        reader = _ShmReader(rx_ring, self.rx_bell)
+        writer = _ShmWriter(tx_ring, self.tx_bell)
+        try:
+            yield reader, writer
+        finally:
+            writer.close()
+            reader.close()
+            rx_ring.close()
+            tx_ring.close()
+            if self.owner:
+                for name in (self.rx_name, self.tx_name):
+                    try:
+                        shared_memory.SharedMemory(name=name).unlink()
+                    except FileNotFoundError:
+                        # the other end got to it first
+                        pass
+
+
+def _shm_duplex(size=RING_SIZE):
+    rings = []
+    for _ in range(2):
+        shm = shared_memory.SharedMemory(
+            create=True, size=_RING_HEADER.size + size
+        )
+        _RING_HEADER.pack_into(shm.buf, 0, 0, 0, 0, 0)
+        rings.append(shm.name)
+        shm.close()
+
+    one_rx, two_tx = multiprocessing.Pipe(duplex=False)
+    two_rx, one_tx = multiprocessing.Pipe(duplex=False)
+
+    return (
+        ShmEnd(rings[0], rings[1], size, one_rx, one_tx, owner=True),
+        ShmEnd(rings[1], rings[0], size, two_rx, two_tx, owner=True),
+    )
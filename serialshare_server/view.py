@@ -0,0 +1,174 @@
+"""
+A module for streaming a session's screen to browser viewers as diffs
+
+rather than the raw device output, which needs a terminal emulator to make
+sense of, viewers get json messages describing the screen itself: a full
+snapshot when they join, then only the lines and cells that changed, at
+most `fps` times a second. a slow viewer gets fewer, bigger diffs instead
+of a growing queue
+
+messages look like:
+    {"type": "snapshot", "width": 80, "height": 24, "cursor": [x, y],
+     "lines": [<runs>, ...]}
+    {"type": "diff", "cursor": [x, y], "lines": [[y, x, <runs>], ...]}
+
+snapshot lines leave out trailing blank cells. a diff's lines replace the
+cells of line y from column x on, for as many cells as the runs cover.
+runs are a list of plain strings, for text with default attributes, or
+[text, fg, bg, flags], with colors named as pyte names them and flags a
+bitmask of FLAGS
+"""
+
+import asyncio
+import json
+import time
+
+# attribute bits of a run's flags
+FLAGS = ("bold", "italics", "underscore", "strikethrough", "reverse")
+
+# diffs sent a second, by default and at most
+FPS = 20
+MAX_FPS = 60
+
+# an empty cell, with default attributes
+_BLANK = (" ", "default", "default", 0)
+
+
+def _cell(char):
+    """ returns a cell of a pyte screen as a hashable tuple """
+    flags = 0
+    for bit, name in enumerate(FLAGS):
+        if getattr(char, name, False):
+            flags |= 1 << bit
+    return char.data, char.fg, char.bg, flags
+
+
+def cells(screen, number):
+    """ returns the cells of line `number` of a pyte screen """
+    line = screen.buffer[number]
+    return tuple(_cell(line[column]) for column in range(screen.columns))
+
+
+def runs(line_cells):
+    """ returns cells as runs of text sharing the same attributes """
+    result = []
+    text = ""
+    style = None
+    for data, fg, bg, flags in line_cells:
+        if (fg, bg, flags) != style and text:
+            result.append(_run(text, style))
+            text = ""
+        style = (fg, bg, flags)
+        text += data
+    if text:
+        result.append(_run(text, style))
+    return result
+
+
+def _strip(line_cells):
+    """ returns cells without the blank ones at the end """
+    end = len(line_cells)
+    while end and line_cells[end - 1] == _BLANK:
+        end -= 1
+    return line_cells[:end]
+
+
+def _run(text, style):
+    if style == ("default", "default", 0):
+        return text
+    return [text, *style]
+
+
+class Viewer:
+    """
+    what one viewer has been sent of a session's screen, for working out
+    what to send it next
+    """
+    def __init__(self, session, fps=FPS):
+        self.session = session
+        self.interval = 1 / max(1, min(fps, MAX_FPS))
+
+        # the session revision, cells of each line and cursor last sent
+        self.revision = None
+        self.lines = {}
+        self.cursor = None
+
+        # counters
+        self.messages = 0
+        self.bytes_sent = 0
+
+    def _cursor(self):
+        screen = self.session.screen
+        return [screen.cursor.x, screen.cursor.y]
+
+    def snapshot(self):
+        """ returns a message with the whole screen """
+        screen = self.session.screen
+        self.revision = self.session.revision
+        self.lines = {
+            number: cells(screen, number) for number in range(screen.lines)
+        }
+        self.cursor = self._cursor()
+        return {
+            "type": "snapshot",
+            "width": screen.columns,
+            "height": screen.lines,
+            "cursor": self.cursor,
+            "lines": [
+                runs(_strip(self.lines[number]))
+                for number in range(screen.lines)
+            ],
+        }
+
+    def diff(self):
+        """
+        returns a message with what changed since the last one, or None if
+        nothing did
+        """
+        screen = self.session.screen
+        changed = []
+        for number in self.session.changed_since(self.revision):
+            new = cells(screen, number)
+            old = self.lines.get(number, ())
+            if new == old:
+                continue
+            self.lines[number] = new
+
+            # send only the span of cells between the first and last change
+            start = 0
+            while start < len(old) and old[start] == new[start]:
+                start += 1
+            end = len(new)
+            while end > start and len(old) == len(new) and (
+                    old[end - 1] == new[end - 1]
+            ):
+                end -= 1
+            changed.append([number, start, runs(new[start:end])])
+        self.revision = self.session.revision
+
+        cursor = self._cursor()
+        if not changed and cursor == self.cursor:
+            return None
+        self.cursor = cursor
+        return {"type": "diff", "cursor": cursor, "lines": changed}
+
+    async def _send(self, websocket, message):
+        text = json.dumps(message, separators=(",", ":"))
+        await websocket.send(text)
+        self.messages += 1
+        self.bytes_sent += len(text)
+
+    async def run(self, websocket):
+        """ sends a snapshot, then diffs as the screen changes, forever """
+        await self._send(websocket, self.snapshot())
+        sent = time.monotonic()
+
+        while True:
+            await self.session.wait_changed(self.revision)
+            # whatever else changes in the meantime goes into the same diff
+            await asyncio.sleep(self.interval - (time.monotonic() - sent))
+
+            message = self.diff()
+            if message is not None:
+                await self._send(websocket, message)
+                sent = time.monotonic()
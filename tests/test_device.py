@@ -0,0 +1,35 @@
+"""
+tests for serialshare.device
+"""
+
+import unittest
+from unittest import mock
+
+from serialshare import device
+
+
+class ResolveTest(unittest.TestCase):
+    """ device.resolve """
+
+    def setUp(self):
+        patcher = mock.patch.object(device, "list_devices", return_value={
+            "COM3 - USB Serial (COM3)": "COM3",
+        })
+        self.list_devices = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_com_port_names_are_kept(self):
+        self.assertEqual(device.resolve("COM12"), "COM12")
+        self.assertEqual(device.resolve("com4"), "com4")
+        self.list_devices.assert_not_called()
+
+    def test_windows_description_is_looked_up(self):
+        self.assertEqual(device.resolve("COM3 - USB Serial (COM3)"), "COM3")
+
+    def test_paths_are_kept(self):
+        self.assertEqual(device.resolve("/dev/null"), "/dev/null")
+        self.list_devices.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+"""
+tests for serialshare_server.fanout
+"""
+
+import unittest
+
+from serialshare_server import fanout
+
+
+class SubscribeTest(unittest.IsolatedAsyncioTestCase):
+    """ fanout.Broadcast.subscribe's queue length """
+
+    async def test_queue_below_one_is_refused(self):
+        broadcast = fanout.Broadcast()
+        for queue in (0, -1, -1000):
+            with self.assertRaises(ValueError):
+                broadcast.subscribe(max_queue=queue)
+        self.assertEqual(broadcast.subscribers, set())
+
+    async def test_queue_of_one_gets_the_newest_frame(self):
+        broadcast = fanout.Broadcast()
+        subscriber = broadcast.subscribe(max_queue=1)
+        broadcast.publish(b"a")
+        broadcast.publish(b"b")
+        self.assertEqual(await subscriber.get(), [b"b"])
+        self.assertEqual(subscriber.frames_dropped, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
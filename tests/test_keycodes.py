@@ -0,0 +1,44 @@
+"""
+tests for serialshare_server.keycodes
+"""
+
+import unittest
+
+from serialshare_server import keycodes
+
+
+class TranslateTest(unittest.TestCase):
+    """ keycodes.translate and keycodes.lookup """
+
+    def test_ascii(self):
+        self.assertEqual(keycodes.translate([ord(c) for c in "ls"]), b"ls")
+
+    def test_enter_is_carriage_return(self):
+        self.assertEqual(keycodes.translate([ord("\n")]), b"\r")
+
+    def test_special_keys(self):
+        screen = keycodes.AsciimaticsScreen
+        self.assertEqual(
+            keycodes.translate([screen.KEY_UP, screen.KEY_SHIFT]),
+            b"\x1b[A"
+        )
+
+    def test_mixed_input_is_utf8(self):
+        # a code under 256 is a character like any other, so é must come
+        # out as utf-8 alongside €, not as a lone latin-1 byte
+        self.assertEqual(
+            keycodes.translate([97, 233, 0x20ac]), b"a\xc3\xa9\xe2\x82\xac"
+        )
+
+    def test_lookup_matches_translate(self):
+        for code in (0, 97, 127, 128, 233, 255, 256, 0x20ac, 0x1f600):
+            self.assertEqual(
+                keycodes.lookup(code), keycodes.translate([code])
+            )
+
+    def test_unknown_codes_send_nothing(self):
+        self.assertEqual(keycodes.translate([-9999, 0x110000]), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+tests for serialshare.proto
+"""
+
+import unittest
+
+from serialshare import compress
+from serialshare import proto
+
+
+class UnpackTest(unittest.TestCase):
+    """ proto.Framer.unpack """
+
+    def test_round_trip(self):
+        framer = proto.Framer(2)
+        frame = framer.unpack(framer.pack(proto.SERIAL, b"hi", 3))
+        self.assertEqual(
+            (frame.mtype, frame.channel, frame.payload),
+            (proto.SERIAL, 3, b"hi")
+        )
+
+    def test_malformed_frames(self):
+        framer = proto.Framer(2)
+        good = framer.pack(proto.SERIAL, b"hi")
+        for message in (b"", "text", good[:5], bytes([proto.ACK]) + good[1:]):
+            with self.assertRaises(proto.FrameError):
+                framer.unpack(message)
+        self.assertEqual(framer.stats()["malformed"], 4)
+        # and the framer carries on afterwards
+        self.assertEqual(framer.unpack(good).payload, b"hi")
+
+    def test_bad_compressed_frame(self):
+        framer = proto.Framer(2, decompressor=compress.Decompressor())
+        with self.assertRaises(proto.FrameError):
+            framer.unpack(bytes([proto.SERIAL | compress.FLAG]) + b"junk")
+
+    def test_version_1(self):
+        framer = proto.Framer()
+        self.assertEqual(framer.unpack(b"\x00").payload, b"")
+        with self.assertRaises(proto.FrameError):
+            framer.unpack(b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+"""
+tests for serialshare_server.scrollback
+"""
+
+import tempfile
+import unittest
+
+from serialshare_server import scrollback
+
+
+class SearchTest(unittest.TestCase):
+    """ scrollback.Scrollback.search keeps each match within one line """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.scrollback = scrollback.open_scrollback(directory.name, "test")
+        self.addCleanup(self.scrollback.close)
+        for line in ("abc", "def", "a b"):
+            self.scrollback.append(line)
+
+    def test_no_match_across_lines(self):
+        for pattern in (r"c\s+d", r"c[^x]d", r"abc.def"):
+            self.assertEqual(self.scrollback.search(pattern), [])
+
+    def test_anchors_match_each_line(self):
+        self.assertEqual(self.scrollback.search(r"^d"), [(1, "def")])
+        self.assertEqual(self.scrollback.search(r"c$"), [(0, "abc")])
+
+    def test_limit_counts_lines(self):
+        self.assertEqual(
+            self.scrollback.search("b"), [(0, "abc"), (2, "a b")]
+        )
+        self.assertEqual(self.scrollback.search("b", limit=1), [(0, "abc")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+tests for the file sync exchange, serialshare.sync and
+serialshare_server.push
+"""
+
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+from serialshare import proto
+from serialshare import sync
+from serialshare_server import push
+
+
+class _Websocket:
+    """ a websocket that keeps whatever is sent on it """
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+class ReofferTest(unittest.IsolatedAsyncioTestCase):
+    """ an OFFER arriving again while the Receiver is still setting up """
+
+    async def test_reoffer_before_have(self):
+        # the device is still attaching, so the sync can't have asked the
+        # device what it has yet
+        attacher = asyncio.get_running_loop().create_future()
+        webserial = types.SimpleNamespace(attacher=attacher, channel=0)
+        receiver = sync.Receiver(webserial, 115200, {}, lambda: None)
+        websocket = _Websocket()
+        receiver.link(websocket, proto.Framer())
+
+        offer = sync.describe(b"print('hi')\n")
+        offer["dest"] = "/main.py"
+        await receiver.receive(sync.pack(sync.OFFER, offer))
+        await receiver.receive(sync.pack(sync.OFFER, offer))
+
+        self.assertTrue(receiver.busy())
+        self.assertIsNone(receiver.have)
+        self.assertEqual(websocket.sent, [])
+
+        receiver.task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await receiver.task
+
+
+class _RawRepl:
+    """ a raw REPL to a device on which the synced copy goes missing """
+    def __init__(self, webserial, baudrate):
+        del webserial, baudrate  # resolves pylint w0613
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def run(self, code):
+        del code  # resolves pylint w0613
+
+    async def evaluate(self, expression):
+        # neither the file nor a partial copy, before or after writing
+        if expression.startswith("(_ss_stat"):
+            return None, None
+        return None
+
+
+class ApplyFailureTest(unittest.IsolatedAsyncioTestCase):
+    """ a sync that fails still answers with a DONE saying why """
+
+    async def _apply(self, offer):
+        webserial = types.SimpleNamespace(attacher=None, channel=0)
+        receiver = sync.Receiver(webserial, 115200, {}, lambda: None)
+        websocket = _Websocket()
+        receiver.link(websocket, proto.Framer())
+        await receiver.receive(sync.pack(sync.OFFER, offer))
+        await receiver.task
+
+        operations = [sync.unpack(sent[1:]) for sent in websocket.sent]
+        self.assertEqual(operations[-1][0], sync.DONE)
+        return operations[-1][1]
+
+    async def test_bad_offer(self):
+        for offer in ({"dest": "/main.py"}, {}, ["not", "an", "offer"]):
+            done = await self._apply(offer)
+            self.assertFalse(done["ok"])
+            self.assertIn("offer", done["error"])
+
+    async def test_copy_missing(self):
+        offer = sync.describe(b"")
+        offer["dest"] = "/main.py"
+        with mock.patch.object(sync, "RawRepl", _RawRepl):
+            done = await self._apply(offer)
+        self.assertFalse(done["ok"])
+        self.assertIn("missing", done["error"])
+
+
+class MalformedHaveTest(unittest.IsolatedAsyncioTestCase):
+    """ a HAVE the Pusher can't build a delta against """
+
+    async def test_ignored(self):
+        pusher = push.Pusher([])
+        data = b"print('hi')\n"
+        offer = sync.describe(data)
+        offer["dest"] = "/main.py"
+        pusher.seen["main.py"] = (0, offer, data)
+        dev_session = types.SimpleNamespace(
+            session_id="default", websocket=_Websocket(),
+            framer=proto.Framer(), channel=0
+        )
+
+        for body in (None, [], {"digest": offer["digest"]}):
+            await pusher.receive(dev_session, sync.pack(sync.HAVE, body))
+        self.assertEqual(pusher.sending, set())
+
+        await pusher.receive(dev_session, sync.pack(sync.HAVE, {
+            "digest": offer["digest"], "blocks": []
+        }))
+        await asyncio.gather(*pusher.sending)
+        self.assertTrue(dev_session.websocket.sent)
+
+
+if __name__ == "__main__":
+    unittest.main()